@@ -1,21 +1,28 @@
+import cPickle
 from cStringIO import StringIO
 from datetime import datetime
 from functools import partial
-from itertools import chain, izip
+from hashlib import sha1
+from itertools import chain, imap, islice, izip
+import json
 from logging import StreamHandler
 import os
 from os.path import join, basename, split, dirname
 from sys import stderr
 from mimetypes import guess_type
 
-from flask import (Blueprint, Flask, current_app, send_file, request, redirect,
-                   jsonify, render_template, url_for)
+from flask import (Blueprint, Flask, Response, current_app, send_file, request,
+                   redirect, jsonify, render_template, stream_with_context,
+                   url_for)
 from funcy import merge
 from pyelasticsearch import ElasticSearch
+from werkzeug.contrib.cache import MemcachedCache
 from werkzeug.exceptions import NotFound
 
-from dxr.es import (filtered_query, frozen_config, frozen_configs,
-                    es_alias_or_not_found)
+from dxr.es import (BLOCKED_LINE_ARRAYS, filtered_query, frozen_config,
+                    frozen_configs, es_alias_or_not_found, LINE_BLOCK,
+                    numbered_sources, REF, unblocked_line_docs,
+                    unblocked_lines)
 from dxr.exceptions import BadTerm
 from dxr.filters import FILE, LINE
 from dxr.lines import html_line, tags_per_line, finished_tags, Ref, Region
@@ -24,7 +31,7 @@ from dxr.plugins import plugins_named
 from dxr.query import Query, filter_menu_items
 from dxr.utils import (non_negative_int, decode_es_datetime, DXR_BLUEPRINT,
                        format_number, append_by_line, build_offset_map,
-                       split_content_lines)
+                       split_content_lines, LruCache)
 from dxr.vcs import file_contents_at_rev
 
 # Look in the 'dxr' package for static files, etc.:
@@ -109,9 +116,29 @@ def make_app(config):
     # Make an ES connection pool shared among all threads:
     app.es = ElasticSearch(config.es_hosts)
 
+    # Cache search results in this process. The memcached tier, if any, is
+    # connected on first use, so indexing doesn't need a client library.
+    app.search_cache = LruCache(config.search_cache_size,
+                                config.search_cache_megabytes * 1024 * 1024)
+    app.shared_search_cache = None
+
+    # (time read, tree docs, tree docs by name), as cached by dxr.es:
+    app.catalog_cache = None
+
     return app
 
 
+# The biggest pickled search result we cache. memcached refuses items over a
+# megabyte by default anyway.
+MAX_CACHED_RESULT_BYTES = 1024 * 1024
+
+# How many template events to render before sending them off when streaming
+STREAM_BUFFER_SIZE = 50
+
+# The most lines of a file to fetch from ES in one request when browsing
+LINES_PER_PAGE = 1000
+
+
 @dxr_blueprint.route('/')
 def index():
     return redirect(url_for('.browse',
@@ -136,14 +163,80 @@ def search(tree):
     query = Query(partial(current_app.es.search,
                           index=frozen['es_alias']),
                   query_text,
-                  plugins_named(frozen['enabled_plugins']))
+                  plugins_named(frozen['enabled_plugins']),
+                  frozen.get('line_block_size', 0))
 
     # Fire off one of the two search routines:
-    searcher = _search_json if _request_wants_json() else _search_html
-    return searcher(query, tree, query_text, offset, limit, config)
+    if _request_wants_json():
+        return _search_json(query, tree, query_text, offset, limit, config,
+                            frozen.get('es_index'))
+    return _search_html(query, tree, query_text, offset, limit, config)
 
 
-def _search_json(query, tree, query_text, offset, limit, config):
+def _shared_search_cache():
+    """Return the memcached tier of the search cache, or None if there isn't
+    one."""
+    config = current_app.dxr_config
+    if (current_app.shared_search_cache is None and
+            config.search_cache_servers and config.search_cache_size):
+        current_app.shared_search_cache = MemcachedCache(
+            config.search_cache_servers,
+            default_timeout=0,  # Let memcached evict as it likes.
+            key_prefix='dxr/')
+    return current_app.shared_search_cache
+
+
+def _cached_search(index, query, key_extras, compute):
+    """Return ``compute()``, caching it in memory and, if configured,
+    memcached.
+
+    Indices never change once deployed, so we key on the index the tree's
+    alias points to, along with the parsed query terms--which irons out
+    differences in whitespace and quoting--and ``key_extras``. Deploying a
+    new index makes for new keys; the old entries just age out. Results
+    which pickle to more than ``MAX_CACHED_RESULT_BYTES`` aren't cached.
+
+    :arg index: The name of the tree's current index, or None to not cache,
+        as for trees deployed before we recorded it
+    :arg key_extras: A JSON-serializable list telling apart the things we
+        cache for a query, like which page of results
+
+    """
+    if not index or not current_app.dxr_config.search_cache_size:
+        return compute()
+    key = sha1(json.dumps([index, query.terms] + key_extras,
+                          sort_keys=True)).hexdigest()
+    local = current_app.search_cache
+    shared = _shared_search_cache()
+    # We wrap values in a list, along with their pickled sizes, so we can
+    # cache None.
+    wrapped = local.get(key)
+    if wrapped is None and shared is not None:
+        wrapped = shared.get(key)
+        if wrapped is not None:
+            local.set(key, wrapped, wrapped[1])
+    if wrapped is None:
+        value = compute()
+        bytes = len(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+        if bytes > MAX_CACHED_RESULT_BYTES:
+            return value
+        wrapped = [value, bytes]
+        local.set(key, wrapped, bytes)
+        if shared is not None:
+            shared.set(key, wrapped)
+    return wrapped[0]
+
+
+def _query_results(query, offset, limit):
+    """Return the results of a query as :meth:`Query.results()` does, but
+    with the results in a list, fit for caching."""
+    count_and_results = query.results(offset, limit)
+    return {'result_count': count_and_results['result_count'],
+            'results': list(count_and_results['results'])}
+
+
+def _search_json(query, tree, query_text, offset, limit, config,
+                 index=None):
     """Try a "direct search" (for exact identifier matches, etc.). If we have a direct hit,
     then return {redirect: hit location}. If that doesn't work, fall back to a normal
     search, and if that yields a single result and redirect is true then return
@@ -157,11 +250,14 @@ def _search_json(query, tree, query_text, offset, limit, config):
           a bubble indicating as much.
     We only redirect to a direct/unique result if the original query contained a
     'redirect=true' parameter, which the user can elicit by hitting enter on the query
-    input."""
+    input.
+
+    Results are cached by ``index``, the name of the tree's current index.
 
+    """
     # If we're asked to redirect and have a direct hit, then return the url to that.
     if request.values.get('redirect') == 'true':
-        result = query.direct_result()
+        result = _cached_search(index, query, ['direct'], query.direct_result)
         if result:
             path, line = result
             # TODO: Does this escape query_text properly?
@@ -173,11 +269,15 @@ def _search_json(query, tree, query_text, offset, limit, config):
             }
             return jsonify({'redirect': url_for('.browse', _anchor=line, **params)})
     try:
-        count_and_results = query.results(offset, limit)
+        count_and_results = _cached_search(
+            index,
+            query,
+            ['results', offset, limit],
+            lambda: _query_results(query, offset, limit))
         # If we're asked to redirect and there's a single result, redirect to the result.
         if (request.values.get('redirect') == 'true' and
             count_and_results['result_count'] == 1):
-            _, path, line = next(count_and_results['results'])
+            _, path, line = count_and_results['results'][0]
             line = line[0][0] if line else None
             params = {
                 'tree': tree,
@@ -291,6 +391,23 @@ def lines(tree):
     path = req.get('path', '')
     from_line = max(0, int(req.get('start', '')))
     to_line = int(req.get('end', ''))
+    frozen = frozen_config(tree)
+    if frozen.get('line_block_size'):
+        # Every line's content is in the blocks. Take those overlapping the
+        # range, and pick out its lines.
+        blocks = filtered_query(
+            frozen['es_alias'],
+            LINE_BLOCK,
+            filter={'path': path},
+            sort=['number'],
+            size=(to_line - from_line) // frozen['line_block_size'] + 2,
+            include=['number', 'content'],
+            range={'number': {'gte': from_line, 'lte': to_line}})
+        return jsonify({'lines': [{'line_number': number, 'line': content}
+                                  for number, content in unblocked_lines(blocks)
+                                  if from_line <= number <= to_line],
+                        'path': path})
+
     ctx_found = []
     possible_hits = current_app.es.search(
             {
@@ -342,21 +459,156 @@ def browse(tree, path=''):
             # Then this path is a symlink, so redirect to the real thing.
             return redirect(url_for('.browse', tree=tree, path=file_doc['link'][0]))
 
-        lines = filtered_query(
-            frozen['es_alias'],
-            LINE,
-            filter={'path': path},
-            sort=['number'],
-            size=1000000,
-            include=['content', 'refs', 'regions', 'annotations'])
-        # Deref the content field in each document. We can do this because we
-        # do not store empty lines in ES.
-        for doc in lines:
-            doc['content'] = doc['content'][0]
-
-        return _browse_file(tree, path, lines, file_doc, config,
+        # Render only the first browse_lines lines of big files. The page
+        # fetches the rest from rendered_lines() as it's scrolled. Ask for one
+        # extra to see whether there are any more.
+        max_lines = config.browse_lines
+        return _browse_file(tree, path,
+                            _line_docs(frozen,
+                                       path,
+                                       last=max_lines + 1 if max_lines else None),
+                            file_doc, config,
                             file_doc.get('is_binary', [False])[0],
-                            frozen['generated_date'])
+                            frozen['generated_date'],
+                            index=frozen['es_alias'],
+                            max_lines=max_lines)
+
+
+@dxr_blueprint.route('/<tree>/rendered-lines/<path:path>')
+def rendered_lines(tree, path):
+    """Return the HTML and annotations of lines start through end of a file,
+    as rendered on its browse page, for filling in the rest of the page as
+    it's scrolled.
+
+    Stored refs and regions are reckoned from the start of the file, so the
+    page passes along the offset at which line start begins, as returned with
+    the lines before it. That way, only the lines asked for are fetched and
+    rendered. At most browse_lines lines are returned at once.
+
+    Also say whether there are more lines after those and at what offset
+    they begin.
+
+    """
+    req = request.values
+    first = max(1, int(req.get('start', '')))
+    last = max(first - 1, int(req.get('end', '')))
+    max_lines = current_app.dxr_config.browse_lines
+    if max_lines:
+        last = min(last, first + max_lines - 1)
+    offset = max(0, int(req.get('offset', 0)))
+    frozen = frozen_config(tree)
+    files = filtered_query(
+        frozen['es_alias'],
+        FILE,
+        filter={'path': path},
+        size=1,
+        include=['link', 'links', 'is_binary'])
+    if not files or 'link' in files[0] or files[0].get('is_binary', [False])[0]:
+        raise NotFound
+    file_doc = files[0]
+
+    line_docs = _line_docs(frozen, path, first=first, last=last + 1)
+    _, lines, html_lines, annotation_sets = _rendered_lines(
+        current_app.dxr_config.trees[tree],
+        path,
+        islice(line_docs, last - first + 1),
+        file_doc,
+        index=frozen['es_alias'],
+        offset=offset)
+    return jsonify({'lines': list(html_lines),
+                    'annotations': list(annotation_sets),
+                    # The extra line we asked for is all that's left:
+                    'more': next(line_docs, None) is not None,
+                    'offset': offset + sum(imap(len, lines))})
+
+
+def _line_docs(frozen, path, first=None, last=None):
+    """Yield the LINE docs for lines first through last of a file, in order,
+    with their content fields dereferenced. In trees with blocks, docs of the
+    same shape are pieced together from those instead.
+
+    They're fetched a page at a time as they're consumed, so a caller can
+    render them as they come and stop early without fetching the rest. No
+    page holds more than LINES_PER_PAGE lines or than the range asked for.
+
+    :arg frozen: The frozen config of the file's tree
+
+    """
+    index = frozen['es_alias']
+    page_size = LINES_PER_PAGE
+    if first is not None and last is not None:
+        page_size = max(1, min(page_size, last - first + 1))
+    elif last is not None:
+        page_size = max(1, min(page_size, last))
+    block_size = frozen.get('line_block_size')
+    if block_size:
+        # A page's worth of lines can straddle a block at either end:
+        return _lines_from_blocks(index, path, first, last,
+                                  page_size=(page_size - 1) // block_size + 2)
+    # Deref the content field in each document. We can do this because we do
+    # not store empty lines in ES.
+    return _with_content_dereffed(numbered_sources(
+        index,
+        LINE,
+        filter={'path': path},
+        include=['content', 'refs', 'regions', 'annotations'],
+        page_size=page_size,
+        first=first,
+        last=last))
+
+
+def _ref_payloads(index, refs):
+    """Fetch, in one request, the payloads some refs from LINE docs point to,
+    and return them in a dict by ID, with their menu data decoded.
+
+    """
+    ids = set(ref['payload'] for ref in refs)
+    if not ids:
+        return {}
+    docs = current_app.es.multi_get(list(ids),
+                                    index=index,
+                                    doc_type=REF)['docs']
+    payloads = {}
+    for doc in docs:
+        if doc.get('found'):
+            payload = doc['_source']
+            payload['menu_data'] = json.loads(payload['menu_data'])
+            payloads[doc['_id']] = payload
+    return payloads
+
+
+def _with_content_dereffed(line_docs):
+    """Yield LINE docs with their content fields dereferenced."""
+    for doc in line_docs:
+        doc['content'] = doc['content'][0]
+        yield doc
+
+
+def _lines_from_blocks(index, path, first=None, last=None, page_size=1000):
+    """Yield a doc for every line, first through last, of a file in a tree
+    with a line_block_size, with its content dereferenced.
+
+    The LINE_BLOCK docs in such trees hold the content, refs, regions, and
+    annotations of every line, so the LINE docs, which hold just structural
+    needles, needn't be fetched at all.
+
+    :arg page_size: How many LINE_BLOCK docs to fetch at once
+
+    """
+    blocks = numbered_sources(index,
+                              LINE_BLOCK,
+                              filter={'path': path},
+                              include=['number', 'content'] +
+                                      BLOCKED_LINE_ARRAYS,
+                              page_size=page_size,
+                              first=first,
+                              last=last)
+    for block in blocks:
+        for number, doc in unblocked_line_docs(block):
+            # The blocks at the ends can stick out past the range.
+            if ((first is None or number >= first) and
+                    (last is None or number <= last)):
+                yield doc
 
 
 def concat_plugin_headers(plugin_list):
@@ -470,13 +722,15 @@ def _build_common_file_template(tree, path, is_binary, date, config):
 
 
 def _browse_file(tree, path, line_docs, file_doc, config, is_binary,
-                 date=None, contents=None, image_rev=None):
+                 date=None, contents=None, image_rev=None, index=None,
+                 max_lines=0):
     """Return a rendered page displaying a source file.
 
     :arg string tree: name of tree on which file is found
     :arg string path: relative path from tree root of file
-    :arg list line_docs: LINE documents as defined in the mapping of core.py,
-        where the `content` field is dereferenced
+    :arg line_docs: an iterable of LINE documents as defined in the mapping of
+        core.py, where the `content` field is dereferenced. It is read only
+        once, and only as far as is rendered.
     :arg file_doc: the FILE document as defined in core.py
     :arg config: TreeConfig object of this tree
     :arg is_binary: Whether file is binary or not
@@ -485,6 +739,9 @@ def _browse_file(tree, path, line_docs, file_doc, config, is_binary,
         the `content` field of all line_docs
     :arg image_rev: revision number of a textual or binary image, for images
         displayed at a certain rev
+    :arg index: the ES index to fetch the payloads of line_docs' refs from
+    :arg max_lines: how many of line_docs to render, if not all. If there are
+        more, the page fetches them from rendered_lines() as it's scrolled.
     """
     def process_link_templates(sections):
         """Look for {{line}} in the links of given sections, and duplicate them onto
@@ -525,17 +782,12 @@ def _browse_file(tree, path, line_docs, file_doc, config, is_binary,
         return render_template(
             'text_file.html',
             **merge(common, {
+                'line_count': 0,
                 'lines': [],
+                'annotation_sets': [],
                 'is_binary': True,
                 'sections': sidebar_links(links)}))
     else:
-        # We concretize the lines into a list because we iterate over it multiple times
-        lines = [doc['content'] for doc in line_docs]
-        if not contents:
-            # If contents are not provided, we can reconstruct them by
-            # stitching the lines together.
-            contents = ''.join(lines)
-        offsets = build_offset_map(lines)
         tree_config = config.trees[tree]
         if is_textual_image(path) and image_rev:
             # Add a link to view textual images on revs:
@@ -546,41 +798,111 @@ def _browse_file(tree, path, line_docs, file_doc, config, is_binary,
                                               tree=tree_config.name,
                                               path=path,
                                               revision=image_rev))])]))
-        # Construct skimmer objects for all enabled plugins that define a
-        # file_to_skim class.
-        skimmers = [plugin.file_to_skim(path,
-                                        contents,
-                                        plugin.name,
-                                        tree_config,
-                                        file_doc,
-                                        line_docs)
-                    for plugin in tree_config.enabled_plugins
-                    if plugin.file_to_skim]
-        skim_links, refses, regionses, annotationses = skim_file(skimmers, len(line_docs))
-        index_refs = (Ref.es_to_triple(ref, tree_config) for ref in
-                      chain.from_iterable(doc.get('refs', [])
-                                          for doc in line_docs))
-        index_regions = (Region.es_to_triple(region) for region in
-                         chain.from_iterable(doc.get('regions', [])
-                                             for doc in line_docs))
-        tags = finished_tags(lines,
-                             chain(chain.from_iterable(refses), index_refs),
-                             chain(chain.from_iterable(regionses), index_regions))
-        return render_template(
+        line_docs = iter(line_docs)
+        skim_links, lines, html_lines, annotation_sets = _rendered_lines(
+            tree_config,
+            path,
+            islice(line_docs, max_lines) if max_lines else line_docs,
+            file_doc,
+            contents,
+            index)
+        # _rendered_lines() has read all the lines it renders already.
+        more_lines = next(line_docs, None) is not None
+        # Stream the page out as we go, so big files start showing up right
+        # away and we never hold the HTML of every line at once. The HTML
+        # lines are made lazily, in a single pass by the template.
+        return _stream_template(
             'text_file.html',
             **merge(common, {
-                # Someday, it would be great to stream this and not concretize
-                # the whole thing in RAM. The template will have to quit
-                # looping through the whole thing 3 times.
-                'lines': [(html_line(doc['content'], tags_in_line, offset),
-                           doc.get('annotations', []) + skim_annotations)
-                          for doc, tags_in_line, offset, skim_annotations
-                              in izip(line_docs, tags_per_line(tags), offsets, annotationses)],
+                'line_count': len(lines),
+                'lines': html_lines,
+                'annotation_sets': annotation_sets,
+                'more_lines': more_lines,
+                # Where the lines rendered_lines() fills in begin:
+                'more_offset': sum(imap(len, lines)) if more_lines else 0,
                 'sections': sidebar_links(links + skim_links),
                 'query': request.args.get('q', ''),
                 'bubble': request.args.get('redirect_type')}))
 
 
+def _rendered_lines(tree_config, path, line_docs, file_doc, contents=None,
+                    index=None, offset=0):
+    """Skim a text file, and mark up its lines.
+
+    Return the skimmers' sidebar links, a list of the text of each line, an
+    iterable of the HTML of each line, and an iterable of the annotations of
+    each line. The iterables are lazy, and each may be iterated only once.
+
+    Skimmers need the whole text at once, so line_docs is read through right
+    away, but as it goes rather than concretized first: only the text, refs,
+    regions, and annotations of each doc are kept.
+
+    Arguments are as for _browse_file(). Lines may be left off either end of
+    line_docs, though then skimmers see only the ones there.
+
+    :arg offset: The offset into the file of the start of the first of
+        line_docs, from which the refs and regions stored on them are reckoned
+
+    """
+    lines, es_refs, index_regions, doc_annotationses = [], [], [], []
+    for doc in line_docs:
+        lines.append(doc['content'])
+        es_refs.extend(doc.get('refs', ()))
+        index_regions.extend(Region.es_to_triple(region)
+                             for region in doc.get('regions', ()))
+        doc_annotationses.append(doc.get('annotations', ()))
+    if not contents:
+        # If contents are not provided, we can reconstruct them by
+        # stitching the lines together.
+        contents = ''.join(lines)
+    offsets = build_offset_map(lines)
+    # Construct skimmer objects for all enabled plugins that define a
+    # file_to_skim class. The docs hold no per-line needles, so there are no
+    # line_properties to give them.
+    skimmers = [plugin.file_to_skim(path,
+                                    contents,
+                                    plugin.name,
+                                    tree_config,
+                                    file_doc)
+                for plugin in tree_config.enabled_plugins
+                if plugin.file_to_skim]
+    skim_links, refses, regionses, annotationses = skim_file(skimmers, len(lines))
+    ref_payloads = _ref_payloads(index, es_refs) if index else {}
+    index_refs = [Ref.es_to_triple(ref, tree_config, ref_payloads)
+                  for ref in es_refs if ref['payload'] in ref_payloads]
+    if offset:
+        # Reckon them from the start of line_docs, like everything else here.
+        index_refs, index_regions = [
+            ((start - offset, end - offset, payload)
+             for start, end, payload in triples)
+            for triples in (index_refs, index_regions)]
+    tags = finished_tags(lines,
+                         chain(chain.from_iterable(refses), index_refs),
+                         chain(chain.from_iterable(regionses), index_regions))
+    return (skim_links,
+            lines,
+            (html_line(text, tags_in_line, line_offset)
+             for text, tags_in_line, line_offset
+                 in izip(lines, tags_per_line(tags), offsets)),
+            (list(doc_annotations) + skim_annotations
+             for doc_annotations, skim_annotations
+                 in izip(doc_annotationses, annotationses)))
+
+
+def _stream_template(template_name, **context):
+    """Return a response which renders a template bit by bit as it's sent,
+    rather than all at once beforehand.
+
+    The template must iterate over any generators in the context only once.
+
+    """
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template_name).stream(context)
+    # Send in chunks of a few dozen template events rather than one by one:
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return Response(stream_with_context(stream))
+
+
 @dxr_blueprint.route('/<tree>/rev/<revision>/<path:path>')
 def rev(tree, revision, path):
     """Display a page showing the file at path at specified revision by
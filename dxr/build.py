@@ -1,36 +1,57 @@
+from collections import namedtuple
+import cPickle
+from contextlib import contextmanager
+from copy import deepcopy
 from datetime import datetime
-from errno import ENOENT
-from fnmatch import fnmatchcase
-from itertools import chain, izip, repeat
+from errno import EEXIST, ENOENT
+import gzip
+from hashlib import sha1
+from heapq import heappush, heappushpop, nlargest
+from itertools import chain, count, izip
+import json
+from mmap import mmap, ACCESS_READ
+import multiprocessing
 import os
 from os import stat, makedirs
-from os.path import islink, relpath, join, split
+from os.path import dirname, exists, islink, relpath, join, split
+from Queue import Queue
+import re
 from shutil import rmtree
+from stat import S_ISLNK
 import subprocess
 import sys
 from sys import exc_info
+from tempfile import mkstemp
+from threading import Condition, Lock, Thread
+from time import sleep, time
 from traceback import format_exc
 from uuid import uuid1
 
-from binaryornot.helpers import is_binary_string
-from concurrent.futures import as_completed, ProcessPoolExecutor
+from concurrent.futures import (as_completed, wait, FIRST_COMPLETED,
+                                ProcessPoolExecutor, ThreadPoolExecutor)
 from click import progressbar
 from flask import current_app
-from funcy import ichunks, first
+from funcy import first
+from pkg_resources import DistributionNotFound, get_distribution
 from pyelasticsearch import (ElasticSearch, IndexAlreadyExistsError,
-                             bulk_chunks, Timeout, ConnectionError)
+                             ElasticHttpError, ElasticHttpNotFoundError,
+                             BulkError, Timeout, ConnectionError)
+from pyelasticsearch.client import JsonEncoder
 
 from dxr.app import make_app, dictify_links
 from dxr.config import FORMAT
-from dxr.es import UNINDEXED_STRING, UNANALYZED_STRING, TREE, create_index_and_wait
+from dxr.es import (UNINDEXED_STRING, UNANALYZED_STRING, UNINDEXED_INT, TREE,
+                    BLOCKED_LINE_ARRAYS, LINE_BLOCK, LINE_FILE_NEEDLES, REF,
+                    create_index_and_wait, scroll_hits)
 from dxr.exceptions import BuildError
 from dxr.filters import LINE, FILE
-from dxr.lines import es_lines, finished_tags
+from dxr.lines import es_lines, finished_tags, ref_payload_id
 from dxr.mime import decode_data
-from dxr.utils import (open_log, deep_update, append_update,
-                       append_update_by_line, append_by_line, bucket,
-                       split_content_lines, unicode_for_display)
-from dxr.vcs import VcsCache
+from dxr.profiling import Profile, write_report
+from dxr.utils import (open_log, deep_update, append_update, by_line, bucket,
+                       split_content_lines, unicode_for_display, glob_to_regex,
+                       rss_bytes)
+from dxr.vcs import claim_repos, VcsCache
 
 
 def full_traceback(callable, *args, **kwargs):
@@ -48,21 +69,216 @@ def full_traceback(callable, *args, **kwargs):
         raise Exception(format_exc())
 
 
-def index_and_deploy_tree(tree, verbose=False):
+def index_and_deploy_tree(tree, **kwargs):
     """Index a tree, and make it accessible.
 
     :arg tree: The TreeConfig of the tree to build
+    :arg kwargs: Passed along to :func:`index_tree()`
 
     """
-    config = tree.config
-    es = ElasticSearch(config.es_hosts,
-                       timeout=config.es_indexing_timeout,
-                       max_retries=config.es_indexing_retries)
-    index_name = index_tree(tree, es, verbose=verbose)
-    if 'index' not in tree.config.skip_stages:
+    es = indexing_es(tree.config)
+    index_name = index_tree(tree, es, **kwargs)
+    if index_name is not None:  # not skipping indexing or exporting
         deploy_tree(tree, es, index_name)
 
 
+def indexing_es(config):
+    """Return an ElasticSearch connection set up for indexing."""
+    return ElasticSearch(config.es_hosts,
+                         timeout=config.es_indexing_timeout,
+                         max_retries=config.es_indexing_retries)
+
+
+def index_and_deploy_trees(trees, jobs=1, max_es_requests=0, **kwargs):
+    """Index several trees, and make each accessible as it finishes.
+
+    With more than one job, each tree is indexed in a process of its own,
+    its console output going to a file next to its log folder. A tree waits
+    to start until its workers fit within the ``workers`` budget of the
+    ``[DXR]`` section alongside those of the trees already running. That way,
+    one tree's build can overlap another's file indexing without
+    oversubscribing the machine. Deployment--the alias swap and catalog
+    update--happens back in this process, one tree at a time.
+
+    If a tree fails, we start no more, let the running ones finish and
+    deploy, and then raise the first failure.
+
+    :arg trees: The TreeConfigs of the trees to index
+    :arg jobs: The most trees to index at once
+    :arg max_es_requests: A cap on the bulk requests in flight to ES at once,
+        across all trees and their workers, or 0 for none
+    :arg kwargs: Passed along to :func:`index_tree()`
+
+    """
+    if max_es_requests:
+        limit_es_requests(max_es_requests)
+    if jobs <= 1:
+        for tree in trees:
+            index_and_deploy_tree(tree, **kwargs)
+        return
+    if not trees:
+        return
+
+    config = trees[0].config
+    budget = max(config.workers, 1)
+    es = indexing_es(config)
+    pending, running = list(trees), {}
+    failure = None
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        while pending or running:
+            if failure is None:
+                for tree in trees_to_start(pending,
+                                           running.values(),
+                                           jobs,
+                                           budget):
+                    pending.remove(tree)
+                    output_path = tree_output_path(tree)
+                    print "Starting tree '%s'. Its output goes to %s." % (
+                        tree.name, output_path)
+                    running[pool.submit(full_traceback,
+                                        index_tree_to_file,
+                                        tree,
+                                        output_path,
+                                        **kwargs)] = tree
+            else:
+                pending = []
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                tree = running.pop(future)
+                try:
+                    index = future.result()
+                except Exception:
+                    print >> sys.stderr, "Indexing '%s' failed. See %s." % (
+                        tree.name, tree_output_path(tree))
+                    failure = failure or exc_info()
+                else:
+                    if index is not None:
+                        deploy_tree(tree, es, index)
+                    print "Finished tree '%s'." % tree.name
+    if failure:
+        raise failure[0], failure[1], failure[2]
+
+
+def trees_to_start(pending, running, jobs, budget):
+    """Return a list of the pending trees to start now, given the running
+    ones.
+
+    We go in order but skip over trees whose workers don't fit in what's left
+    of the budget, so little trees fill in around big ones. A tree that wants
+    more than the whole budget gets cut down to it, so it runs alone.
+
+    :arg pending: TreeConfigs of the trees yet to index, in preferred order
+    :arg running: TreeConfigs of the trees being indexed
+    :arg jobs: The most trees to run at once
+    :arg budget: The most worker processes to run at once
+
+    """
+    def cost(tree):
+        return min(max(tree.workers, 1), budget)
+
+    free = budget - sum(cost(tree) for tree in running)
+    slots = jobs - len(running)
+    starting = []
+    for tree in pending:
+        if len(starting) >= slots:
+            break
+        if cost(tree) <= free:
+            starting.append(tree)
+            free -= cost(tree)
+    return starting
+
+
+def tree_output_path(tree):
+    """Return where the console output of a tree indexed in parallel with
+    others goes.
+
+    It can't go in the log folder, since indexing clears that out.
+
+    """
+    return tree.log_folder.rstrip(os.sep) + '.out'
+
+
+def index_tree_to_file(tree, output_path, **kwargs):
+    """Index a tree with our stdout and stderr sent to a file, and return the
+    name of the new index.
+
+    This is meant to run in a process of its own. The redirection is at the
+    file-descriptor level, so the build command and worker processes we start
+    write there too.
+
+    """
+    with open(output_path, 'w', 1) as output:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(output.fileno(), sys.stdout.fileno())
+        os.dup2(output.fileno(), sys.stderr.fileno())
+        return index_tree(tree, indexing_es(tree.config), **kwargs)
+
+
+def load_and_deploy_tree(tree, export_folder):
+    """Send the bulk requests a ``dxr index --export`` run wrote for a tree
+    into a new index, and make it accessible.
+
+    Files are read and sent as fast as ES takes them, with as many requests
+    in flight as a regular run of the tree would have across its workers.
+
+    :arg export_folder: The folder given to ``--export``, which holds a
+        folder for each tree
+
+    """
+    config = tree.config
+    es = indexing_es(config)
+    export = Export(join(export_folder, tree.name))
+    bulk_files = export.bulk_files()
+    index = new_index_name(tree)
+    print "Loading '%s' from %s." % (tree.name, export.folder)
+    create_index_and_wait(es, index, settings=export.load_settings())
+    try:
+        for doc_type, paths in sorted(
+                bucket(bulk_files, lambda file: file[0]).iteritems()):
+            with BulkSender(es,
+                            index,
+                            threads=(max(tree.workers, 1) *
+                                     max(config.es_indexing_senders, 1)),
+                            doc_type=doc_type,
+                            timeout=config.es_indexing_timeout) as sender:
+                with aligned_progressbar(
+                        paths,
+                        label='Loading %s docs' % doc_type) as bar:
+                    for _, path in bar:
+                        sender.add_all(export.actions(path))
+        make_searchable(es, index, config)
+    except Exception as exc:
+        delete_index_quietly(es, index)
+        raise
+    deploy_tree(tree, es, index)
+    print "Finished loading '%s'." % tree.name
+
+
+# A semaphore shared by this process and the ones it forks, if the number of
+# bulk requests in flight to ES is capped:
+_es_request_slots = None
+
+
+def limit_es_requests(max_requests):
+    """Cap the number of bulk requests in flight to ES at once, across this
+    process and any it forks from now on."""
+    global _es_request_slots
+    _es_request_slots = multiprocessing.BoundedSemaphore(max_requests)
+
+
+@contextmanager
+def es_request_slot():
+    """Wait, if requests are capped, for a turn to send one to ES."""
+    if _es_request_slots is None:
+        yield
+    else:
+        with _es_request_slots:
+            yield
+
+
 def deploy_tree(tree, es, index_name):
     """Point the ES aliases and catalog records to a newly built tree, and
     delete any obsoleted index.
@@ -99,12 +315,20 @@ def deploy_tree(tree, es, index_name):
                             'format': UNANALYZED_STRING,
                             # In case es_alias changes in the conf file:
                             'es_alias': UNINDEXED_STRING,
+                            # The index the alias points to, which search
+                            # result caches key on:
+                            'es_index': UNINDEXED_STRING,
                             # Needed so new trees or edited descriptions can show
                             # up without a WSGI restart:
                             'description': UNINDEXED_STRING,
                             # ["clang", "pygmentize"]:
                             'enabled_plugins': UNINDEXED_STRING,
-                            'generated_date': UNINDEXED_STRING
+                            'generated_date': UNINDEXED_STRING,
+                            # How the index was sized:
+                            'sharding': {'type': 'object', 'enabled': False},
+                            # How many lines each LINE_BLOCK doc holds, or 0
+                            # if there are none:
+                            'line_block_size': UNINDEXED_INT
                             # We may someday also need to serialize some plugin
                             # configuration here.
                         }
@@ -114,6 +338,9 @@ def deploy_tree(tree, es, index_name):
     except IndexAlreadyExistsError:
         pass
 
+    mapping = first(es.get_mapping(index_name, FILE).itervalues())
+    meta = mapping['mappings'][FILE].get('_meta', {})
+
     # Insert or update the doc representing this tree. There'll be a little
     # race between this and the alias swap. We'll live.
     es.index(config.es_catalog_index,
@@ -121,9 +348,12 @@ def deploy_tree(tree, es, index_name):
              doc=dict(name=tree.name,
                       format=FORMAT,
                       es_alias=alias,
+                      es_index=index_name,
                       description=tree.description,
                       enabled_plugins=[p.name for p in tree.enabled_plugins],
-                      generated_date=config.generated_date),
+                      generated_date=config.generated_date,
+                      sharding=meta.get('sharding', {}),
+                      line_block_size=meta.get('line_block_size', 0)),
              id='%s/%s' % (FORMAT, tree.name))
 
 
@@ -146,10 +376,219 @@ def swap_alias(alias, index, es):
         es.delete_index(old_index)
 
 
-def index_tree(tree, es, verbose=False):
+def index_tree(tree, es, verbose=False, incremental=False, resume=False,
+               export_folder=None, gzip_export=False):
     """Index a single tree into ES and the filesystem, and return the
     name of the new ES index.
 
+    :arg incremental: Whether to copy the docs of files unchanged since the
+        currently deployed index was built rather than reindexing them. We
+        fall back to indexing everything if we can't tell what changed.
+    :arg resume: Whether to resume an interrupted run from its
+        :class:`Checkpoint`, if it left one, rather than starting over. Also,
+        keep a checkpoint for this run, and, if it fails while indexing
+        files, keep its partial index for a later resumption.
+    :arg export_folder: If given, write the tree's index settings and bulk
+        requests into a folder named after the tree within this one, for
+        ``dxr load`` to send to ES later, rather than making an index. We
+        return None in that case. Can't be combined with ``incremental`` or
+        ``resume``, which need the index.
+    :arg gzip_export: Whether to compress the exported bulk requests
+
+    """
+    print "Starting tree '%s'." % tree.name
+
+    # Note starting time
+    start_time = datetime.now()
+    profile = Profile()
+    stats = []
+
+    config = tree.config
+    skip_indexing = 'index' in config.skip_stages
+    skip_build = 'build' in config.skip_stages
+    skip_cleanup = skip_indexing or skip_build or 'clean' in config.skip_stages
+
+    export = export_folder and Export(join(export_folder, tree.name),
+                                      compress=gzip_export)
+
+    checkpoint = Checkpoint(tree)
+    resumed = None
+    if resume and not skip_indexing:
+        resumed = checkpoint.resume(es, index_metadata(tree, VcsCache(tree)))
+    if not resumed:
+        checkpoint.clear()  # Never resume into an index a later run made.
+    # An interrupted run's build output and temp files are what we resume
+    # from, so leave them be.
+    clean = not resumed
+
+    # Create and/or clear out folders:
+    ensure_folder(tree.object_folder,
+                  clean and tree.source_folder != tree.object_folder)
+    ensure_folder(tree.temp_folder, clean and not skip_cleanup)
+    ensure_folder(tree.log_folder, clean and not skip_cleanup)
+    ensure_folder(join(tree.temp_folder, 'plugins'), clean and not skip_cleanup)
+    for plugin in tree.enabled_plugins:
+        ensure_folder(join(tree.temp_folder, 'plugins', plugin.name),
+                      clean and not skip_cleanup)
+    if export:
+        ensure_folder(export.folder, clean=True)
+
+    index = None
+    try:
+        if resumed:
+            state = resumed
+        else:
+            state = prepare_to_index(tree, es, verbose, incremental, profile,
+                                     export)
+            if resume and not skip_indexing:
+                checkpoint.save(state)
+        index, tree_indexers, files, folders, _ = state
+
+        # Index files:
+        if not skip_indexing:
+            with profile.timed(('stage', 'index')):
+                stats = index_files(tree, tree_indexers, index, es, files,
+                                    folders, checkpoint if resume else None,
+                                    export)
+
+            if export:
+                print "Exported '%s' to %s." % (tree.name, export.folder)
+            else:
+                make_searchable(es, index, config, profile)
+    except Exception as exc:
+        # If anything went wrong, delete the index, because we're not
+        # going to have a way of returning its name if we raise an
+        # exception. The exception is a checkpointed index, which a
+        # resumed run can return.
+        if checkpoint.exists:
+            print >> sys.stderr, ("Indexing '%s' failed. Rerun with --resume "
+                                  "to pick up where it left off." % tree.name)
+        elif index is not None:
+            delete_index_quietly(es, index)
+        raise
+
+    checkpoint.clear()
+    elapsed = datetime.now() - start_time
+    print "Finished '%s' in %s." % (tree.name, elapsed)
+    write_profile(tree, profile, stats, elapsed.total_seconds())
+    if not skip_cleanup:
+        # By default, we remove the temp files, because they're huge.
+        rmtree(tree.temp_folder)
+    return index
+
+
+def make_searchable(es, index, config, profile=None):
+    """Refresh a freshly filled index, merge down its segments if so
+    configured, and give it replicas.
+
+    :arg profile: A :class:`~dxr.profiling.Profile` to charge the time spent
+        to
+
+    """
+    if profile is None:
+        profile = Profile()
+
+    # refresh() times out in prod. Wait until it doesn't. That probably means
+    # things are ready to rock again. Back off between tries so we don't pile
+    # more work onto a struggling cluster.
+    with profile.timed(('stage', 'refresh')):
+        with aligned_progressbar(count(), label='Refreshing index') as bar:
+            for attempt in bar:
+                try:
+                    es.refresh(index=index)
+                except (ConnectionError, Timeout) as exc:
+                    sleep(min(2 ** attempt, 60))
+                else:
+                    break
+
+    # Merge before adding replicas, so they get copies of the merged segments
+    # rather than each doing the merging over again.
+    if config.es_optimize_segments:
+        with profile.timed(('stage', 'optimize')):
+            optimize_index(es, index, config)
+
+    es.update_settings(
+        index,
+        {
+            'settings': {
+                'index': {
+                    'number_of_replicas': 1  # fairly arbitrary
+                }
+            }
+        })
+
+
+def optimize_index(es, index, config):
+    """Merge each shard of an index down to ``es_optimize_segments`` segments,
+    so searches of a fresh index don't pay for a pile of little ones until
+    ES gets around to merging them.
+
+    Optimizing is unthrottled by default, so we throttle the index's merges
+    to ``es_optimize_rate`` MB/s for the duration, to spare the searches of
+    the other indices on the cluster. We wait up to ``es_optimize_timeout``
+    seconds and then go on regardless; the merging carries on, still
+    throttled, in the background.
+
+    """
+    target = config.es_optimize_segments
+
+    def throttle(settings):
+        es.update_settings(index, {'settings': {'index': settings}})
+
+    throttle({'store.throttle.type': 'merge',
+              'store.throttle.max_bytes_per_sec':
+                  '%smb' % config.es_optimize_rate})
+    es.send_request('POST',
+                    [index, '_optimize'],
+                    query_params={'max_num_segments': target,
+                                  'wait_for_merge': 'false'})
+    deadline = time() + config.es_optimize_timeout
+
+    def unmerged_shards():
+        return shards_over(es.send_request('GET', [index, '_segments']),
+                           index,
+                           target)
+
+    shards, unmerged = unmerged_shards()
+    with aligned_progressbar(length=shards, label='Merging segments') as bar:
+        bar.update(shards - unmerged)
+        while unmerged and time() < deadline:
+            sleep(5)
+            _, still_unmerged = unmerged_shards()
+            bar.update(unmerged - still_unmerged)
+            unmerged = still_unmerged
+    if unmerged:
+        # Leave the throttle on for the merges still going.
+        print ('Gave up waiting for %s shards to merge down to %s segments. '
+               'They will carry on in the background.' % (unmerged, target))
+    else:
+        # Go back to the node-wide throttling, if any.
+        throttle({'store.throttle.type': 'node'})
+
+
+def shards_over(segments, index, max_segments):
+    """Return (number of primary shards, number of them which have more than
+    ``max_segments`` searchable segments), given the response of a
+    ``_segments`` request for an index."""
+    primaries = [copy for copies in
+                 segments['indices'][index]['shards'].itervalues()
+                 for copy in copies if copy['routing']['primary']]
+    return len(primaries), sum(1 for copy in primaries if
+                               copy['num_search_segments'] > max_segments)
+
+
+def prepare_to_index(tree, es, verbose, incremental, profile, export=None):
+    """Do everything that comes before indexing files: make the index, run
+    the build and its plugin hooks, and work out what to index.
+
+    Return a :class:`ResumeState` of what's left: the index name, tree
+    indexers, files and folders to index, and the tree's
+    :func:`index_metadata()`. The index name is None if we're skipping indexing or exporting, in which case
+    the index settings go into the :class:`Export` instead. If something goes
+    wrong after the index is made, delete it.
+
+    See :func:`index_tree()` for the args.
+
     """
     def new_pool():
         return ProcessPoolExecutor(max_workers=tree.workers)
@@ -164,139 +603,519 @@ def index_tree(tree, es, verbose=False):
 
         """
         if not tree.workers:
-            return [save_scribbles(ti, method_name) for ti in tree_indexers]
+            results = [profiled_scribbles(ti, method_name)
+                       for ti in tree_indexers]
         else:
-            futures = [pool.submit(full_traceback, save_scribbles, ti, method_name)
+            futures = [pool.submit(full_traceback, profiled_scribbles, ti, method_name)
                        for ti in tree_indexers]
-            return [future.result() for future in
-                    show_progress(futures, 'Running %s' % method_name)]
-
-    def delete_index_quietly(es, index):
-        """Delete an index, and ignore any error.
-
-        This cannot be done inline in the except clause below, because, even
-        if we catch this exception, it spoils the exception info in that
-        scope, making the bare ``raise`` raise the not-found error rather than
-        whatever went wrong earlier.
-
-        """
-        try:
-            es.delete_index(index)
-        except Exception:
-            pass
-
-    print "Starting tree '%s'." % tree.name
-
-    # Note starting time
-    start_time = datetime.now()
+            results = [future.result() for future in
+                       show_progress(futures, 'Running %s' % method_name)]
+        for _, totals in results:
+            profile.merge(totals)
+        return [ti for ti, _ in results]
 
     config = tree.config
     skip_indexing = 'index' in config.skip_stages
     skip_build = 'build' in config.skip_stages
-    skip_cleanup = skip_indexing or skip_build or 'clean' in config.skip_stages
-
-    # Create and/or clear out folders:
-    ensure_folder(tree.object_folder, tree.source_folder != tree.object_folder)
-    ensure_folder(tree.temp_folder, not skip_cleanup)
-    ensure_folder(tree.log_folder, not skip_cleanup)
-    ensure_folder(join(tree.temp_folder, 'plugins'), not skip_cleanup)
-    for plugin in tree.enabled_plugins:
-        ensure_folder(join(tree.temp_folder, 'plugins', plugin.name),
-                      not skip_cleanup)
 
-    vcs_cache = VcsCache(tree)
+    # Walk the source folder up front to find repositories and plan the
+    # index. The files to index come from this walk only if there's no build:
+    with profile.timed(('stage', 'walk')):
+        manifest = walk_tree(tree)
+    vcs_cache = VcsCache(tree, manifest.repos)
     tree_indexers = [p.tree_to_index(p.name, tree, vcs_cache) for p in
                      tree.enabled_plugins if p.tree_to_index]
+    files = []
+    index = None
     try:
         if not skip_indexing:
-            # Substitute the format, tree name, and uuid into the index identifier.
-            index = tree.es_index.format(format=FORMAT,
-                                         tree=tree.name,
-                                         unique=uuid1())
-            create_index_and_wait(
-                es,
-                index,
-                settings={
-                    'settings': {
-                        'index': {
-                            'number_of_shards': tree.es_shards,  # Fewer should be faster, assuming enough RAM.
-                            'number_of_replicas': 0  # for speed
-                        },
-                        # Default analyzers and mappings are in the core plugin.
-                        'analysis': reduce(
-                                deep_update,
-                                (p.analyzers for p in tree.enabled_plugins),
-                                {}),
-
-                        # DXR indices are immutable once built. Turn the
-                        # refresh interval down to keep the segment count low
-                        # while indexing. It will make for less merging later.
-                        # We could also simply call "optimize" after we're
-                        # done indexing, but it is unthrottled; we'd have to
-                        # use shard allocation to do the indexing on one box
-                        # and then move it elsewhere for actual use.
-                        'refresh_interval':
-                            '%is' % config.es_refresh_interval
-                    },
-                    'mappings': reduce(deep_update,
-                                       (p.mappings for p in
-                                            tree.enabled_plugins),
-                                       {})
-                })
+            settings = index_settings(tree, vcs_cache, manifest.files)
+            if export:
+                export.save_settings(settings)
+            else:
+                index = new_index_name(tree)
+                with profile.timed(('stage', 'create_index')):
+                    create_index_and_wait(es, index, settings=settings)
         else:
-            index = None
             print "Skipping indexing (due to 'index' in 'skip_stages')"
 
         # Run pre-build hooks:
-        with new_pool() as pool:
-            tree_indexers = farm_out('pre_build')
-            # Tear down pool to let the build process use more RAM.
+        with profile.timed(('stage', 'pre_build')):
+            with new_pool() as pool:
+                tree_indexers = farm_out('pre_build')
+                # Tear down pool to let the build process use more RAM.
 
         if not skip_build:
             # Set up env vars, and build:
-            build_tree(tree, tree_indexers, verbose)
+            with profile.timed(('stage', 'build')):
+                build_tree(tree, tree_indexers, verbose)
+            # The build may have scribbled new files into the source folder,
+            # whether into an objdir under it or right alongside the code, and
+            # it may have touched existing ones, so look again:
+            with profile.timed(('stage', 'walk')):
+                manifest = walk_tree(tree, find_repos=False)
         else:
             print "Skipping rebuild (due to 'build' in 'skip_stages')"
 
-        # Post-build, and index files:
+        # Post-build, and work out what to index:
         if not skip_indexing:
+            save_manifest(tree, manifest)
             with new_pool() as pool:
-                tree_indexers = farm_out('post_build')
-                index_files(tree, tree_indexers, index, pool, es)
-
-            # refresh() times out in prod. Wait until it doesn't. That
-            # probably means things are ready to rock again.
-            with aligned_progressbar(repeat(None), label='Refreshing index') as bar:
-                for _ in bar:
-                    try:
-                        es.refresh(index=index)
-                    except (ConnectionError, Timeout) as exc:
-                        pass
-                    else:
-                        break
-
-            es.update_settings(
-                index,
-                {
-                    'settings': {
-                        'index': {
-                            'number_of_replicas': 1  # fairly arbitrary
-                        }
-                    }
-                })
+                with profile.timed(('stage', 'post_build')):
+                    tree_indexers = farm_out('post_build')
+            files = manifest.files
+            if incremental:
+                with profile.timed(('stage', 'copy_unchanged')):
+                    plan = plan_incremental_index(tree, es, vcs_cache, files)
+                    if plan:
+                        old_index, unchanged_paths, files = plan
+                        copy_unchanged_docs(es, old_index, index,
+                                            unchanged_paths)
     except Exception as exc:
-        # If anything went wrong, delete the index, because we're not
-        # going to have a way of returning its name if we raise an
-        # exception.
-        if not skip_indexing:
+        if index is not None:
             delete_index_quietly(es, index)
         raise
+    return ResumeState(index, tree_indexers, files, manifest.folders,
+                       index_metadata(tree, vcs_cache))
+
+
+def line_block_mapping(line_mapping):
+    """Return the mapping for LINE_BLOCK docs, given that for LINE docs.
+
+    Blocks hold the same file-wide needles and content as lines, so they're
+    mapped the same way. Their contents are arrays of lines, so we put a wide gap between
+    the positions of one line's trigrams and the next's, lest a phrase match
+    span lines. Their refs, regions, and annotations carry the numbers of
+    their lines as well.
+
+    """
+    mapping = deepcopy(line_mapping)
+    for field in mapping['properties']['content']['fields'].itervalues():
+        field['position_offset_gap'] = 100
+    for key in BLOCKED_LINE_ARRAYS:
+        mapping['properties'][key].setdefault(
+            'properties', {})['number'] = UNINDEXED_INT
+    return mapping
 
-    print "Finished '%s' in %s." % (tree.name, datetime.now() - start_time)
-    if not skip_cleanup:
-        # By default, we remove the temp files, because they're huge.
-        rmtree(tree.temp_folder)
-    return index
+
+def new_index_name(tree):
+    """Return a fresh, unique name for an index of a tree."""
+    # Substitute the format, tree name, and uuid into the index identifier.
+    return tree.es_index.format(format=FORMAT, tree=tree.name, unique=uuid1())
+
+
+def index_settings(tree, vcs_cache, files):
+    """Return the settings and mappings to create a tree's index with.
+
+    :arg vcs_cache: The :class:`~dxr.vcs.VcsCache` of the tree, whose
+        revisions go into the mappings' metadata
+    :arg files: The :class:`ManifestFile` of each file in the tree, from
+        which to size the index
+
+    """
+    config = tree.config
+    sharding = plan_shards(tree, files)
+    print ('Using %(shards)s shards for an index of about %(estimated_docs)s '
+           'docs and %(estimated_bytes)s bytes.' % sharding)
+    mappings = reduce(deep_update,
+                      (p.mappings for p in tree.enabled_plugins),
+                      {})
+    # Remember what we indexed so a later incremental build can work out
+    # what has changed since, and how we sized the index:
+    mappings.setdefault(FILE, {})['_meta'] = dict(
+        index_metadata(tree, vcs_cache),
+        sharding=sharding)
+    if tree.line_block_size:
+        mappings[LINE_BLOCK] = line_block_mapping(mappings[LINE])
+    return {
+        'settings': {
+            'index': {
+                'number_of_shards': sharding['shards'],  # Fewer should be faster, assuming enough RAM.
+                'number_of_replicas': 0  # for speed
+            },
+            # Default analyzers and mappings are in the core plugin.
+            'analysis': reduce(
+                    deep_update,
+                    (p.analyzers for p in tree.enabled_plugins),
+                    {}),
+
+            # DXR indices are immutable once built. Turn the refresh interval
+            # down to keep the segment count low while indexing. It will make
+            # for less merging later. If es_optimize_segments is set, we
+            # merge down the rest once we're done, throttled.
+            'refresh_interval': '%is' % config.es_refresh_interval
+        },
+        'mappings': mappings
+    }
+
+
+def delete_index_quietly(es, index):
+    """Delete an index, and ignore any error.
+
+    This cannot be done inline in an except clause, because, even if we catch
+    this exception, it spoils the exception info in that scope, making the
+    bare ``raise`` raise the not-found error rather than whatever went wrong
+    earlier.
+
+    """
+    try:
+        es.delete_index(index)
+    except Exception:
+        pass
+
+
+#: What a resumed run needs to get on with indexing files: the index name, the
+#: tree indexers as post_build left them, a list of :class:`ManifestFile` of
+#: the files to index, a list of the folders to index, and the
+#: :func:`index_metadata()` of the tree they came from
+ResumeState = namedtuple('ResumeState',
+                         ['index', 'tree_indexers', 'files', 'folders',
+                          'metadata'])
+
+
+class Checkpoint(object):
+    """A record, in a tree's temp folder, of how far a resumable indexing run
+    has gotten
+
+    Once the build and post_build are done, we :meth:`save()` a
+    :class:`ResumeState`. From then on, we journal each chunk of files as it's
+    handed out and as it finishes, and the folders once they're done. If the
+    run dies, :meth:`resume()` picks it back up, reindexing only what never
+    finished.
+
+    """
+    #: How many paths to clear out of the index per delete-by-query request
+    PATHS_PER_DELETE = 500
+
+    def __init__(self, tree):
+        self.tree = tree
+        self._state_path = join(tree.temp_folder, 'checkpoint.pickle')
+        self._journal_path = join(tree.temp_folder, 'checkpoint-journal.pickle')
+        self._journal = None
+        self._lock = Lock()  # The folder-indexing thread records too.
+
+    @property
+    def exists(self):
+        """Return whether there's a saved state to resume from."""
+        return exists(self._state_path)
+
+    def save(self, state):
+        """Save the :class:`ResumeState` of a run, and start a fresh journal
+        of its progress."""
+        temp_path = self._state_path + '.new'
+        with open(temp_path, 'wb') as file:
+            cPickle.dump(state, file, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, self._state_path)
+        self._open_journal('wb')
+
+    def record(self, event, paths=()):
+        """Journal some progress.
+
+        :arg event: 'started' or 'finished' for a chunk of files, or
+            'folders' when the folders are all indexed
+        :arg paths: The bytestring absolute paths of the chunk's files
+
+        """
+        with self._lock:
+            cPickle.dump((event, list(paths)),
+                         self._journal,
+                         cPickle.HIGHEST_PROTOCOL)
+            # Make it to the OS, at least, in case we're killed:
+            self._journal.flush()
+
+    def resume(self, es, metadata):
+        """Return the :class:`ResumeState` of an interrupted run, pared down
+        to the files and folders it didn't finish, or None if there is no
+        usable one. Say which.
+
+        Docs left behind by chunks that were cut off partway are deleted
+        first, since bulk-indexed docs have no IDs to overwrite.
+
+        :arg metadata: The :func:`index_metadata()` of the tree as it is now.
+            If the source has moved to new revisions or the options that
+            shape the index have changed since the interrupted run, its file
+            list and post_build data no longer match, so we start over.
+
+        """
+        def start_over(reason):
+            print 'Not resuming, since %s.' % reason
+
+        try:
+            with open(self._state_path, 'rb') as file:
+                state = cPickle.load(file)
+        except IOError as exc:
+            if exc.errno != ENOENT:
+                raise
+            return start_over('there is no interrupted run to resume')
+        except Exception:  # Anything from old code to a truncated file
+            return start_over('its checkpoint is unreadable')
+        if ([ti.plugin_name for ti in state.tree_indexers] !=
+                [p.name for p in self.tree.enabled_plugins if p.tree_to_index]):
+            return start_over('the enabled plugins have changed')
+        for key, what in [('revisions', 'the source has been updated'),
+                          ('plugin_options', 'the plugin options have changed'),
+                          ('ignore_paths', 'ignore_patterns has changed'),
+                          ('ignore_filenames', 'ignore_patterns has changed'),
+                          ('line_block_size', 'line_block_size has changed')]:
+            if state.metadata.get(key) != metadata.get(key):
+                return start_over(what)
+        try:
+            es.refresh(index=state.index)
+        except ElasticHttpNotFoundError:
+            return start_over('its index, %s, is gone' % state.index)
+
+        started, finished, folders_done = set(), set(), False
+        for event, paths in self._journal_entries():
+            if event == 'started':
+                started.update(paths)
+            elif event == 'finished':
+                finished.update(paths)
+            elif event == 'folders':
+                folders_done = True
+        interrupted = [unicode_for_display(relpath(path,
+                                                   self.tree.source_folder))
+                       for path in started - finished]
+        for i in xrange(0, len(interrupted), self.PATHS_PER_DELETE):
+            es.delete_by_query(
+                state.index,
+                [FILE, LINE, LINE_BLOCK],
+                {'filtered': {
+                    'query': {'match_all': {}},
+                    'filter': {'terms': {
+                        'path': interrupted[i:i + self.PATHS_PER_DELETE]}}}})
+        if not folders_done:
+            es.delete_by_query(
+                state.index,
+                FILE,
+                {'filtered': {
+                    'query': {'match_all': {}},
+                    'filter': {'term': {'is_folder': True}}}})
+
+        files = [f for f in state.files if f.path not in finished]
+        print 'Resuming %s: %s files of %s left to index.' % (
+            state.index, len(files), len(state.files))
+        self._open_journal('ab')
+        return state._replace(files=files,
+                              folders=[] if folders_done else state.folders)
+
+    def clear(self):
+        """Forget any saved state and progress."""
+        if self._journal:
+            self._journal.close()
+            self._journal = None
+        for path in [self._state_path, self._journal_path]:
+            try:
+                os.remove(path)
+            except OSError as exc:
+                if exc.errno != ENOENT:
+                    raise
+
+    def _open_journal(self, mode):
+        if self._journal:
+            self._journal.close()
+        self._journal = open(self._journal_path, mode)
+
+    def _journal_entries(self):
+        """Yield the (event, paths) records of the journal, stopping short of
+        any last one that was only partly written."""
+        try:
+            file = open(self._journal_path, 'rb')
+        except IOError as exc:
+            if exc.errno != ENOENT:
+                raise
+            return
+        with file:
+            while True:
+                try:
+                    yield cPickle.load(file)
+                except (EOFError, cPickle.UnpicklingError, ValueError,
+                        IndexError, KeyError):
+                    return
+
+
+# Rough ratios for guessing the size of an index from the size of its source.
+# Each line gets a doc, and each doc holds its text trigram-indexed, along with
+# refs, regions, and needles:
+SOURCE_BYTES_PER_LINE = 32
+INDEX_BYTES_PER_SOURCE_BYTE = 8
+
+
+def plan_shards(tree, files):
+    """Return a dict of the number of shards to give a tree's index, along
+    with the doc count and size in bytes we estimate for it.
+
+    If the tree's ``es_shards`` is "auto", we pick enough shards to hold the
+    estimated bytes at ``es_shard_size`` MB apiece, so small trees don't fan
+    each query out to a pile of tiny shards and big ones still spread out
+    across the cluster.
+
+    :arg files: The :class:`ManifestFile` of each file in the tree
+
+    """
+    source_bytes = sum(f.size for f in files)
+    estimated_bytes = source_bytes * INDEX_BYTES_PER_SOURCE_BYTE
+    if tree.es_shards == 'auto':
+        shard_bytes = tree.config.es_shard_size * 1024 * 1024
+        shards = max(1, -(-estimated_bytes // shard_bytes))  # ceiling
+    else:
+        shards = tree.es_shards
+    return {'shards': shards,
+            'estimated_docs': len(files) + source_bytes // SOURCE_BYTES_PER_LINE,
+            'estimated_bytes': estimated_bytes}
+
+
+def index_metadata(tree, vcs_cache):
+    """Return the facts about a tree which we stash in the ``_meta`` of its
+    FILE mapping so a later incremental build can compare against them.
+
+    """
+    return {'enabled_plugins': [p.name for p in tree.enabled_plugins],
+            'plugin_options': plugin_options(tree),
+            'ignore_paths': tree.ignore_paths,
+            'ignore_filenames': tree.ignore_filenames,
+            'line_block_size': tree.line_block_size,
+            # {VCS root: revision}:
+            'revisions': dict((root, vcs.revision) for root, vcs in
+                              vcs_cache.repos.iteritems())}
+
+
+def plugin_options(tree):
+    """Return {plugin name: its options for a tree}, in a form that survives
+    a round trip through JSON, so we can tell whether they've changed.
+
+    """
+    def jsonable(value):
+        if isinstance(value, dict):
+            return dict((k, jsonable(v)) for k, v in value.iteritems())
+        if isinstance(value, (list, tuple)):
+            return [jsonable(v) for v in value]
+        if value is None or isinstance(value, (basestring, bool, int, long,
+                                               float)):
+            return value
+        # Compiled regexes, mostly:
+        return getattr(value, 'pattern', repr(value))
+
+    return dict((p.name, jsonable(tree._section.get(p.name, {})))
+                for p in tree.enabled_plugins)
+
+
+def plan_incremental_index(tree, es, vcs_cache, files):
+    """Work out which files have to be reindexed and which can be copied
+    forward from the currently deployed index of a tree.
+
+    Return (name of the deployed index, set of unicode paths of unchanged
+    files relative to the source folder, list of :class:`ManifestFile` of
+    files to index). If we can't tell what changed, print why, and return
+    None.
+
+    Untracked files and symlinks are always reindexed, since we have no record
+    of their old contents. Folders are always reindexed, since they're cheap.
+    If the plugins, their options, or the ignore patterns differ from those
+    of the deployed index, we start over, since files the VCS considers
+    unchanged might then be newly indexed or indexed differently.
+
+    :arg files: The :class:`ManifestFile` of every file in the tree
+
+    """
+    def give_up(reason):
+        print 'Indexing every file, since %s.' % reason
+
+    alias = tree.config.es_alias.format(format=FORMAT, tree=tree.name)
+    try:
+        old_index = first(es.aliases(alias))
+    except ElasticHttpNotFoundError:
+        old_index = None
+    if not old_index:
+        return give_up('there is no deployed index to start from')
+
+    mapping = first(es.get_mapping(old_index, FILE).itervalues())
+    meta = mapping['mappings'][FILE].get('_meta', {})
+    if meta.get('enabled_plugins') != [p.name for p in tree.enabled_plugins]:
+        return give_up('the enabled plugins differ from those of %s' %
+                       old_index)
+    if meta.get('plugin_options') != plugin_options(tree):
+        return give_up('the plugin options differ from those of %s' %
+                       old_index)
+    if (meta.get('ignore_paths') != tree.ignore_paths or
+            meta.get('ignore_filenames') != tree.ignore_filenames):
+        return give_up('ignore_patterns differs from that of %s' % old_index)
+    if meta.get('line_block_size', 0) != tree.line_block_size:
+        return give_up('line_block_size differs from that of %s' % old_index)
+
+    old_revisions = meta.get('revisions', {})
+    changed = set()
+    for root, vcs in vcs_cache.repos.iteritems():
+        if root not in old_revisions:
+            return give_up('%s was not a known repository when %s was built' %
+                           (root, old_index))
+        try:
+            changed_files = vcs.changed_files(old_revisions[root])
+        except NotImplementedError:
+            return give_up("%s can't list changed files" % vcs.get_vcs_name())
+        except subprocess.CalledProcessError:
+            return give_up("%s couldn't compare %s against revision %s" %
+                           (vcs.get_vcs_name(), root, old_revisions[root]))
+        if isinstance(root, unicode):
+            root = root.encode('utf8')
+        changed.update(join(root, path) for path in changed_files)
+
+    unchanged_paths, changed_files = set(), []
+    for file in files:
+        rel_path = relpath(file.path, tree.source_folder)
+        if (file.path in changed or file.is_link or
+                not vcs_cache.vcs_for_path(rel_path)):
+            changed_files.append(file)
+        else:
+            unchanged_paths.add(unicode_for_display(rel_path))
+    print 'Reindexing %s files; copying %s unchanged ones from %s.' % (
+        len(changed_files), len(unchanged_paths), old_index)
+    return old_index, unchanged_paths, changed_files
+
+
+def copy_unchanged_docs(es, old_index, new_index, unchanged_paths):
+    """Copy the FILE, LINE, and LINE_BLOCK docs of unchanged files from one
+    index to another, along with the REF docs their lines point to.
+
+    ES 1.x has no server-side reindexing, so we scroll through the old index
+    and bulk the docs we want back in. Folder docs are left behind;
+    :func:`index_folders()` makes fresh ones. REF docs aren't tied to a file,
+    so we note which ones the copied lines point to and then scroll through
+    the REF docs for those. The payloads of only changed or deleted files
+    don't make it across, so they don't pile up from one run to the next.
+
+    :arg unchanged_paths: A set of unicode paths, relative to the source
+        folder, whose docs should be copied
+
+    """
+    ref_ids = set()
+
+    def docs():
+        """Yield bulk actions for the docs that belong to unchanged files,
+        then for the REF docs they point to."""
+        hits = scroll_hits(es,
+                           old_index,
+                           doc_type=[FILE, LINE, LINE_BLOCK],
+                           query={'filtered': {
+                                      'query': {'match_all': {}},
+                                      'filter': {
+                                          'not': {'term': {'is_folder': True}}
+                                      }
+                                  }})
+        for hit in hits:
+            source = hit['_source']
+            if first(source.get('path') or []) in unchanged_paths:
+                ref_ids.update(ref['payload'] for ref in
+                               source.get('refs', ()))
+                yield es.index_op(source, doc_type=hit['_type'])
+        for hit in scroll_hits(es, old_index, doc_type=REF):
+            if hit['_id'] in ref_ids:
+                yield es.index_op(hit['_source'], doc_type=REF, id=hit['_id'])
+
+    with aligned_progressbar(docs(),
+                             show_eta=False,
+                             label='Copying unchanged') as bar:
+        with BulkSender(es, new_index, threads=1) as sender:
+            sender.add_all(bar)
 
 
 def aligned_progressbar(*args, **kwargs):
@@ -316,6 +1135,59 @@ def show_progress(futures, message):
             yield future
 
 
+def profiled_scribbles(obj, method):
+    """Do :func:`save_scribbles()`, and return (obj, :attr:`Profile.totals`
+    of the call), charged to the plugin the tree indexer belongs to.
+
+    This is meant to run in a remote process.
+
+    """
+    profile = Profile()
+    with profile.timed(('plugin', obj.plugin_name, method)):
+        obj = save_scribbles(obj, method)
+    return obj, profile.totals
+
+
+def write_profile(tree, profile, stats, seconds):
+    """Write a JSON summary of where the time went while indexing a tree to
+    ``profile.json`` in its log folder.
+
+    The ``walk``, ``create_index``, ``pre_build``, ``build``,
+    ``post_build``, ``copy_unchanged``, ``index``, and ``refresh`` stages are
+    timed in the master process. Everything else--the per-file stages, plugin
+    methods, and ES requests--is summed across workers, with time spent in
+    nested sections counted only toward the innermost. Alongside are
+    per-worker utilization and the slowest files to index, handy for spotting
+    pathological inputs.
+
+    :arg profile: The :class:`~dxr.profiling.Profile` of the master process
+    :arg stats: The :class:`ChunkStats` of every chunk indexed
+
+    """
+    for chunk in stats:
+        profile.merge(chunk.totals)
+    workers = {}
+    for pid, worker_stats in bucket(stats, lambda s: s.pid).iteritems():
+        workers[str(pid)] = {
+            'chunks': len(worker_stats),
+            'files': sum(s.files for s in worker_stats),
+            'busy_seconds': round(sum(s.seconds for s in worker_stats), 3)}
+    slowest = nlargest(SLOWEST_FILES,
+                       chain.from_iterable(s.slowest for s in stats))
+    path = join(tree.log_folder, 'profile.json')
+    write_report(
+        path,
+        profile.totals,
+        tree=tree.name,
+        wall_seconds=round(seconds, 3),
+        workers=workers,
+        slowest_files=[
+            {'path': unicode_for_display(relpath(p, tree.source_folder)),
+             'seconds': round(file_seconds, 3)}
+            for file_seconds, p in slowest])
+    print 'Wrote profile to %s.' % path
+
+
 def save_scribbles(obj, method):
     """Call obj.method(), then return obj and the result so the master process
     can see anything method() scribbled on it.
@@ -339,20 +1211,52 @@ def ensure_folder(folder, clean=False):
         makedirs(folder)
 
 
-def _unignored_folders(folders, source_path, ignore_filenames, ignore_paths):
-    """Yield the folders from ``folders`` which are not ignored by the given
-    patterns and paths.
+class IgnoreMatcher(object):
+    """A decider of which files and folders of a source tree to ignore
 
-    :arg source_path: Relative path to the source directory
-    :arg ignore_filenames: Filename-based globs to be ignored
-    :arg ignore_paths: Path-based globs to be ignored
+    Each set of globs is compiled into a single regex, so deciding costs one
+    match per name rather than one ``fnmatchcase()`` per pattern.
 
     """
-    for folder in folders:
-        if not any(fnmatchcase(folder, p) for p in ignore_filenames):
-            folder_path = '/' + join(source_path, folder).replace(os.sep, '/') + '/'
-            if not any(fnmatchcase(folder_path, p) for p in ignore_paths):
-                yield folder
+    def __init__(self, ignore_filenames, ignore_paths):
+        """
+        :arg ignore_filenames: Globs matched against bare file and folder
+            names
+        :arg ignore_paths: Globs matched against paths relative to the source
+            folder, with a leading slash and, for folders, a trailing one
+
+        """
+        self._filenames = self._compile(ignore_filenames)
+        self._paths = self._compile(ignore_paths)
+
+    @staticmethod
+    def _compile(globs):
+        """Return a compiled regex which matches anything any of the globs
+        does, or None if there are no globs."""
+        if not globs:
+            return None
+        return re.compile(r'(?ms)(?:%s)\Z' %
+                          '|'.join(glob_to_regex(g) for g in globs))
+
+    def is_ignored(self, name, rel_path, is_folder=False):
+        """Return whether a file or folder should be ignored.
+
+        :arg name: The file or folder's name
+        :arg rel_path: Its path relative to the source folder
+
+        """
+        if self._filenames and self._filenames.match(name):
+            return True
+        if self._paths:
+            path = '/' + rel_path.replace(os.sep, '/')
+            if is_folder:
+                path += '/'
+            return bool(self._paths.match(path))
+        return False
+
+
+# Files at least this big get mmapped rather than read:
+MMAP_THRESHOLD = 256 * 1024
 
 
 def unicode_contents(path, encoding_guess):  # TODO: Make accessible to TreeToIndex.post_build.
@@ -364,17 +1268,23 @@ def unicode_contents(path, encoding_guess):  # TODO: Make accessible to TreeToIn
         it seems to be text
 
     """
-    # Read the binary contents of the file.
+    # Read each file only once. Big ones are mapped rather than read, so they
+    # get decoded straight out of the page cache without an extra copy.
     with open(path, 'rb') as source_file:
-        initial_portion = source_file.read(4096)
-        if not is_binary_string(initial_portion):
-            # Move the cursor back to the start of the file.
-            source_file.seek(0)
-            decoded, contents = decode_data(source_file.read(),
+        size = os.fstat(source_file.fileno()).st_size
+        if size < MMAP_THRESHOLD:
+            data = source_file.read()
+        else:
+            data = mmap(source_file.fileno(), 0, access=ACCESS_READ)
+        try:
+            decoded, contents = decode_data(data,
                                             encoding_guess,
-                                            can_be_binary=False)
-            if decoded:
-                return contents
+                                            sample_size=4096)
+        finally:
+            if size >= MMAP_THRESHOLD:
+                data.close()
+    if decoded:
+        return contents
 
 
 def unignored(folder, ignore_paths, ignore_filenames, want_folders=False):
@@ -386,6 +1296,36 @@ def unignored(folder, ignore_paths, ignore_filenames, want_folders=False):
     :arg want_folders: If falsey, return files. If truthy, return folders
         instead.
 
+    """
+    want_folders = bool(want_folders)
+    return (path for path, is_folder in
+            unignored_entries(folder, ignore_paths, ignore_filenames)
+            if is_folder == want_folders)
+
+
+def unignored_entries(folder, ignore_paths, ignore_filenames):
+    """Yield (bytestring absolute path, is_folder) for each unignored file and
+    folder in a source tree, walking it only once.
+
+    """
+    for root, rel_path, folders, files in _walk_unignored(
+            folder, IgnoreMatcher(ignore_filenames, ignore_paths)):
+        for f in files:
+            yield join(root, f), False
+        for f in folders:
+            yield join(root, f), True
+
+
+def _walk_unignored(folder, matcher, visit=None):
+    """Walk a source tree, skipping what ``matcher`` ignores.
+
+    Yield (bytestring absolute path of a folder, path relative to ``folder``,
+    list of unignored subfolder names, list of unignored file names).
+
+    :arg visit: A callable to pass each folder's absolute path and full list
+        of subfolder names before any are pruned. It may remove names from the
+        list to keep the walk out of them.
+
     """
     # On Linux (which is what we guarantee support for), paths are bags of
     # bytes; they may not even be representable as Unicode code points.
@@ -395,37 +1335,238 @@ def unignored(folder, ignore_paths, ignore_filenames, want_folders=False):
     def raise_(exc):
         raise exc
 
-    # TODO: Expose a lot of pieces of this as routines plugins can call.
     for root, folders, files in os.walk(folder, topdown=True, onerror=raise_):
         # Find relative path
         rel_path = relpath(root, folder)
         if rel_path == '.':
             rel_path = ''
+        if visit:
+            visit(root, folders)
 
-        if not want_folders:
-            for f in files:
-                # Ignore file if it matches an ignore pattern
-                if any(fnmatchcase(f, e) for e in ignore_filenames):
-                    continue  # Ignore the file.
+        files = [f for f in files if
+                 not matcher.is_ignored(f, join(rel_path, f))]
+        # Exclude folders that match an ignore pattern.
+        # os.walk listens to any changes we make in `folders`.
+        folders[:] = [f for f in folders if
+                      not matcher.is_ignored(f, join(rel_path, f),
+                                             is_folder=True)]
+        yield root, rel_path, folders, files
 
-                path = join(rel_path, f)
 
-                # Ignore file if its path (relative to the root) matches an
-                # ignore path.
-                if any(fnmatchcase("/" + path.replace(os.sep, "/"), e) for e in ignore_paths):
-                    continue  # Ignore the file.
+#: A file found by :func:`walk_tree()`, with a bytestring absolute path and
+#: the results of lstat-ing it
+ManifestFile = namedtuple('ManifestFile', ['path', 'size', 'mtime', 'is_link'])
 
-                yield join(root, f)
+#: The unignored contents of a source tree: lists of :class:`ManifestFile`
+#: and of bytestring absolute folder paths, plus a mapping of {root: Vcs
+#: object} for the repositories within (empty if not asked for)
+Manifest = namedtuple('Manifest', ['files', 'folders', 'repos'])
 
-        # Exclude folders that match an ignore pattern.
-        # os.walk listens to any changes we make in `folders`.
-        folders[:] = _unignored_folders(
-            folders, rel_path, ignore_filenames, ignore_paths)
-        if want_folders:
-            for f in folders:
-                yield join(root, f)
 
-def index_file(tree, tree_indexers, path, es, index):
+def walk_tree(tree, find_repos=True):
+    """Walk a tree's source folder once, and return a :class:`Manifest` of
+    what's in it.
+
+    This is the one trip over the (possibly networked) filesystem that
+    everything from VCS discovery to the chunking of files for indexing
+    shares.
+
+    :arg find_repos: Whether to look for VCS repositories along the way.
+        Each walked folder's subfolders are checked for VCS metadata before
+        ignored ones are pruned, so a repo is found even if its metadata
+        folder (like .hg) is ignored. Ignored folders are never walked,
+        though, so repos within them are not found.
+
+    """
+    files, folders, repos = [], [], {}
+    if find_repos:
+        def visit(root, subfolders):
+            for vcs in claim_repos(root, subfolders, tree):
+                repos[vcs.root] = vcs
+    else:
+        visit = None
+    matcher = IgnoreMatcher(tree.ignore_filenames, tree.ignore_paths)
+    for root, rel_path, subfolders, names in _walk_unignored(
+            tree.source_folder, matcher, visit):
+        for name in names:
+            path = join(root, name)
+            try:
+                status = os.lstat(path)
+            except OSError:  # vanished from under us; index_file will say so
+                files.append(ManifestFile(path, 0, 0, False))
+            else:
+                files.append(ManifestFile(path,
+                                          status.st_size,
+                                          status.st_mtime,
+                                          S_ISLNK(status.st_mode)))
+        folders.extend(join(root, f) for f in subfolders)
+    return Manifest(files, folders, repos)
+
+
+def _manifest_path(tree):
+    return join(tree.temp_folder, 'manifest.pickle')
+
+
+def save_manifest(tree, manifest):
+    """Stash the files and folders of a manifest in the tree's temp folder,
+    where plugins can get at them with :func:`load_manifest()`."""
+    with open(_manifest_path(tree), 'wb') as file:
+        cPickle.dump(manifest._replace(repos={}),
+                     file,
+                     cPickle.HIGHEST_PROTOCOL)
+
+
+def load_manifest(tree):
+    """Return the :class:`Manifest` of unignored files and folders saved
+    during the indexing of a tree, or, if there isn't one, walk the tree
+    afresh.
+
+    Its ``repos`` is always empty.
+
+    """
+    try:
+        with open(_manifest_path(tree), 'rb') as file:
+            return cPickle.load(file)
+    except IOError as exc:
+        if exc.errno != ENOENT:
+            raise
+        return walk_tree(tree, find_repos=False)
+
+
+_code_digests = {}
+
+
+def code_digest(module_name):
+    """Return a hex digest of the source code of a module, memoized for the
+    life of the process.
+
+    Anything within the dxr package gets the digest of the whole package,
+    since per-line output also depends on shared machinery like tag
+    balancing.
+
+    """
+    if module_name == 'dxr' or module_name.startswith('dxr.'):
+        module_name = 'dxr'
+    if module_name not in _code_digests:
+        module_path = sys.modules[module_name].__file__
+        if module_name == 'dxr':
+            package_folder = dirname(module_path)
+            paths = sorted(join(folder, f)
+                           for folder, _, files in os.walk(package_folder)
+                           for f in files if f.endswith('.py'))
+        else:
+            # Point at source rather than bytecode:
+            paths = [module_path[:-1] if module_path.endswith('.pyc')
+                     else module_path]
+        hasher = sha1()
+        for path in paths:
+            with open(path, 'rb') as file:
+                hasher.update(file.read())
+        _code_digests[module_name] = hasher.hexdigest()
+    return _code_digests[module_name]
+
+
+_library_versions = None
+
+
+def library_versions():
+    """Return a string naming the versions of Python and of the libraries DXR
+    requires, memoized for the life of the process.
+
+    Plugins' per-line output can change with these as much as with our own
+    code: a new Pygments, for instance, highlights differently.
+
+    """
+    global _library_versions
+    if _library_versions is None:
+        versions = [sys.version]
+        try:
+            requirements = get_distribution('dxr').requires()
+        except DistributionNotFound:  # running from an uninstalled checkout
+            requirements = []
+        for requirement in requirements:
+            try:
+                version = get_distribution(requirement.project_name).version
+            except DistributionNotFound:
+                version = None
+            versions.append('%s %s' % (requirement.project_name, version))
+        _library_versions = '\n'.join(versions)
+    return _library_versions
+
+
+def line_cache_path(tree, rel_path, contents, files_to_index):
+    """Return the path in the index cache where the per-line docs of a file
+    live, if they've been cached.
+
+    The key covers everything a cacheable FileToIndex is allowed to depend on,
+    including the versions of the libraries it might use.
+
+    :arg rel_path: Bytestring path to the file, relative to the source folder
+    :arg contents: The unicode contents of the file
+    :arg files_to_index: The interesting FileToIndex objects for the file
+
+    """
+    hasher = sha1()
+    for part in [FORMAT, code_digest('dxr'), library_versions(), rel_path,
+                 contents.encode('utf-8')]:
+        hasher.update(part)
+        hasher.update('\0')
+    for file_to_index in files_to_index:
+        cls = type(file_to_index)
+        hasher.update(json.dumps(
+            [file_to_index.plugin_name,
+             cls.__module__,
+             cls.__name__,
+             code_digest(cls.__module__),
+             tree._section.get(file_to_index.plugin_name)],
+            sort_keys=True,
+            # Compiled regexes and such:
+            default=lambda obj: getattr(obj, 'pattern', repr(obj))))
+    key = hasher.hexdigest()
+    return join(tree.config.index_cache_folder, key[:2], key[2:] + '.json.gz')
+
+
+def cached_lines(cache_path):
+    """Yield the per-line docs stored at a path in the index cache."""
+    with gzip.open(cache_path, 'rb') as file:
+        for line in file:
+            yield json.loads(line)
+
+
+def caching_lines(lines, cache_path):
+    """Pass through an iterable of per-line docs, and save them at a path in
+    the index cache once it's exhausted.
+
+    Each doc is written before it is yielded, so the consumer is free to
+    scribble on it. We write to a temp file and rename it into place so
+    concurrent workers never see a partial entry.
+
+    """
+    folder = dirname(cache_path)
+    try:
+        makedirs(folder)
+    except OSError as exc:
+        if exc.errno != EEXIST:
+            raise
+    fd, temp_path = mkstemp(dir=folder)
+    os.close(fd)
+    finished = False
+    try:
+        with gzip.open(temp_path, 'wb') as file:
+            for line in lines:
+                # Encode as ES would, since that's where the docs end up:
+                file.write(json.dumps(line, cls=JsonEncoder))
+                file.write('\n')
+                yield line
+        os.rename(temp_path, cache_path)
+        finished = True
+    finally:
+        if not finished:
+            os.remove(temp_path)
+
+
+def index_file(tree, tree_indexers, path, es, index, sender=None,
+               profile=None, ref_ids=None):
     """Index a single file into ES, and build a static HTML representation of it.
 
     For the moment, we execute plugins in series, figuring that we have plenty
@@ -436,10 +1577,21 @@ def index_file(tree, tree_indexers, path, es, index):
 
     :arg path: Bytestring absolute path to the file to index
     :arg index: The ES index name
+    :arg sender: The :class:`BulkSender` through which to send docs to ES. If
+        omitted, we send them ourselves, synchronously.
+    :arg profile: A :class:`~dxr.profiling.Profile` to charge the time spent
+        in each stage and plugin method to
+    :arg ref_ids: The set of IDs of the ref payloads already sent, which we
+        add to as we send more
 
     """
+    if profile is None:
+        profile = Profile()
+    if ref_ids is None:
+        ref_ids = set()
     try:
-        contents = unicode_contents(path, tree.source_encoding)
+        with profile.timed(('stage', 'read')):
+            contents = unicode_contents(path, tree.source_encoding)
     except IOError as exc:
         if exc.errno == ENOENT and islink(path):
             # It's just a bad symlink (or a symlink that was swiped out
@@ -455,38 +1607,89 @@ def index_file(tree, tree_indexers, path, es, index):
     is_link = islink(path)
     # Index by line if the contents are text and the path is not a symlink.
     index_by_line = is_text and not is_link
+    files_to_index = []
+    for tree_indexer in tree_indexers:
+        with profile.timed(('plugin', tree_indexer.plugin_name,
+                            'file_to_index')):
+            file_to_index = tree_indexer.file_to_index(rel_path, contents)
+            if file_to_index.is_interesting():
+                files_to_index.append(file_to_index)
+
+    def timed(file_to_index, method):
+        """Return an iterator over the output of a plugin method, charging
+        the time spent producing it to the plugin."""
+        return profile.timed_iter(
+            ('plugin', file_to_index.plugin_name, method),
+            getattr(file_to_index, method))
+
+    # If every interested plugin says its per-line output depends only on
+    # things we can hash, we may have that output on disk already:
+    cache_path = None
+    if (index_by_line and
+            tree.config.index_cache_folder and
+            all(f.cacheable for f in files_to_index)):
+        cache_path = line_cache_path(tree, rel_path, contents, files_to_index)
+        if exists(cache_path):
+            index_by_line = False  # Replay the cached lines instead.
+    needles = {}
+    linkses = []
     if index_by_line:
         lines = split_content_lines(contents)
-        num_lines = len(lines)
-        needles_by_line = [{} for _ in xrange(num_lines)]
-        annotations_by_line = [[] for _ in xrange(num_lines)]
         refses, regionses = [], []
-    needles = {}
-    linkses = []
+        needles_by_lines, annotations_by_lines = [], []
 
-    for tree_indexer in tree_indexers:
-        file_to_index = tree_indexer.file_to_index(rel_path, contents)
-        if file_to_index.is_interesting():
-            # Per-file stuff:
-            append_update(needles, file_to_index.needles())
-            if not is_link:
-                linkses.append(file_to_index.links())
-
-            # Per-line stuff:
-            if index_by_line:
-                refses.append(file_to_index.refs())
-                regionses.append(file_to_index.regions())
-                append_update_by_line(needles_by_line,
-                                      file_to_index.needles_by_line())
-                append_by_line(annotations_by_line,
-                               file_to_index.annotations_by_line())
+    for file_to_index in files_to_index:
+        # Per-file stuff:
+        append_update(needles, timed(file_to_index, 'needles'))
+        if not is_link:
+            linkses.append(timed(file_to_index, 'links'))
 
-    def docs():
-        """Yield documents for bulk indexing.
+        # Per-line stuff:
+        if index_by_line:
+            refses.append(timed(file_to_index, 'refs'))
+            regionses.append(timed(file_to_index, 'regions'))
+            needles_by_lines.append(timed(file_to_index, 'needles_by_line'))
+            annotations_by_lines.append(
+                timed(file_to_index, 'annotations_by_line'))
+
+    def line_docs():
+        """Yield a doc for each line, lacking the file-wide needles.
+
+        The plugins' per-line needles and annotations are pulled a line at a
+        time, so, apart from the refs and regions tag balancing has to sort,
+        only the line at hand is in memory.
 
-        Big Warning: docs also clears the contents of all elements of
-        needles_by_line because they will no longer be used.
         """
+        # The plugins' refs and regions are pulled lazily from within tag
+        # balancing, but exclusive timing keeps them out of its total.
+        tagses = profile.timed_iter(
+            ('stage', 'balance_tags'),
+            lambda: es_lines(finished_tags(lines,
+                                           chain.from_iterable(refses),
+                                           chain.from_iterable(regionses))))
+        for needle_pairses, annotationses, tags in izip(
+                by_line(needles_by_lines, len(lines)),
+                by_line(annotations_by_lines, len(lines)),
+                tagses):
+            total = append_update({}, chain.from_iterable(needle_pairses))
+            annotations_for_this_line = list(
+                chain.from_iterable(annotationses))
+            # We bucket tags into refs and regions for ES because later at
+            # request time we want to be able to merge them individually
+            # with those from skimmers.
+            refs_and_regions = bucket(tags, lambda index_obj: "regions" if
+                                      isinstance(index_obj['payload'], basestring) else
+                                      "refs")
+            if 'refs' in refs_and_regions:
+                total['refs'] = refs_and_regions['refs']
+            if 'regions' in refs_and_regions:
+                total['regions'] = refs_and_regions['regions']
+            if annotations_for_this_line:
+                total['annotations'] = annotations_for_this_line
+            yield total
+
+    def docs():
+        """Yield documents for bulk indexing."""
         # Index a doc of type 'file' so we can build folder listings.
         # At the moment, we send to ES in the same worker that does the
         # indexing. We could interpose an external queueing system, but I'm
@@ -511,41 +1714,492 @@ def index_file(tree, tree_indexers, path, es, index):
 
         # Index all the lines.
         if index_by_line:
-            for total, annotations_for_this_line, tags in izip(
-                    needles_by_line,
-                    annotations_by_line,
-                    es_lines(finished_tags(lines,
-                                           chain.from_iterable(refses),
-                                           chain.from_iterable(regionses)))):
-                # Duplicate the file-wide needles into this line:
-                total.update(needles)
-
-                # We bucket tags into refs and regions for ES because later at
-                # request time we want to be able to merge them individually
-                # with those from skimmers.
-                refs_and_regions = bucket(tags, lambda index_obj: "regions" if
-                                          isinstance(index_obj['payload'], basestring) else
-                                          "refs")
-                if 'refs' in refs_and_regions:
-                    total['refs'] = refs_and_regions['refs']
-                if 'regions' in refs_and_regions:
-                    total['regions'] = refs_and_regions['regions']
-                if annotations_for_this_line:
-                    total['annotations'] = annotations_for_this_line
-                yield es.index_op(total)
-
-                # Because needles_by_line holds a reference, total is not
-                # garbage collected. Since we won't use it again, we can clear
-                # the contents, saving substantial memory on long files.
-                total.clear()
+            lines = line_docs()
+            if cache_path:
+                lines = caching_lines(lines, cache_path)
+        elif cache_path:
+            lines = profile.timed_iter(('stage', 'line_cache'),
+                                       lambda: cached_lines(cache_path))
+        else:
+            lines = []
+        # Refs point to their payloads, which are sent once apiece:
+        new_payloads = []
+        lines = interned_refs(lines, ref_ids, new_payloads)
+        if tree.line_block_size:
+            line_and_block_docs = blocked_lines(lines, tree.line_block_size)
+        else:
+            line_and_block_docs = ((LINE, line) for line in lines)
+        # The rest of the file-wide needles stay on the FILE doc. Queries
+        # on them join on the path.
+        line_needles = dict((k, v) for k, v in needles.iteritems()
+                            if k in LINE_FILE_NEEDLES)
+        for doc_type, doc in line_and_block_docs:
+            for payload_id, payload in new_payloads:
+                yield es.index_op(payload, doc_type=REF, id=payload_id)
+            del new_payloads[:]
+            doc.update(line_needles)
+            yield es.index_op(doc, doc_type=doc_type)
+
+    # Whatever time isn't charged to a plugin, tag balancing, or the cache
+    # goes toward assembling and serializing the docs:
+    actions = profile.timed_iter(('stage', 'assemble_docs'), docs)
+    if sender is None:
+        with BulkSender(es, index, threads=0, profile=profile) as sender:
+            sender.add_all(actions)
+    else:
+        sender.add_all(actions)
+
+
+def interned_refs(lines, ref_ids, new_payloads):
+    """Replace the payload of each ref in some line docs with its ID, and
+    pass the docs along.
+
+    Payloads whose IDs aren't yet in ``ref_ids`` get appended to
+    ``new_payloads`` as (ID, payload) pairs, and their IDs added, by the time
+    the line that first has them comes out.
+
+    """
+    for line in lines:
+        for ref in line.get('refs', ()):
+            payload_id = ref_payload_id(ref['payload'])
+            if payload_id not in ref_ids:
+                ref_ids.add(payload_id)
+                new_payloads.append((payload_id, ref['payload']))
+            ref['payload'] = payload_id
+        yield line
+
+
+def blocked_lines(lines, block_size):
+    """Group line docs into LINE_BLOCK docs, and yield (doc type, doc) for
+    each block, as well as for each line which has structural needles.
+
+    Blocks hold arrays of the numbers and contents of up to ``block_size``
+    consecutive lines, and of the BLOCKED_LINE_ARRAYS of all of them, tagged
+    with their lines' numbers. Text searches and browsing need only them, so
+    a tree needs around a ``block_size``th of the docs it otherwise would,
+    plus a LINE doc, without content, for each line with structural needles.
+    Those are the only ones structural searches need, and highlighting puts
+    regions on nearly every line, so that is far fewer than the lines with
+    anything but content to them.
+
+    :arg lines: An iterable of line docs, as from ``index_file()``, lacking
+        the file-wide needles
+
+    """
+    block = None
+    for line in lines:
+        if block is None or len(block['number']) >= block_size:
+            if block is not None:
+                yield LINE_BLOCK, block
+            block = {'number': [], 'content': []}
+        number = line['number'][0]
+        block['number'].append(number)
+        block['content'].extend(line.pop('content'))
+        for key in BLOCKED_LINE_ARRAYS:
+            for item in line.pop(key, ()):
+                item['number'] = number
+                block.setdefault(key, []).append(item)
+        if any(key != 'number' for key in line):
+            yield LINE, line
+    if block is not None:
+        yield LINE_BLOCK, block
+
+
+class BulkThrottle(object):
+    """Additive-increase, multiplicative-decrease (AIMD) control of the size
+    and concurrency of bulk requests to ES
+
+    Clusters differ wildly in capacity, so rather than hard-coding a chunk
+    size, we start from a known-decent one and feel our way: each prompt
+    response nudges chunks bigger and lets another request into flight, and
+    each slow response, rejection, or timeout halves both. ES's capacity is a
+    property of the cluster, not of any one sender, so one of these, from
+    :func:`bulk_throttle()`, is shared by all the sending threads of all the
+    :class:`BulkSender` objects in a process, and what one learns carries
+    over to the next.
 
+    """
     # Indexing a 277K-line file all in one request makes ES time out (>60s),
     # so we chunk it up. 300 docs is optimal according to the benchmarks in
     # https://bugzilla.mozilla.org/show_bug.cgi?id=1122685. So large docs like
     # images don't make our chunk sizes ridiculous, there's a size ceiling as
     # well: 10000 is based on the 300 and an average of 31 chars per line.
-    for chunk in bulk_chunks(docs(), docs_per_chunk=300, bytes_per_chunk=10000):
-        es.bulk(chunk, index=index, doc_type=LINE)
+    # Those are where we start. Chunks are always some multiple of them.
+    DOCS_PER_CHUNK = 300
+    BYTES_PER_CHUNK = 10000
+    MIN_SCALE = 0.1
+    MAX_SCALE = 50
+
+    def __init__(self, max_in_flight, slow_seconds):
+        """
+        :arg max_in_flight: The most requests we'll ever allow in flight at
+            once
+        :arg slow_seconds: How long a response can take before we consider ES
+            overloaded
+
+        """
+        self.scale = 1.0
+        self.in_flight_limit = 1.0
+        self.max_in_flight = max_in_flight
+        self.pid = os.getpid()
+        self._slow_seconds = slow_seconds
+        self._in_flight = 0
+        self._condition = Condition()
+
+    @property
+    def docs_per_chunk(self):
+        return max(int(self.DOCS_PER_CHUNK * self.scale), 1)
+
+    @property
+    def bytes_per_chunk(self):
+        return int(self.BYTES_PER_CHUNK * self.scale)
+
+    @contextmanager
+    def slot(self):
+        """Wait until another request is allowed in flight, and keep its
+        place until the end of the ``with`` block."""
+        with self._condition:
+            while self._in_flight >= int(self.in_flight_limit):
+                self._condition.wait()
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def succeeded(self, seconds):
+        """Note a request that completed in ``seconds``."""
+        if seconds > self._slow_seconds:
+            self.failed()
+        else:
+            with self._condition:
+                self.scale = min(self.scale + 1, self.MAX_SCALE)
+                # About one more request in flight per full window of
+                # successes, as in TCP congestion avoidance:
+                self.in_flight_limit = min(
+                    self.in_flight_limit + 1 / self.in_flight_limit,
+                    self.max_in_flight)
+                self._condition.notify_all()
+
+    def failed(self):
+        """Note that ES seems overloaded."""
+        with self._condition:
+            self.scale = max(self.scale / 2, self.MIN_SCALE)
+            self.in_flight_limit = max(self.in_flight_limit / 2, 1)
+
+
+# The BulkThrottle shared by the BulkSenders of this process:
+_bulk_throttle = None
+
+
+def bulk_throttle(max_in_flight, slow_seconds):
+    """Return the :class:`BulkThrottle` shared by the bulk senders of this
+    process, making it if need be.
+
+    Its ceiling on requests in flight is raised to ``max_in_flight`` if
+    that's higher than any sender has asked for before. A forked worker gets a
+    fresh one, since its parent's threads may have held slots in the old one
+    at the moment of the fork.
+
+    """
+    global _bulk_throttle
+    if _bulk_throttle is None or _bulk_throttle.pid != os.getpid():
+        _bulk_throttle = BulkThrottle(max_in_flight, slow_seconds)
+    else:
+        _bulk_throttle.max_in_flight = max(_bulk_throttle.max_in_flight,
+                                           max_in_flight)
+    return _bulk_throttle
+
+
+class BulkSender(object):
+    """A sender of bulk requests to ES from a pool of threads
+
+    This lets the CPU-bound analysis of files carry on while requests are in
+    flight. The queue in front of the threads is bounded, so, if ES falls
+    behind, :meth:`add()` blocks rather than piling up docs in RAM. Since each
+    thread has at most one request outstanding, the load on ES is bounded by
+    the number of threads, and a :class:`BulkThrottle` shared across the
+    process keeps it lower still if ES struggles.
+
+    Actions are gathered into chunks across calls, so small files share
+    requests.
+
+    Actions ES rejects for lack of capacity (status 429) are retried, with
+    exponential backoff. Timeouts are not: a timed-out request may yet
+    complete, and our docs have no IDs to make a retry idempotent.
+
+    If a request fails, the error is raised out of the next :meth:`add()` or
+    out of :meth:`close()`. Use me as a context manager to make sure that
+    happens.
+
+    """
+    MAX_RETRIES = 10
+
+    def __init__(self, es, index, threads=1, doc_type=LINE, timeout=60,
+                 profile=None, throttle=None):
+        """
+        :arg index: The name of the index to send docs to
+        :arg threads: The number of sending threads. If 0, we send
+            synchronously.
+        :arg doc_type: The doc type of actions that don't specify one
+        :arg timeout: The ES timeout, in seconds. We consider a tenth of this
+            a slow response.
+        :arg profile: A :class:`~dxr.profiling.Profile` to charge the time,
+            docs, and bytes of each bulk request to
+        :arg throttle: The :class:`BulkThrottle` to pace requests with.
+            Defaults to the one shared by the process.
+
+        """
+        self._es = es
+        self._profile = Profile() if profile is None else profile
+        self._index = index
+        self._doc_type = doc_type
+        self._throttle = throttle or bulk_throttle(max(threads, 1),
+                                                   timeout / 10.0)
+        self._chunk, self._chunk_bytes = [], 0
+        self._error = None
+        self._queue = Queue(maxsize=threads * 2)
+        self._threads = [Thread(target=self._drain) for _ in xrange(threads)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def add(self, action):
+        """Queue an action, as from ``es.index_op()``, for sending."""
+        self._chunk.append(action)
+        self._chunk_bytes += len(action)
+        if (len(self._chunk) >= self._throttle.docs_per_chunk or
+                self._chunk_bytes >= self._throttle.bytes_per_chunk):
+            self._send_chunk()
+
+    def add_all(self, actions):
+        """Queue an iterable of actions for sending."""
+        for action in actions:
+            self.add(action)
+
+    def close(self):
+        """Send any partial chunk, and wait for all queued requests to finish.
+        Raise the first error any of them encountered."""
+        if self._chunk and self._error is None:
+            self._send_chunk()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            # Don't mask the original exception with one of ours.
+            try:
+                self.close()
+            except Exception:
+                pass
+
+    def _send_chunk(self):
+        self._raise_error()
+        chunk = self._chunk
+        self._chunk, self._chunk_bytes = [], 0
+        if self._threads:
+            self._queue.put(chunk)  # blocks while the queue is full
+        else:
+            self._bulk(chunk)
+
+    def _bulk(self, actions):
+        """Send a bulk request, retrying any actions ES rejects for being too
+        busy."""
+        for attempt in count():
+            with self._throttle.slot(), es_request_slot():
+                start = time()
+                body = '\n'.join(actions) + '\n'
+                try:
+                    # We do what es.bulk() does, but we need to see which
+                    # items correspond to which actions.
+                    with self._profiled(len(actions), len(body)):
+                        response = self._es.send_request(
+                            'POST',
+                            [self._index, self._doc_type, '_bulk'],
+                            body=body)
+                except (Timeout, ConnectionError):
+                    self._throttle.failed()
+                    raise
+                except ElasticHttpError as exc:
+                    if exc.status_code not in (429, 503):
+                        raise
+                    rejections = [(action, None) for action in actions]
+                else:
+                    rejections = []
+                    if response.get('errors', True):
+                        errors = []
+                        for action, item in izip(actions, response['items']):
+                            status = first(item.itervalues()).get('status', 999)
+                            if status == 429:
+                                rejections.append((action, item))
+                            elif not 200 <= status < 300:
+                                errors.append(item)
+                        if errors:
+                            raise BulkError(errors, [])
+                    if not rejections:
+                        self._throttle.succeeded(time() - start)
+                        return
+            self._throttle.failed()
+            if attempt >= self.MAX_RETRIES:
+                raise BulkError([item for _, item in rejections if item], [])
+            sleep(min(0.5 * 2 ** attempt, 30))
+            actions = [action for action, _ in rejections]
+
+    def _profiled(self, docs, bytes):
+        """Return a context manager which charges a bulk request to our
+        profile."""
+        key = ('es', 'bulk')
+        if self._threads:
+            return self._profile.clocked(key, docs=docs, bytes=bytes)
+        # On the caller's thread, so take part in its exclusive timing:
+        return self._profile.timed(key, docs=docs, bytes=bytes)
+
+    def _drain(self):
+        """Send requests off the queue until told to stop.
+
+        Once any request has failed, keep emptying the queue but stop
+        sending, so nobody blocks on a full queue.
+
+        """
+        while True:
+            actions = self._queue.get()
+            if actions is None:
+                break
+            if self._error is None:
+                try:
+                    self._bulk(actions)
+                except Exception:
+                    self._error = exc_info()
+
+    def _raise_error(self):
+        if self._error is not None:
+            type, value, traceback = self._error
+            self._error = None
+            raise type, value, traceback
+
+
+class Export(object):
+    """A folder of index settings and bulk requests, written in place of
+    indexing a tree into ES, for :func:`load_and_deploy_tree()` to send along
+    later, maybe from another machine
+
+    The bulk requests are newline-delimited JSON, just as they'd go to ES's
+    ``_bulk`` endpoint. Each :meth:`sender()` writes a file of its own, so
+    workers needn't coordinate. The files are named after the doc type of the
+    actions that don't specify one, which is the type a loader should POST
+    them under.
+
+    """
+    SETTINGS = 'index.json'
+
+    def __init__(self, folder, compress=False):
+        """
+        :arg folder: The folder to keep things in
+        :arg compress: Whether to gzip the bulk requests we write
+
+        """
+        self.folder = folder
+        self.compress = compress
+
+    def save_settings(self, settings):
+        """Write the settings and mappings to create the index with."""
+        with open(join(self.folder, self.SETTINGS), 'w') as file:
+            json.dump(settings, file)
+
+    def load_settings(self):
+        with open(join(self.folder, self.SETTINGS)) as file:
+            return json.load(file)
+
+    def sender(self, name, doc_type=LINE, profile=None):
+        """Return a :class:`BulkExporter` writing to a new file.
+
+        :arg name: A name for the file, unique within its doc type
+
+        """
+        extension = '.ndjson.gz' if self.compress else '.ndjson'
+        return BulkExporter(join(self.folder,
+                                 '%s-%s%s' % (doc_type, name, extension)),
+                            compress=self.compress,
+                            profile=profile)
+
+    def bulk_files(self):
+        """Return a list of (default doc type, path) for each file of bulk
+        requests."""
+        return [(name.split('-', 1)[0], join(self.folder, name))
+                for name in sorted(os.listdir(self.folder))
+                if name.endswith(('.ndjson', '.ndjson.gz'))]
+
+    @staticmethod
+    def actions(path):
+        """Yield the actions, as from ``es.index_op()``, in a file of bulk
+        requests."""
+        with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as file:
+            # Each action is a line of metadata and one of source.
+            for metadata, source in izip(file, file):
+                yield metadata + source.rstrip('\n')
+
+
+class BulkExporter(object):
+    """A stand-in for :class:`BulkSender` which writes bulk requests to a file
+    rather than sending them to ES"""
+
+    def __init__(self, path, compress=False, profile=None):
+        """
+        :arg compress: Whether to gzip the file
+        :arg profile: A :class:`~dxr.profiling.Profile` to charge the docs
+            and bytes written to
+
+        """
+        self._profile = Profile() if profile is None else profile
+        # Compression level 6 is zlib's default. gzip's 9 costs much more CPU
+        # for not much less disk.
+        self._file = (gzip.open(path, 'wb', compresslevel=6) if compress else
+                      open(path, 'wb'))
+        self._docs = self._bytes = 0
+
+    def add(self, action):
+        """Write an action, as from ``es.index_op()``."""
+        self._file.write(action)
+        self._file.write('\n')
+        self._docs += 1
+        self._bytes += len(action) + 1
+
+    def add_all(self, actions):
+        """Write an iterable of actions."""
+        for action in actions:
+            self.add(action)
+
+    def close(self):
+        self._file.close()
+        self._profile.add(('es', 'export'), docs=self._docs, bytes=self._bytes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+#: What an indexing worker reports back about a chunk: its pid, the number of
+#: files indexed, the seconds taken, the :attr:`~dxr.profiling.Profile.totals`
+#: of its profile, a list of (seconds, path) of its slowest files, and its
+#: resident set size in bytes when done (or None if unknown)
+ChunkStats = namedtuple('ChunkStats',
+                        ['pid', 'files', 'seconds', 'totals', 'slowest', 'rss'])
+
+#: How many of the slowest files to index to list in the profile report
+SLOWEST_FILES = 25
 
 
 def index_chunk(tree,
@@ -553,16 +2207,27 @@ def index_chunk(tree,
                 paths,
                 index,
                 swallow_exc=False,
-                worker_number=None):
+                worker_number=None,
+                export=None,
+                export_name=None):
     """Index a pile of files.
 
     This is the entrypoint for indexer pool workers.
 
     :arg worker_number: A unique number assigned to this worker so it knows
         what to call its log file
+    :arg export: An :class:`Export` to write the chunk's bulk requests into,
+        under ``export_name``, rather than sending them to ES
+
+    Return a :class:`ChunkStats` on success. If ``swallow_exc`` and something
+    goes wrong, return a tuple of (formatted traceback, exception type,
+    exception value, path being indexed) instead.
 
     """
     path = '(no file yet)'
+    start = time()
+    profile = Profile()
+    slowest = []  # a min-heap of (seconds, path)
     try:
         # So we can use Flask's url_from():
         with make_app(tree.config).test_request_context():
@@ -572,12 +2237,40 @@ def index_chunk(tree,
                 log = (worker_number and
                        open_log(tree.log_folder,
                                 'index-chunk-%s.log' % worker_number))
-                for path in paths:
-                    log and log.write('Starting %s.\n' % path)
-                    index_file(tree, tree_indexers, path, es, index)
-                log and log.write('Finished chunk.\n')
+                log and log.write('Starting chunk in worker %s. %s\n' %
+                                  (os.getpid(), describe_rss()))
+                if export:
+                    sender = export.sender(export_name, profile=profile)
+                else:
+                    sender = BulkSender(
+                        es,
+                        index,
+                        threads=tree.config.es_indexing_senders,
+                        timeout=tree.config.es_indexing_timeout,
+                        profile=profile)
+                # The IDs of the ref payloads the chunk has sent so far:
+                ref_ids = set()
+                with sender:
+                    for path in paths:
+                        log and log.write('Starting %s.\n' % path)
+                        file_start = time()
+                        with profile.timed(('stage', 'index_file')):
+                            index_file(tree, tree_indexers, path, es, index,
+                                       sender, profile, ref_ids)
+                        timing = time() - file_start, path
+                        if len(slowest) < SLOWEST_FILES:
+                            heappush(slowest, timing)
+                        else:
+                            heappushpop(slowest, timing)
+                log and log.write('Finished chunk. %s\n' % describe_rss())
             finally:
                 log and log.close()
+        return ChunkStats(os.getpid(),
+                          len(paths),
+                          time() - start,
+                          profile.totals,
+                          slowest,
+                          rss_bytes())
     except Exception as exc:
         if swallow_exc:
             type, value, traceback = exc_info()
@@ -586,58 +2279,298 @@ def index_chunk(tree,
             raise
 
 
-def index_folders(tree, index, es):
-    """Index the folder hierarchy into ES."""
+def describe_rss():
+    """Return a sentence about the memory use of this process, for logs."""
+    rss = rss_bytes()
+    return 'Resident set: %s.' % ('unknown' if rss is None else
+                                  '%.0f MB' % (rss / 1024.0 / 1024))
+
+
+def recycling_reason(config, stats, files_done):
+    """Return why a pool worker should be replaced, given the
+    :class:`ChunkStats` of the chunk it just finished and the number of files
+    it has done in all, or None if it's fine.
+
+    """
+    if config.worker_max_files and files_done >= config.worker_max_files:
+        return 'a worker has indexed %s files' % files_done
+    max_bytes = config.worker_max_memory * 1024 * 1024
+    if max_bytes and stats.rss and stats.rss >= max_bytes:
+        return 'a worker has grown to %.0f MB' % (stats.rss / 1024.0 / 1024)
+
+
+class PoolWorker(object):
+    """One worker process of a :class:`RecyclingPool`, with the chunk handed
+    to it, if it's busy"""
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.future = None
+        self.files = 0  # done so far
+
+
+class RecyclingPool(object):
+    """A pool of indexing worker processes, each of which is replaced on its
+    own once it passes the ``worker_max_files`` or ``worker_max_memory``
+    limit
+
+    Each worker is a single-process executor, handed one chunk at a time,
+    only once it's free. Nothing is queued behind a busy worker, so the next
+    chunk always goes to whichever worker frees up first, just as with a
+    shared queue: one stuck on a big chunk never holds up others an idle one
+    could take. A worker due for replacement exits once its chunk is done,
+    and only then is its replacement started. So there are never more than
+    ``workers`` processes alive, and the rest keep working all the while.
+
+    """
+    def __init__(self, workers, config, new_executor=None):
+        """
+        :arg config: The [DXR] section of the config, which sets the limits
+        :arg new_executor: A callable returning an executor to run a worker's
+            chunks. Defaults to making a single-process one.
+
+        """
+        self._config = config
+        self._new_executor = (new_executor or
+                              (lambda: ProcessPoolExecutor(max_workers=1)))
+        self._workers = [PoolWorker(self._new_executor())
+                         for _ in xrange(workers)]
+        self._workers_by_future = {}
+
+    def has_room(self):
+        """Return whether any worker is free to take a chunk."""
+        return any(w.future is None for w in self._workers)
+
+    def submit(self, fn, *args, **kwargs):
+        """Hand a call to a free worker, and return its future."""
+        worker = first(w for w in self._workers if w.future is None)
+        worker.future = worker.executor.submit(fn, *args, **kwargs)
+        self._workers_by_future[worker.future] = worker
+        return worker.future
+
+    def finished(self, future, stats):
+        """Note that a future is done, given the :class:`ChunkStats` of its
+        chunk. If that puts its worker over a limit, retire the worker, and
+        return why. Otherwise, return None.
+
+        """
+        worker = self._workers_by_future.pop(future)
+        worker.future = None
+        worker.files += stats.files
+        reason = recycling_reason(self._config, stats, worker.files)
+        if reason:
+            # Let the old process exit before starting its replacement:
+            worker.executor.shutdown()
+            self._workers[self._workers.index(worker)] = PoolWorker(
+                self._new_executor())
+        return reason
+
+    def shutdown(self):
+        """Wait for every worker to finish, and let them exit."""
+        for worker in self._workers:
+            worker.executor.shutdown()
+
+
+def index_folders(tree, index, es, folders, export=None):
+    """Index the folder hierarchy into ES.
+
+    :arg folders: The bytestring absolute paths of the folders to index
+    :arg export: An :class:`Export` to write the bulk requests into rather
+        than sending them to ES
+
+    """
     folder_indexers = [(p.name, p.folder_to_index)
                        for p in tree.enabled_plugins if p.folder_to_index]
-    with aligned_progressbar(unignored(tree.source_folder,
-                                       tree.ignore_paths,
-                                       tree.ignore_filenames,
-                                       want_folders=True),
-                     show_eta=False,  # never even close
-                     label='Indexing folders') as folders:
+
+    def docs():
         for folder in folders:
             needles = {'is_folder': True}
             for name, folder_to_index in folder_indexers:
                 needles.update(dict(folder_to_index(name, tree, folder).needles()))
-            es.index(index, FILE, needles)
+            yield es.index_op(needles)
+
+    if export:
+        sender = export.sender('folders', doc_type=FILE)
+    else:
+        sender = BulkSender(es,
+                            index,
+                            threads=0,
+                            doc_type=FILE,
+                            timeout=tree.config.es_indexing_timeout)
+    with sender:
+        sender.add_all(docs())
+
+
+# Caps on the size of a chunk of files handed to an indexing worker:
+MAX_CHUNK_FILES = 500
+MIN_CHUNK_BYTES = 1024 * 1024
+
 
+def index_files(tree, tree_indexers, index, es, files, folders,
+                checkpoint=None, export=None):
+    """Divide source files into groups, and send them out to be indexed.
 
-def index_files(tree, tree_indexers, index, pool, es):
-    """Divide source files into groups, and send them out to be indexed."""
+    Folders get indexed alongside, from a thread in this process, which
+    otherwise just sits waiting on workers.
 
-    def path_chunks(tree):
-        """Return an iterable of worker-sized iterables of paths."""
-        return ichunks(500, unignored(tree.source_folder,
-                                      tree.ignore_paths,
-                                      tree.ignore_filenames))
+    Workers pile up memory in plugin state and caches as they go, so, once
+    one passes the ``worker_max_files`` or ``worker_max_memory`` limit, a
+    :class:`RecyclingPool` replaces it with a fresh process.
 
-    index_folders(tree, index, es)
+    :arg files: The :class:`ManifestFile` of each file to index
+    :arg folders: The bytestring absolute paths of the folders to index
+    :arg checkpoint: A :class:`Checkpoint` to record our progress in, if any
+    :arg export: An :class:`Export` to write bulk requests into rather than
+        sending them to ES, if any
+
+    Return a list of the :class:`ChunkStats` of the chunks.
+
+    """
+    def record(event, paths=()):
+        if checkpoint:
+            checkpoint.record(event, paths)
+
+    def index_and_record_folders():
+        index_folders(tree, index, es, folders, export)
+        record('folders')
+
+    chunks = path_chunks(files, tree.workers)
 
     if not tree.workers:
-        for paths in path_chunks(tree):
-            index_chunk(tree,
-                        tree_indexers,
-                        paths,
-                        index,
-                        swallow_exc=False)
+        index_and_record_folders()
+        stats = []
+        for number, chunk in enumerate(chunks, 1):
+            record('started', chunk)
+            stats.append(index_chunk(tree,
+                                     tree_indexers,
+                                     chunk,
+                                     index,
+                                     swallow_exc=False,
+                                     export=export,
+                                     export_name='chunk-%s' % number))
+            record('finished', chunk)
+        return stats
     else:
-        futures = [pool.submit(index_chunk,
-                               tree,
-                               tree_indexers,
-                               paths,
-                               index,
-                               worker_number=worker_number,
-                               swallow_exc=True)
-                   for worker_number, paths in enumerate(path_chunks(tree), 1)]
-        for future in show_progress(futures, 'Indexing files'):
-            result = future.result()
-            if result:
-                formatted_tb, type, value, path = result
-                print 'A worker failed while indexing %s:' % path
-                print formatted_tb
-                # Abort everything if anything fails:
-                raise type, value  # exits with non-zero
+        def submit(worker_number, chunk):
+            record('started', chunk)
+            future = pool.submit(index_chunk,
+                                 tree,
+                                 tree_indexers,
+                                 chunk,
+                                 index,
+                                 worker_number=worker_number,
+                                 swallow_exc=True,
+                                 export=export,
+                                 export_name='chunk-%s' % worker_number)
+            chunks_by_future[future] = chunk
+            return future
+
+        def submit_more():
+            """Hand out chunks until every worker has one."""
+            for numbered in numbered_chunks:
+                futures.add(submit(*numbered))
+                if not pool.has_room():
+                    break
+
+        # Rather than queueing everything up front, hand out a chunk whenever
+        # one finishes, to the worker that just freed up. That way, the big
+        # chunks at the front get started first, and the little ones at the
+        # back fill in around them, wherever there's a worker free.
+        numbered_chunks = enumerate(chunks, 1)
+        chunks_by_future = {}
+        futures = set()
+        pool = RecyclingPool(tree.workers, tree.config)
+        try:
+            submit_more()
+            folder_thread = ThreadPoolExecutor(max_workers=1)
+            folders_done = folder_thread.submit(index_and_record_folders)
+            folder_thread.shutdown(wait=False)
+            stats = []
+            start = time()
+            with aligned_progressbar(length=len(chunks),
+                                     show_eta=False,  # never even close
+                                     label='Indexing files') as bar:
+                while futures:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        result = future.result()
+                        if not isinstance(result, ChunkStats):
+                            formatted_tb, type, value, path = result
+                            print 'A worker failed while indexing %s:' % path
+                            print formatted_tb
+                            # Abort everything if anything fails:
+                            raise type, value  # exits with non-zero
+                        stats.append(result)
+                        record('finished', chunks_by_future.pop(future))
+                        reason = pool.finished(future, result)
+                        if reason:
+                            print ('\nReplacing a worker process, since %s.' %
+                                   reason)
+                        bar.update(1)
+                    if pool.has_room():
+                        submit_more()
+            folders_done.result()  # Raise any error.
+        finally:
+            pool.shutdown()
+        print 'Indexed %s folders.' % len(folders)
+        print_utilization(stats, time() - start)
+        return stats
+
+
+def path_chunks(files, workers):
+    """Divide paths into chunks for indexing workers, and return a list of
+    lists of paths.
+
+    Files go out biggest first, so giant generated files don't start last and
+    hold up the end of the run. Chunks shrink as the remaining work does
+    (guided self-scheduling), so the tail is made of small chunks that even
+    out the finishing times of the workers. There is a floor on chunk size,
+    since each chunk costs us a trip of the pickled tree indexers to a worker.
+
+    :arg files: An iterable of :class:`ManifestFile`, whose sizes we use
+        rather than going back to the filesystem
+    :arg workers: The number of worker processes that will be sharing the
+        chunks
+
+    """
+    sized_paths = sorted(((f.size, f.path) for f in files), reverse=True)
+
+    remaining_bytes = sum(size for size, _ in sized_paths)
+    chunks = []
+    chunk, chunk_bytes = [], 0
+    for size, path in sized_paths:
+        if not chunk:
+            target_bytes = max(remaining_bytes // (max(workers, 1) * 4),
+                               MIN_CHUNK_BYTES)
+        chunk.append(path)
+        chunk_bytes += size
+        remaining_bytes -= size
+        if chunk_bytes >= target_bytes or len(chunk) >= MAX_CHUNK_FILES:
+            chunks.append(chunk)
+            chunk, chunk_bytes = [], 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def print_utilization(stats, seconds):
+    """Print how busy each indexing worker process was.
+
+    :arg stats: An iterable of :class:`ChunkStats`
+    :arg seconds: The wall-clock duration of the indexing
+
+    """
+    by_pid = bucket(stats, lambda s: s.pid)
+    print 'Worker utilization (busy time / wall time):'
+    for pid, worker_stats in sorted(by_pid.iteritems()):
+        busy = sum(s.seconds for s in worker_stats)
+        rss = max(s.rss for s in worker_stats)
+        print '    %-8s %3.0f%%  %s files in %s chunks, %s MB at most' % (
+            pid,
+            100 * busy / seconds if seconds else 100,
+            sum(s.files for s in worker_stats),
+            len(worker_stats),
+            '?' if rss is None else '%.0f' % (rss / 1024.0 / 1024))
 
 
 def _fill_and_write_template(jinja_env, template_name, out_path, vars):
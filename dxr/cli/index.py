@@ -1,6 +1,6 @@
-from click import command, option
+from click import ClickException, command, IntRange, option, Path
 
-from dxr.build import index_and_deploy_tree
+from dxr.build import index_and_deploy_trees
 from dxr.cli.utils import tree_objects, config_option, tree_names_argument
 
 
@@ -10,8 +10,42 @@ from dxr.cli.utils import tree_objects, config_option, tree_names_argument
         is_flag=True,
         help='Display the build logs during the build instead of only '
              'on error.')
+@option('--incremental', '-i',
+        is_flag=True,
+        help='Reindex only the files that changed since the currently '
+             'deployed index was built, copying the rest forward from it. '
+             'Fall back to a full index if that cannot be worked out.')
+@option('--resume', '-r',
+        is_flag=True,
+        help='Pick up an interrupted run where it left off, reindexing only '
+             'the files it did not finish. Also, if this run fails, keep '
+             'its partial index and build output so it can be resumed in '
+             'turn.')
+@option('--jobs', '-j',
+        type=IntRange(min=1),
+        default=1,
+        show_default=True,
+        help='The most trees to index at once. Trees also wait their turn '
+             'until their workers fit within the "workers" setting of the '
+             '[DXR] section.')
+@option('--max-es-requests',
+        type=IntRange(min=0),
+        default=0,
+        help='The most bulk requests to have in flight to elasticsearch at '
+             'once, across all trees and workers. Default: no limit')
+@option('--export',
+        'export_folder',
+        type=Path(file_okay=False, resolve_path=True),
+        help='Rather than indexing into elasticsearch, write each tree\'s '
+             'bulk requests into a folder named after it within this one, '
+             'for "dxr load" to send later.')
+@option('--gzip',
+        'gzip_export',
+        is_flag=True,
+        help='Compress the bulk requests written by --export.')
 @tree_names_argument
-def index(config, verbose, tree_names):
+def index(config, verbose, incremental, resume, jobs, max_es_requests,
+          export_folder, gzip_export, tree_names):
     """Build indices for one or more trees.
 
     When finished, update elasticsearch aliases and the catalog index to make
@@ -22,5 +56,37 @@ def index(config, verbose, tree_names):
     order they occur in the file.
 
     """
-    for tree in tree_objects(tree_names, config):
-        index_and_deploy_tree(tree, verbose=verbose)
+    trees = tree_objects(tree_names, config)
+    if export_folder and (incremental or resume):
+        raise ClickException("--export can't be used with --incremental or "
+                             "--resume, which work from an existing index.")
+    if gzip_export and not export_folder:
+        raise ClickException('--gzip goes only with --export.')
+    if jobs > 1:
+        if verbose:
+            raise ClickException("--verbose can't be used with --jobs, since "
+                                 "each tree's output goes to its own file.")
+        ensure_separate_folders(trees)
+    index_and_deploy_trees(trees,
+                           jobs=jobs,
+                           max_es_requests=max_es_requests,
+                           verbose=verbose,
+                           incremental=incremental,
+                           resume=resume,
+                           export_folder=export_folder,
+                           gzip_export=gzip_export)
+
+
+def ensure_separate_folders(trees):
+    """Raise ClickException if any trees share a folder they'd clobber each
+    other's files in if indexed at once."""
+    for attr in ['object_folder', 'temp_folder', 'log_folder']:
+        owners = {}
+        for tree in trees:
+            folder = getattr(tree, attr)
+            if folder in owners:
+                raise ClickException(
+                    "Trees '%s' and '%s' share the %s %s, so they can't be "
+                    "indexed at once." % (owners[folder], tree.name, attr,
+                                          folder))
+            owners[folder] = tree.name
@@ -0,0 +1,36 @@
+from os.path import isdir, join
+
+from click import argument, ClickException, command, Path
+
+from dxr.build import load_and_deploy_tree
+from dxr.cli.utils import tree_objects, config_option, tree_names_argument
+
+
+@command()
+@config_option
+@argument('export_folder',
+          metavar='FOLDER',
+          type=Path(exists=True, file_okay=False, resolve_path=True))
+@tree_names_argument
+def load(config, export_folder, tree_names):
+    """Load trees exported by "dxr index --export" into elasticsearch.
+
+    Send the bulk requests written to FOLDER by an earlier "dxr index
+    --export FOLDER" into new indices, and then update elasticsearch aliases
+    and the catalog index, just as "dxr index" does once it's done.
+
+    Each of TREES is an INI section title from the config file. If none are
+    specified, we load every tree FOLDER holds an export of, in the order
+    they occur in the file.
+
+    """
+    trees = tree_objects(tree_names, config)
+    if not tree_names:
+        trees = [tree for tree in trees
+                 if isdir(join(export_folder, tree.name))]
+    for tree in trees:
+        if not isdir(join(export_folder, tree.name)):
+            raise ClickException("There's no export of tree '%s' in %s." %
+                                 (tree.name, export_folder))
+    for tree in trees:
+        load_and_deploy_tree(tree, export_folder)
@@ -13,7 +13,7 @@ from configobj import ConfigObj
 from funcy import merge
 from more_itertools import first
 from pkg_resources import resource_string
-from schema import Optional, Use, And, Schema, SchemaError
+from schema import Optional, Or, Use, And, Schema, SchemaError
 
 from dxr.exceptions import ConfigError
 from dxr.plugins import all_plugins_but_core, core_plugin
@@ -104,15 +104,42 @@ class Config(DotSection):
                          default=datetime.utcnow()
                                          .strftime("%a, %d %b %Y %H:%M:%S +0000")):
                     basestring,
+                Optional('index_cache_folder', default=None): AbsPath,
                 Optional('log_folder', default=abspath('dxr-logs-{tree}')):
                     AbsPath,
                 Optional('workers', default=if_raises(NotImplementedError,
                                                       cpu_count,
                                                       1)):
                     WORKERS_VALIDATOR,
+                Optional('worker_max_files', default=0):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"worker_max_files" must be a non-negative '
+                              'integer.'),
+                Optional('worker_max_memory', default=0):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"worker_max_memory" must be a non-negative '
+                              'integer.'),
                 Optional('skip_stages', default=[]): WhitespaceList,
                 Optional('www_root', default=''): Use(lambda v: v.rstrip('/')),
                 Optional('google_analytics_key', default=''): basestring,
+                Optional('catalog_cache_ttl', default=10):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"catalog_cache_ttl" must be a non-negative '
+                              'integer.'),
+                Optional('search_cache_size', default=1000):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"search_cache_size" must be a non-negative '
+                              'integer.'),
+                Optional('search_cache_megabytes', default=50):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"search_cache_megabytes" must be a '
+                              'non-negative integer.'),
+                Optional('search_cache_servers', default=[]): WhitespaceList,
                 Optional('es_hosts', default='http://127.0.0.1:9200/'):
                     WhitespaceList,
                 # A semi-random name, having the tree name and format version in it.
@@ -124,6 +151,11 @@ class Config(DotSection):
                     basestring,
                 Optional('es_catalog_replicas', default=1):
                     Use(int, error='"es_catalog_replicas" must be an integer.'),
+                Optional('browse_lines', default=20000):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"browse_lines" must be a non-negative '
+                              'integer.'),
                 Optional('max_thumbnail_size', default=20000):
                     And(Use(int),
                         lambda v: v >= 0,
@@ -139,8 +171,32 @@ class Config(DotSection):
                         lambda v: v >= 0,
                         error='"es_indexing_retries" must be a non-negative '
                               'integer.'),
+                Optional('es_indexing_senders', default=1):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"es_indexing_senders" must be a non-negative '
+                              'integer.'),
+                Optional('es_shard_size', default=10240):
+                    And(Use(int),
+                        lambda v: v > 0,
+                        error='"es_shard_size" must be a positive integer.'),
                 Optional('es_refresh_interval', default=60):
-                    Use(int, error='"es_refresh_interval" must be an integer.')
+                    Use(int, error='"es_refresh_interval" must be an integer.'),
+                Optional('es_optimize_segments', default=0):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"es_optimize_segments" must be a non-negative '
+                              'integer.'),
+                Optional('es_optimize_rate', default=20):
+                    And(Use(int),
+                        lambda v: v > 0,
+                        error='"es_optimize_rate" must be a positive '
+                              'integer.'),
+                Optional('es_optimize_timeout', default=1800):
+                    And(Use(int),
+                        lambda v: v >= 0,
+                        error='"es_optimize_timeout" must be a non-negative '
+                              'integer.')
             },
             basestring: dict
         })
@@ -213,11 +269,17 @@ class TreeConfig(DotSectionWrapper):
             Optional('enabled_plugins', default=plugin_list('*')): Plugins,
             Optional('es_index', default=config.es_index): basestring,
             Optional('es_shards', default=5):
-                Use(int, error='"es_shards" must be an integer.'),
+                Or(And(basestring, lambda v: v == 'auto'),
+                   Use(int),
+                   error='"es_shards" must be an integer or "auto".'),
             Optional('ignore_patterns',
                      default=['.hg', '.git', 'CVS', '.svn', '.bzr',
                               '.deps', '.libs', '.DS_Store', '.nfs*', '*~',
                               '._*']): WhitespaceList,
+            Optional('line_block_size', default=0):
+                And(Use(int),
+                    lambda v: v >= 0,
+                    error='"line_block_size" must be a non-negative integer.'),
             Optional('object_folder', default=None): AbsPath,
             'source_folder': AbsPath,
             Optional('source_encoding', default='utf-8'): basestring,
@@ -1,5 +1,8 @@
 """Elasticsearch utilities not general enough to lift into pyelasticsearch"""
 
+from itertools import izip
+from time import time
+
 from flask import current_app
 from pyelasticsearch import ElasticHttpNotFoundError
 from werkzeug.exceptions import NotFound
@@ -33,15 +36,52 @@ UNINDEXED_LONG = {
 
 TREE = 'tree'  # 'tree' doctype
 
+# The doctype of blocks of consecutive lines, which, in trees with a
+# line_block_size, hold the content of every line and everything else it
+# takes to browse it. LINE docs are then made, without content, only for lines
+# with structural needles.
+LINE_BLOCK = 'line_block'
+
+# The per-line arrays which LINE_BLOCK docs hold for all their lines at once,
+# each item tagged with the ``number`` of its line
+BLOCKED_LINE_ARRAYS = ['refs', 'regions', 'annotations']
+
+# The doctype of ref payloads, which LINE docs point to by ID so each distinct
+# one is stored only once
+REF = 'ref'
+
+# The file-wide needles which are copied onto every LINE and LINE_BLOCK doc.
+# Only the unanalyzed path is, which the path, file, and ext filters match
+# with regexps. The rest of the file-wide needles live only on FILE docs.
+LINE_FILE_NEEDLES = ['path']
+
 
 def frozen_configs():
     """Return a list of dicts, each describing a tree of the current format
     version."""
-    return filtered_query(current_app.dxr_config.es_catalog_index,
-                          TREE,
-                          filter={'format': FORMAT},
-                          sort=['name'],
-                          size=10000)
+    return _catalog()[0]
+
+
+def _catalog():
+    """Return a list of the catalog's tree docs of the current format version,
+    and a dict of them by name.
+
+    The catalog is read at most once per ``catalog_cache_ttl`` seconds per
+    process. Every page wants it, so it otherwise sees more traffic than the
+    trees' own indices.
+
+    """
+    cached = current_app.catalog_cache
+    if cached and time() - cached[0] < current_app.dxr_config.catalog_cache_ttl:
+        return cached[1:]
+    trees = filtered_query(current_app.dxr_config.es_catalog_index,
+                           TREE,
+                           filter={'format': FORMAT},
+                           sort=['name'],
+                           size=10000)
+    trees_by_name = dict((tree['name'], tree) for tree in trees)
+    current_app.catalog_cache = time(), trees, trees_by_name
+    return trees, trees_by_name
 
 
 def frozen_config(tree_name):
@@ -51,6 +91,11 @@ def frozen_config(tree_name):
     version. Raise NotFound if the tree
 
     """
+    if current_app.dxr_config.catalog_cache_ttl:
+        frozen = _catalog()[1].get(tree_name)
+        if frozen is not None:
+            return frozen
+        # Maybe the tree was deployed since we read the catalog. Look.
     try:
         frozen = current_app.es.get(current_app.dxr_config.es_catalog_index,
                                     TREE,
@@ -78,8 +123,12 @@ def filtered_query(*args, **kwargs):
     return sources(filtered_query_hits(*args, **kwargs))
 
 
-def filtered_query_hits(index, doc_type, filter, sort=None, size=1, include=None, exclude=None):
-    """Do a simple, filtered term query, returning an iterable of hit hashes."""
+def filtered_query_hits(index, doc_type, filter, sort=None, size=1, include=None, exclude=None, range=None):
+    """Do a simple, filtered term query, returning an iterable of hit hashes.
+
+    :arg range: Additional conditions for a range filter, if any
+
+    """
     query = {
             'query': {
                 'filtered': {
@@ -92,6 +141,9 @@ def filtered_query_hits(index, doc_type, filter, sort=None, size=1, include=None
                 }
             }
         }
+    if range:
+        query['query']['filtered']['filter'] = {
+            'and': [{'term': filter}, {'range': range}]}
     if sort:
         query['sort'] = sort
     if include is not None:
@@ -105,6 +157,76 @@ def filtered_query_hits(index, doc_type, filter, sort=None, size=1, include=None
         size=size)['hits']['hits']
 
 
+def numbered_sources(index, doc_type, filter, include=None, page_size=1000,
+                     first=None, last=None):
+    """Yield the sources of the docs matching a term filter in order by their
+    ``number`` field, fetching them a page at a time.
+
+    Each page picks up after the greatest number in the last, so ES never has
+    to sort more than a page's worth of hits, and we never hold more than a
+    page of raw results at once. Docs with several numbers, like LINE_BLOCKs,
+    must not overlap.
+
+    :arg first: The least number to fetch docs for, if any
+    :arg last: The greatest number to fetch docs for, if any. Docs with
+        several numbers are fetched if any of them falls between ``first``
+        and ``last``.
+
+    """
+    after = None
+    while True:
+        range = {}
+        if after is not None:
+            range['gt'] = after
+        elif first is not None:
+            range['gte'] = first
+        if last is not None:
+            range['lte'] = last
+        hits = filtered_query_hits(
+            index,
+            doc_type,
+            filter,
+            sort=[{'number': {'order': 'asc', 'mode': 'max'}}],
+            size=page_size,
+            include=include,
+            range={'number': range} if range else None)
+        for hit in hits:
+            yield hit['_source']
+        if len(hits) < page_size:
+            break
+        after = hits[-1]['sort'][0]
+
+
+def scroll_hits(es, index, doc_type=None, query=None, size=500, scroll='5m'):
+    """Yield every hit of a query, however many there are, using ES's scan
+    and scroll API.
+
+    Hits come out in no particular order.
+
+    :arg query: An ES query, without the outer "query" key. Defaults to
+        matching everything.
+    :arg size: How many hits to fetch per shard per round trip
+    :arg scroll: How long ES should keep the scroll alive between round trips
+
+    """
+    result = es.search({'query': query or {'match_all': {}}},
+                       index=index,
+                       doc_type=doc_type,
+                       size=size,
+                       es_search_type='scan',
+                       es_scroll=scroll)
+    while True:
+        result = es.send_request('GET',
+                                 ['_search', 'scroll'],
+                                 body=result['_scroll_id'],
+                                 query_params={'scroll': scroll})
+        hits = result['hits']['hits']
+        if not hits:
+            break
+        for hit in hits:
+            yield hit
+
+
 def create_index_and_wait(es, index, settings=None):
     """Create a new index, and wait for all shards to become ready."""
     es.create_index(index, settings=settings)
@@ -117,3 +239,24 @@ def create_index_and_wait(es, index, settings=None):
 def sources(search_results):
     """Return just the _source attributes of some ES search results."""
     return [r['_source'] for r in search_results]
+
+
+def unblocked_lines(blocks):
+    """Yield (line number, content) for each line of some LINE_BLOCK docs'
+    sources."""
+    for block in blocks:
+        for number, content in izip(block['number'], block['content']):
+            yield number, content
+
+
+def unblocked_line_docs(block):
+    """Yield (line number, doc) for each line of a LINE_BLOCK doc's source,
+    each doc holding the line's content, dereferenced, and its part of the
+    BLOCKED_LINE_ARRAYS, as a LINE doc in a tree without blocks would."""
+    docs = dict((number, {'content': content}) for number, content in
+                unblocked_lines([block]))
+    for key in BLOCKED_LINE_ARRAYS:
+        for item in block.get(key, ()):
+            docs[item.pop('number')].setdefault(key, []).append(item)
+    for number in block['number']:
+        yield number, docs[number]
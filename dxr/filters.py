@@ -48,6 +48,16 @@ class Filter(object):
         filter
     :ivar is_identifier: Whether to include this filter in the "id:" aggregate
         filter
+    :ivar on_lines: Whether this FILE-domain filter can narrow down LINE and
+        LINE_BLOCK docs directly, through :meth:`line_filter()` on the path
+        copied onto them. Line queries otherwise resolve FILE filters by
+        looking up the paths of the files they match, which is fine for rare
+        needles but slow for ones matching much of the tree.
+    :ivar block_searchable: Whether this LINE-domain filter can narrow down
+        LINE_BLOCK docs, which hold only the content of runs of lines and a
+        few file-wide needles. Lines found through blocks are confirmed one at a
+        time with :meth:`highlight_content()`, so such filters must highlight
+        something on every line they match.
 
     """
     domain = LINE
@@ -55,6 +65,8 @@ class Filter(object):
     is_reference = False
     is_identifier = False
     union_only = False
+    on_lines = False
+    block_searchable = False
 
     def __init__(self, term, enabled_plugins):
         """This is a good place to parse the term's arg (if it requires further
@@ -87,6 +99,28 @@ class Filter(object):
         """
         raise NotImplementedError
 
+    def line_filter(self):
+        """Return the ES filter clause that applies my restrictions to LINE
+        and LINE_BLOCK docs, if :attr:`on_lines` is set.
+
+        The only file-wide needle those docs carry is the unanalyzed
+        ``path``, so this typically matches a ``regexp`` against that.
+
+        """
+        raise NotImplementedError
+
+    def block_filter(self):
+        """Return an ES filter clause that finds the LINE_BLOCK docs which may
+        hold lines I match, or None to let every block through.
+
+        It may be looser than :meth:`filter()`, since each line of the blocks
+        found is checked afterward. By default, this is :meth:`filter()` for
+        positive terms and nothing for negated ones, as a block which has a
+        matching line may still have others which don't.
+
+        """
+        return None if self._term['not'] else self.filter()
+
     def highlight_path(self, result):
         """Return an unsorted iterable of extents that should be highlighted in
         the ``path`` field of a search result.
@@ -353,6 +353,18 @@ class FileToSkim(PluginConfig):
 class FileToIndex(FileToSkim):
     """A source of search and rendering data about one source file"""
 
+    #: Whether my per-line output--:meth:`needles_by_line()`,
+    #: :meth:`~dxr.indexers.FileToSkim.refs()`,
+    #: :meth:`~dxr.indexers.FileToSkim.regions()`, and
+    #: :meth:`~dxr.indexers.FileToSkim.annotations_by_line()`--is determined
+    #: entirely by the file's path and contents, the plugin's configuration,
+    #: and the plugin's code. If this is true of every interesting indexer of
+    #: a file, the per-line output can be replayed from the on-disk index
+    #: cache (see ``index_cache_folder``) when the file hasn't changed. Leave
+    #: this False if you consult anything else, like the output of a
+    #: compiler run during the build.
+    cacheable = False
+
     def __init__(self, path, contents, plugin_name, tree):
         """Analyze a file or digest an analysis that happened at compile time.
 
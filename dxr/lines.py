@@ -6,7 +6,9 @@ Within this file, "tag" means a tuple of (file-wide offset, is_start, payload).
 
 """
 import cgi
-from itertools import chain
+from hashlib import sha1
+from heapq import merge
+from itertools import chain, tee
 try:
     from itertools import compress
 except ImportError:
@@ -96,18 +98,21 @@ class Ref(object):
         return ret
 
     @staticmethod
-    def es_to_triple(es_data, tree):
+    def es_to_triple(es_data, tree, payloads):
         """Convert ES-dwelling ref representation to a (start, end,
         :class:`~dxr.lines.Ref` subclass) triple.
 
-        Return a subclass of Ref, chosen according to the ES data. Into its
-        attributes "menu_data", "hover" and "qualname_hash", copy the ES
-        properties of the same names, JSON-decoding "menu_data" first.
+        Return a subclass of Ref, chosen according to the payload the ES data
+        points to. Into its attributes "menu_data", "hover" and
+        "qualname_hash", copy the payload's properties of the same names.
 
         :arg es_data: An item from the array under the 'refs' key of an ES LINE
             document
         :arg tree: The :class:`~dxr.config.TreeConfig` representing the tree
             from which the ``es_data`` was pulled
+        :arg payloads: A mapping of payload IDs to REF docs, with their
+            "menu_data" already JSON-decoded. Many refs share a payload, so
+            we decode each only once.
 
         """
         def ref_class(plugin, id):
@@ -121,12 +126,12 @@ class Ref(object):
                      'in the index but not found in the current '
                      'implementation. Ignored.' % (plugin, id))
 
-        payload = es_data['payload']
+        payload = payloads[es_data['payload']]
         cls = ref_class(payload['plugin'], payload['id'])
         return (es_data['start'],
                 es_data['end'],
                 cls(tree,
-                    json.loads(payload['menu_data']),
+                    payload['menu_data'],
                     hover=payload.get('hover'),
                     qualname_hash=payload.get('qualname_hash')))
 
@@ -174,6 +179,17 @@ class Ref(object):
         return u'</a>'
 
 
+def ref_payload_id(payload):
+    """Return the ID under which to store a ref's payload, as returned by
+    :meth:`Ref.es()`.
+
+    It's a hash of the payload, so identical ones, like those of every
+    reference to a popular function, are stored only once per tree.
+
+    """
+    return sha1(json.dumps(payload, sort_keys=True)).hexdigest()
+
+
 class Region(object):
     """A <span> tag with a CSS class, wrapped around a run of text"""
 
@@ -416,6 +432,13 @@ def remove_overlapping_refs(tags):
         del tags[i + 1:]
 
 
+def without_overlapping_refs(tags):
+    """Like :func:`remove_overlapping_refs()`, but filter an iterable lazily
+    rather than a list in place."""
+    tags, selectees = tee(tags)
+    return compress(tags, non_overlapping_refs(selectees))
+
+
 def nesting_order((point, is_start, payload)):
     """Return a sorting key that places coincident Line boundaries outermost,
     then Ref boundaries, and finally Region boundaries.
@@ -466,12 +489,21 @@ def finished_tags(lines, refs, regions):
 
     # balanced_tags undoes the sorting, but we tolerate that in html_lines().
     # Remark: this sort is the memory peak, but it is not a significant use of
-    # time in an indexing run.
-    tags = sorted(chain(tag_boundaries(chain(refs, regions)),
-                        line_boundaries(lines)),
-                  key=nesting_order)
-    remove_overlapping_refs(tags)
-    return balanced_tags(tags)
+    # time in an indexing run. Plugins emit refs and regions in no particular
+    # order, so we can't avoid holding them all at once, but we can keep it
+    # lean: line boundaries come out in order already, so they're merged in
+    # lazily rather than sorted, and we sort decorated tuples in place rather
+    # than using a key function, which would build a second list as big as
+    # the first. The index in each decoration keeps the sort stable and keeps
+    # payloads from ever being compared.
+    decorated = [nesting_order(tag) + (i, tag[2]) for i, tag in
+                 enumerate(tag_boundaries(chain(refs, regions)))]
+    decorated.sort()
+    tags = ((point, is_start, payload) for point, is_start, _, _, payload in
+            merge(decorated,
+                  (nesting_order(tag) + (0, tag[2]) for tag in
+                   line_boundaries(lines))))
+    return balanced_tags(without_overlapping_refs(tags))
 
 
 def tags_per_line(flat_tags):
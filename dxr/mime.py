@@ -1,3 +1,4 @@
+from codecs import decode, lookup
 from os.path import splitext
 
 from funcy import ichunks
@@ -5,6 +6,13 @@ from binaryornot.helpers import is_binary_string
 from chardet.universaldetector import UniversalDetector
 
 
+#: Bytes which, if they make up the whole of a sample, mean it's plain text
+_PLAIN_TEXT_BYTES = '\n\r\t\f\b' + ''.join(chr(c) for c in xrange(32, 127))
+
+#: How much of a file chardet gets to look at before it has to guess
+CHARDET_SAMPLE_SIZE = 64 * 1024
+
+
 def icon(path, is_binary=False):
     """Return the basename (no extension) of the icon file to use for a path."""
     root, ext = splitext(path)
@@ -14,37 +22,72 @@ def icon(path, is_binary=False):
     return class_name
 
 
-def decode_data(data, encoding_guess, can_be_binary=True):
+def is_binary_sample(sample):
+    """Return whether a string sample from the start of a file looks binary.
+
+    Plain ASCII text, which is most of what we see, is recognized with a
+    single C-level pass. Only samples with other bytes in them go to
+    binaryornot, which runs chardet over them.
+
+    """
+    if not sample.translate(None, _PLAIN_TEXT_BYTES):
+        return False
+    return is_binary_string(sample)
+
+
+def decode_data(data, encoding_guess, can_be_binary=True, sample_size=1024):
     """Given string data, return an (is_text, data) tuple, where data is
     returned as unicode if we think it's text and were able to determine an
     encoding for it.
     If can_be_binary is False, then skip the initial is_binary check.
+
+    :arg data: A str or anything else that supports the buffer protocol and
+        slicing, like an mmap
+    :arg sample_size: How many bytes from the start of the data to examine
+        when deciding whether it's binary
+
     """
-    if not (can_be_binary and is_binary_string(data[:1024])):
-        try:
-            # Try our default encoding.
-            data = data.decode(encoding_guess)
-            return True, data
-        except UnicodeDecodeError:
-            # Fall back to chardet - chardet is really slow, which is why we
-            # don't just do chardet from the start.
-            detector = UniversalDetector()
-            for chunk in ichunks(80, data):
-                detector.feed(chunk)
-                if detector.done:
-                    break
-            detector.close()
-            if detector.result['encoding']:
-                try:
-                    data = data.decode(detector.result['encoding'])
-                    return True, data
-                except (UnicodeDecodeError, LookupError):
-                    # Either we couldn't decode or chardet gave us an encoding
-                    # that python doesn't recognize (yes, it can do that).
-                    pass  # Leave data as str.
+    if not (can_be_binary and is_binary_sample(data[:sample_size])):
+        # Try our default encoding, then UTF-8; both are validated at C speed.
+        for encoding in unique_encodings([encoding_guess, 'utf-8']):
+            try:
+                return True, decode(data, encoding)
+            except UnicodeDecodeError:
+                pass
+        # Fall back to chardet - chardet is really slow, which is why we
+        # don't just do chardet from the start. Show it only a sample, since
+        # it can otherwise grind through the whole of a big file without
+        # ever making up its mind.
+        detector = UniversalDetector()
+        for chunk in ichunks(4096, data[:CHARDET_SAMPLE_SIZE]):
+            detector.feed(chunk)
+            if detector.done:
+                break
+        detector.close()
+        if detector.result['encoding']:
+            try:
+                return True, decode(data, detector.result['encoding'])
+            except (UnicodeDecodeError, LookupError):
+                # Either we couldn't decode or chardet gave us an encoding
+                # that python doesn't recognize (yes, it can do that).
+                pass  # Leave data as it was.
     return False, data
 
 
+def unique_encodings(encodings):
+    """Return the given encoding names in order, leaving out later aliases of
+    ones already seen."""
+    seen = set()
+    for encoding in encodings:
+        try:
+            name = lookup(encoding).name
+        except LookupError:
+            continue
+        if name not in seen:
+            seen.add(name)
+            yield encoding
+
+
 def is_binary_image(path):
     """Return whether the path points to an image without human-readable
     contents."""
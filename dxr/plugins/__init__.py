@@ -232,6 +232,12 @@ def direct_search(priority, domain=LINE):
     :arg domain: LINE if this searcher searches for individual lines, FILE if
         it searches for entire files
 
+    The function takes a query term and returns an ES filter clause for docs
+    of its domain, or None to pass. A LINE searcher which jumps to a line by
+    number can return a pair instead: a clause for the FILE doc of the file,
+    then the line number. That works whether or not the line has a LINE doc
+    of its own.
+
     """
     def decorator(searcher):
         searcher.direct_search_priority = priority
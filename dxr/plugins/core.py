@@ -13,7 +13,7 @@ from jinja2 import Markup
 from parsimonious import ParseError
 
 from dxr.es import (UNINDEXED_STRING, UNANALYZED_STRING, UNINDEXED_INT,
-                    UNINDEXED_LONG)
+                    UNINDEXED_LONG, REF)
 from dxr.exceptions import BadTerm
 from dxr.filters import Filter, negatable, FILE, LINE
 import dxr.indexers
@@ -22,7 +22,8 @@ from dxr.query import some_filters
 from dxr.plugins import direct_search
 from dxr.trigrammer import (regex_grammar, NGRAM_LENGTH, es_regex_filter,
                             NoTrigrams, PythonRegexVisitor)
-from dxr.utils import glob_to_regex, split_content_lines, unicode_for_display
+from dxr.utils import (es_regexp_escape, glob_to_es_regexp, glob_to_regex,
+                       split_content_lines, unicode_for_display)
 
 __all__ = ['mappings', 'analyzers', 'TextFilter', 'PathFilter', 'FilenameFilter',
            'ExtFilter', 'RegexpFilter', 'IdFilter', 'RefFilter']
@@ -114,13 +115,12 @@ mappings = {
             'enabled': False
         },
         'properties': {
-            'path': PATH_SEGMENT_MAPPING,
-            'file_name': PATH_SEGMENT_MAPPING,
-            'ext': UNANALYZED_STRING,
-            # TODO: After the query language refresh, use match_phrase_prefix
-            # queries on non-globbed paths, analyzing them with the path
-            # analyzer, for max perf. Perfect! Otherwise, fall back to trigram-
-            # accelerated substring or wildcard matching.
+            # The only file-wide needle copied here. The path, file, and ext
+            # filters match it with regexp filters, which walk the terms
+            # dictionary: one entry per file, however many lines it has. Line
+            # queries with other FILE filters look up the matching paths
+            # first and then filter lines on this.
+            'path': UNANALYZED_STRING,
 
             'number': {
                 'type': 'integer'
@@ -159,21 +159,7 @@ mappings = {
                 'type': 'object',
                 'start': UNINDEXED_INT,
                 'end': UNINDEXED_INT,
-                'payload': {
-                    'type': 'object',
-                    'properties': {
-                        'plugin': UNINDEXED_STRING,
-                        'id': UNINDEXED_STRING,  # Ref ID
-                        'menu_data': UNINDEXED_STRING,  # opaque to ES
-                        'hover': UNINDEXED_STRING,
-                        # Hash of qualname of the symbol we're hanging the
-                        # menu off of, if it is a symbol and we can come up
-                        # with a qualname. This powers the highlighting of
-                        # other occurrences of the symbol when you pull up the
-                        # context menu.
-                        'qualname_hash': UNINDEXED_LONG
-                    }
-                }
+                'payload': UNINDEXED_STRING,  # the ID of a REF doc
             },
 
             'regions': {
@@ -192,6 +178,25 @@ mappings = {
                 }
             }
         }
+    },
+
+    # The payloads of refs, stored once per tree under their hashes and
+    # pointed to from LINE docs
+    REF: {
+        '_all': {
+            'enabled': False
+        },
+        'properties': {
+            'plugin': UNINDEXED_STRING,
+            'id': UNINDEXED_STRING,  # Ref ID
+            'menu_data': UNINDEXED_STRING,  # opaque to ES
+            'hover': UNINDEXED_STRING,
+            # Hash of qualname of the symbol we're hanging the menu off of, if
+            # it is a symbol and we can come up with a qualname. This powers
+            # the highlighting of other occurrences of the symbol when you
+            # pull up the context menu.
+            'qualname_hash': UNINDEXED_LONG
+        }
     }
 }
 
@@ -253,6 +258,7 @@ class TextFilter(Filter):
     """Filter matching a run of plain text in a file"""
 
     name = 'text'
+    block_searchable = True
 
     @negatable
     def filter(self):
@@ -282,6 +288,7 @@ class TextFilter(Filter):
 class _PathSegmentFilterBase(Filter):
     """A base class for a filter that matches a glob against a path segment."""
     domain = FILE
+    on_lines = True
 
     def _regex_filter(self, path_seg_property_name, no_trigrams_error_text):
         """Return an ES regex filter that matches this filter's glob against the
@@ -297,6 +304,11 @@ class _PathSegmentFilterBase(Filter):
         except NoTrigrams:
             raise BadTerm(no_trigrams_error_text)
 
+    def _line_regexp(self, regexp):
+        """Return an ES filter matching a Lucene regexp against the whole
+        unanalyzed path copied onto LINE and LINE_BLOCK docs."""
+        return {'regexp': {'path': regexp}}
+
 
 class PathFilter(_PathSegmentFilterBase):
     """Substring filter for paths
@@ -316,6 +328,13 @@ class PathFilter(_PathSegmentFilterBase):
                                   'Path globs need at least 3 literal '
                                   'characters in a row for speed.')
 
+    @negatable
+    def line_filter(self):
+        return self._line_regexp(
+            u'.*%s.*' % glob_to_es_regexp(
+                self._term['arg'],
+                is_case_sensitive=self._term['case_sensitive']))
+
 
 class FilenameFilter(_PathSegmentFilterBase):
     """Substring filter for file names"""
@@ -330,12 +349,21 @@ class FilenameFilter(_PathSegmentFilterBase):
                                   'File globs need at least 3 literal '
                                   'characters in a row for speed.')
 
+    @negatable
+    def line_filter(self):
+        return self._line_regexp(
+            u'(.*/)?[^/]*%s[^/]*' % glob_to_es_regexp(
+                self._term['arg'],
+                is_case_sensitive=self._term['case_sensitive'],
+                within_segment=True))
+
 
 class ExtFilter(Filter):
     """Case-sensitive filter for exact matching on file extensions"""
 
     name = 'ext'
     domain = FILE
+    on_lines = True
     description = Markup('Filename extension: <code>ext:cpp</code>. Always '
                          'case-sensitive.')
     # The intersection of two different Ext filters would always be nothing.
@@ -343,11 +371,21 @@ class ExtFilter(Filter):
 
     @negatable
     def filter(self):
+        return {'term': {'ext': self._extension()}}
+
+    @negatable
+    def line_filter(self):
+        extension = self._extension()
+        if '.' in extension or '/' in extension:
+            # splitext() never makes such an extension.
+            return {'term': {'path': u''}}
+        # A leading run of dots doesn't start an extension, as in splitext().
+        return {'regexp': {'path': u'(.*/)?\\.*[^/.][^/]*\\.%s' %
+                                   es_regexp_escape(extension)}}
+
+    def _extension(self):
         extension = self._term['arg']
-        return {
-            'term': {'ext': extension[1:] if extension.startswith('.')
-                            else extension}
-        }
+        return extension[1:] if extension.startswith('.') else extension
 
 
 class RegexpFilter(Filter):
@@ -357,6 +395,7 @@ class RegexpFilter(Filter):
     description = Markup(r'Regular expression. Examples: '
                          r'<code>regexp:(?i)\bs?printf</code> '
                          r'<code>regexp:"(three|3) mice"</code>')
+    block_searchable = True
 
     def __init__(self, term, enabled_plugins):
         """Compile the Python equivalent of the regex so we don't have to lean
@@ -386,6 +425,26 @@ class RegexpFilter(Filter):
             raise BadTerm('Regexes need at least 3 literal characters in a  '
                           'row for speed.')
 
+    def block_filter(self):
+        """Find blocks by trigrams alone.
+
+        The script in :meth:`filter()` tests only the first element of the
+        content, which, in a block, is just its first line. We check the
+        lines ourselves instead.
+
+        """
+        if self._term['not']:
+            return None
+        try:
+            return es_regex_filter(
+                self._parsed_regex,
+                'content',
+                is_case_sensitive=self._term['case_sensitive'],
+                with_script=False)
+        except NoTrigrams:
+            raise BadTerm('Regexes need at least 3 literal characters in a  '
+                          'row for speed.')
+
     def highlight_content(self, result):
         return (m.span() for m in
                 self._compiled_regex.finditer(result['content'][0]))
@@ -398,8 +457,10 @@ class FilterAggregator(Filter):
     """
     def __init__(self, term, enabled_plugins, condition=None):
         super(FilterAggregator, self).__init__(term, enabled_plugins)
+        # Filters of the other domain would query needles our docs lack:
         self.filters = [f(term, enabled_plugins) for f in
-                        some_filters(enabled_plugins, condition)]
+                        some_filters(enabled_plugins, condition)
+                        if f.domain == self.domain]
 
     def filter(self):
         # OR together all the underlying filters.
@@ -464,6 +525,8 @@ class TreeToIndex(dxr.indexers.TreeToIndex):
 
 
 class FileToIndex(dxr.indexers.FileToIndex):
+    cacheable = True
+
     def __init__(self, path, contents, plugin_name, tree, vcs):
         super(FileToIndex, self).__init__(path, contents, plugin_name, tree)
         self.vcs = vcs
@@ -606,12 +669,7 @@ def direct_path_and_line(term):
     except NoTrigrams:
         return None
 
-    return {
-        'and': [
-            trigram_clause,
-            {'term': {'number': line}}
-        ]
-    }
+    return trigram_clause, line
 
 
 @direct_search(priority=150, domain=FILE)
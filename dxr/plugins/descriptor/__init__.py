@@ -56,6 +56,8 @@ class FolderToIndex(dxr.indexers.FolderToIndex):
 class FileToIndex(dxr.indexers.FileToIndex):
     """Do lots of work to yield a description needle."""
 
+    cacheable = True
+
     # comment_re matches C-style block comments:
     comment_re = re.compile(r'^(/\*[*\s]*)(?P<description>(\*(?!/)|[^*])*)\*/', flags=re.M)
     docstring_res = [re.compile(r'"""\s*(?P<description>[^"]*)"""', flags=re.M),
@@ -36,6 +36,8 @@ class TreeToIndex(TreeToIndexBase):
 
 
 class FileToIndex(FileToIndexBase):
+    cacheable = True
+
     def __init__(self, path, contents, plugin_name, tree, ext_pairings):
         super(FileToIndex, self).__init__(path, contents, plugin_name, tree)
         self.ext_pairings = ext_pairings
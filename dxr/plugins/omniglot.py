@@ -18,6 +18,8 @@ class TreeToIndex(dxr.indexers.TreeToIndex):
 class FileToIndex(dxr.indexers.FileToIndex):
     """Adder of blame and external links to items under version control"""
 
+    cacheable = True
+
     def __init__(self, path, contents, plugin_name, tree, vcs):
         super(FileToIndex, self).__init__(path, contents, plugin_name, tree)
         self.vcs = vcs
@@ -99,6 +99,8 @@ def _regions_for_contents(lexer, contents):
 class FileToIndex(dxr.indexers.FileToIndex):
     """Emitter of CSS classes for syntax-highlit regions"""
 
+    cacheable = True
+
     def regions(self):
         lexer = _lexer_for_filename(basename(self.path))
         if lexer:
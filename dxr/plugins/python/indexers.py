@@ -5,7 +5,7 @@ from os.path import islink
 from StringIO import StringIO
 from itertools import izip
 
-from dxr.build import unignored
+from dxr.build import load_manifest
 from dxr.filters import FILE, LINE
 from dxr.indexers import (Extent, FileToIndex as FileToIndexBase,
                           iterable_per_line, Position, split_into_lines,
@@ -52,8 +52,7 @@ FILE_TO_IGNORE = _FileToIgnore()
 class TreeToIndex(TreeToIndexBase):
     @property
     def unignored_files(self):
-        return unignored(self.tree.source_folder, self.tree.ignore_paths,
-                         self.tree.ignore_filenames)
+        return (f.path for f in load_manifest(self.tree).files)
 
     def post_build(self):
         paths = ((path, self.tree.source_encoding)
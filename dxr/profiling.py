@@ -0,0 +1,139 @@
+"""Cheap, always-on accounting of where the time goes during indexing
+
+A :class:`Profile` keeps running totals under keys like ``('plugin', 'clang',
+'refs')``. Workers ship their :attr:`Profile.totals` back to the master, which
+merges them and writes a report with :func:`write_report()`.
+
+"""
+from contextlib import contextmanager
+import json
+from threading import Lock
+from time import clock, time
+
+
+# Indices into a totals entry:
+CALLS, WALL, CPU, DOCS, BYTES = range(5)
+
+
+class Profile(object):
+    """Running totals of calls, wall time, CPU time, and doc and byte counts
+
+    Timings are exclusive: time spent in a timed section nested inside another
+    counts only toward the inner one. That lets us tell the cost of, say, tag
+    balancing apart from that of the plugins whose refs it pulls lazily.
+
+    CPU time is that of the whole process, so it includes any threads (like
+    :class:`~dxr.build.BulkSender`'s) that run alongside.
+
+    :meth:`timed()` and :meth:`timed_iter()` must be used from a single
+    thread; other threads should stick to :meth:`add()`.
+
+    """
+    def __init__(self):
+        #: {key: [calls, wall seconds, CPU seconds, docs, bytes]}
+        self.totals = {}
+        self._stack = []  # [wall, CPU] spent in nested sections
+        self._lock = Lock()
+
+    def add(self, key, calls=1, wall=0, cpu=0, docs=0, bytes=0):
+        """Add to the totals for a key."""
+        with self._lock:
+            entry = self.totals.get(key)
+            if entry is None:
+                entry = self.totals[key] = [0, 0, 0, 0, 0]
+            entry[CALLS] += calls
+            entry[WALL] += wall
+            entry[CPU] += cpu
+            entry[DOCS] += docs
+            entry[BYTES] += bytes
+
+    @contextmanager
+    def timed(self, key, calls=1, docs=0, bytes=0):
+        """Charge the time spent within the block to a key."""
+        self._stack.append([0, 0])
+        start_wall, start_cpu = time(), clock()
+        try:
+            yield
+        finally:
+            wall, cpu = time() - start_wall, clock() - start_cpu
+            nested_wall, nested_cpu = self._stack.pop()
+            if self._stack:
+                self._stack[-1][0] += wall
+                self._stack[-1][1] += cpu
+            self.add(key,
+                     calls=calls,
+                     wall=wall - nested_wall,
+                     cpu=cpu - nested_cpu,
+                     docs=docs,
+                     bytes=bytes)
+
+    @contextmanager
+    def clocked(self, key, docs=0, bytes=0):
+        """Charge the wall time spent within the block to a key.
+
+        Unlike :meth:`timed()`, this is safe to use from any thread. It
+        doesn't take part in exclusive timing, so don't nest it inside a
+        :meth:`timed()` block on the same thread.
+
+        """
+        start = time()
+        try:
+            yield
+        finally:
+            self.add(key, wall=time() - start, docs=docs, bytes=bytes)
+
+    def timed_iter(self, key, make_iterable):
+        """Call ``make_iterable``, and return an iterator over its result,
+        charging both the call and every step of the iteration to a key.
+
+        Lazy generators do their real work as they're iterated, so timing
+        just the call would miss it.
+
+        """
+        with self.timed(key):
+            iterator = iter(make_iterable())
+        return self._timed_steps(key, iterator)
+
+    def _timed_steps(self, key, iterator):
+        while True:
+            with self.timed(key, calls=0):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def merge(self, totals):
+        """Add another profile's :attr:`totals` to ours."""
+        for key, entry in totals.iteritems():
+            self.add(key, *entry)
+
+
+def _entry_json(entry):
+    """Return a readable dict of a totals entry, leaving out zero counts."""
+    result = {'calls': entry[CALLS],
+              'wall_seconds': round(entry[WALL], 3),
+              'cpu_seconds': round(entry[CPU], 3)}
+    if entry[DOCS]:
+        result['docs'] = entry[DOCS]
+    if entry[BYTES]:
+        result['bytes'] = entry[BYTES]
+    return result
+
+
+def report(totals, **extras):
+    """Return a JSON-ready dict of profile totals, nested by the parts of
+    their keys, plus any extra top-level items."""
+    result = dict(extras)
+    for key, entry in sorted(totals.iteritems()):
+        branch = result
+        for part in key[:-1]:
+            branch = branch.setdefault(part, {})
+        branch[key[-1]] = _entry_json(entry)
+    return result
+
+
+def write_report(path, totals, **extras):
+    """Write :func:`report()` output to a file as JSON."""
+    with open(path, 'w') as file:
+        json.dump(report(totals, **extras), file, indent=2, sort_keys=True)
@@ -5,6 +5,7 @@ import re
 
 from parsimonious import Grammar, NodeVisitor
 
+from dxr.es import LINE_BLOCK, unblocked_lines
 from dxr.filters import LINE, FILE
 from dxr.mime import icon
 from dxr.utils import append_update, cached
@@ -29,12 +30,38 @@ def direct_searchers(plugins):
     return [searcher for searcher, _ in sortables]
 
 
+# How many LINE_BLOCK docs to fetch at a time when finding lines through them
+BLOCK_BATCH_SIZE = 100
+
+# The most LINE_BLOCK docs to page through for one page of results, lest a
+# regex with common trigrams have us scan every block in the tree
+MAX_SCANNED_BLOCKS = 2000
+
+# How many LINE docs to fetch at a time, and the most to page through, when
+# finding lines through them in a tree with blocks means checking text terms
+# against content fetched from the blocks
+LINE_BATCH_SIZE = 500
+MAX_SCANNED_LINES = 20000
+
+# How many paths to ask for at a time when resolving FILE-domain filters for a
+# line query. Broad ones take a page per this many matching files; it's the
+# path:, file:, and ext: filters, the common broad ones, which skip this by
+# matching lines directly.
+PATH_BATCH_SIZE = 1000
+
+
 class Query(object):
     """Query object, constructor will parse any search query"""
 
-    def __init__(self, es_search, querystr, enabled_plugins):
+    def __init__(self, es_search, querystr, enabled_plugins, line_block_size=0):
+        """
+        :arg line_block_size: The tree's ``line_block_size``. If nonzero, text
+            and regex searches go through its LINE_BLOCK docs.
+
+        """
         self.es_search = es_search
         self.enabled_plugins = list(enabled_plugins)
+        self.line_block_size = line_block_size
 
         # A list of dicts describing query terms:
         grammar = query_grammar(self.enabled_plugins)
@@ -126,37 +153,43 @@ class Query(object):
         is_line_query = any(f.domain == LINE for f in
                             chain.from_iterable(filters))
 
-        # An ORed-together ball for each term's filters, omitting filters that
-        # punt by returning {} and ors that contain nothing but punts:
-        ors = filter(None, [filter(None, (f.filter() for f in term))
-                            for term in filters])
-        ors = [{'or': x} for x in ors]
+        path_highlighters = [f.highlight_path for f in chain.from_iterable(filters)
+                             if hasattr(f, 'highlight_path')]
 
-        if not is_line_query:
+        if (is_line_query and self.line_block_size and
+                self._blocks_searchable(filters)):
+            result_count, results = self._block_query_results(filters,
+                                                              offset,
+                                                              limit)
+            return {'result_count': result_count,
+                    'results': self._line_query_results(filters,
+                                                        results,
+                                                        path_highlighters)}
+
+        if is_line_query and self.line_block_size:
+            result_count, results = self._structural_query_results(filters,
+                                                                   offset,
+                                                                   limit)
+            return {'result_count': result_count,
+                    'results': self._line_query_results(filters,
+                                                        results,
+                                                        path_highlighters)}
+
+        if is_line_query:
+            ors = self._line_ors(filters, lambda f: f.filter())
+        else:
+            # An ORed-together ball for each term's filters, omitting filters
+            # that punt by returning {} and ors that contain nothing but
+            # punts:
+            ors = _ors(filters, lambda f: f.filter())
             # Don't show folders yet in search results. I don't think the JS
             # is able to handle them.
             ors.append({'term': {'is_folder': False}})
             # Filter out all FILE docs who are links.
             ors.append({'not': {'exists': {'field': 'link'}}})
 
-        if ors:
-            query = {
-                'filtered': {
-                    'query': {
-                        'match_all': {}
-                    },
-                    'filter': {
-                        'and': ors
-                    }
-                }
-            }
-        else:
-            query = {
-                'match_all': {}
-            }
-
         results = self.es_search(
-            {'query': query,
+            {'query': _filtered_query(ors),
              'sort': ['path', 'number'] if is_line_query else ['path'],
              'from': offset,
              'size': limit},
@@ -164,8 +197,6 @@ class Query(object):
         result_count = results['total']
         results = [r['_source'] for r in results['hits']]
 
-        path_highlighters = [f.highlight_path for f in chain.from_iterable(filters)
-                             if hasattr(f, 'highlight_path')]
         return {'result_count': result_count,
                 'results': self._line_query_results(filters, results, path_highlighters)
                            if is_line_query
@@ -173,6 +204,246 @@ class Query(object):
 
         # Test: If var-ref (or any structural query) returns 2 refs on one line, they should both get highlit.
 
+    def _line_ors(self, filters, es_filter):
+        """Return ORed-together balls for each term's filters, as for
+        :func:`_ors()`, but fit for querying LINE or LINE_BLOCK docs.
+
+        Most file-wide needles live only on FILE docs, so we look up the
+        paths of the files each term's FILE-domain filters match, and stand a
+        filter on those paths in for them. Filters which can match the path
+        copied onto lines apply directly.
+
+        :arg es_filter: A callable returning a LINE-domain Filter's ES clause
+
+        """
+        def line_filters(term_filters):
+            file_clauses = []
+            for f in term_filters:
+                if f.domain == LINE:
+                    yield es_filter(f)
+                elif f.on_lines:
+                    yield f.line_filter()
+                else:
+                    file_clauses.append(f.filter())
+            file_clauses = filter(None, file_clauses)
+            if file_clauses:
+                yield self._path_filter({'or': file_clauses})
+
+        return [{'or': x} for x in
+                filter(None, [filter(None, line_filters(term_filters))
+                              for term_filters in filters])]
+
+    def _path_filter(self, file_clause):
+        """Return an ES filter clause that finds the LINE or LINE_BLOCK docs
+        of the files a FILE-domain one does.
+
+        Page through the paths of however many files match, so a broad
+        filter costs a round trip per :const:`PATH_BATCH_SIZE` of them.
+
+        """
+        # Negated filters would match nearly every file. Look up the few they
+        # exclude instead.
+        clauses = file_clause.get('or', [file_clause])
+        negated = all(c.keys() == ['not'] for c in clauses)
+        if negated:
+            file_clause = {'and': [c['not'] for c in clauses]}
+
+        query = {'query': _filtered_query([file_clause,
+                                           {'term': {'is_folder': False}}]),
+                 '_source': {'include': ['path']},
+                 # A stable order keeps pages from overlapping.
+                 'sort': ['path'],
+                 'size': PATH_BATCH_SIZE}
+        paths = []
+        while True:
+            query['from'] = len(paths)
+            hits = self.es_search(query, doc_type=FILE)['hits']
+            paths.extend(hit['_source']['path'][0] for hit in hits['hits'])
+            if not hits['hits'] or len(paths) >= hits['total']:
+                break
+        clause = {'terms': {'path': paths}}
+        return {'not': clause} if negated else clause
+
+    def _blocks_searchable(self, filters):
+        """Return whether a line query can be run against LINE_BLOCK docs.
+
+        Every LINE filter has to be checkable against the content of a line
+        alone, except in negated terms, which :meth:`_block_query_results()`
+        checks against the LINE docs of the lines it finds. The union_only
+        filters at the end of ``filters`` are all FILE-domain, so zip() can
+        drop them.
+
+        """
+        return all(f.domain == FILE or f.block_searchable or term['not']
+                   for term, term_filters in zip(self.terms, filters)
+                   for f in term_filters)
+
+    def _block_query_results(self, filters, offset, limit):
+        """Find lines through the LINE_BLOCK docs, which hold the content of
+        every line, a run of them per doc.
+
+        The blocks ES finds may hold lines which don't match, so we check each
+        line with the highlighters of its terms' LINE-domain filters, as only
+        the blocks worth checking can be told apart by ES. Negated terms whose
+        filters need needles the blocks lack rule out the lines that have
+        LINE docs matching them. We page through the blocks until we have
+        ``offset + limit`` matching lines or have seen
+        ``MAX_SCANNED_BLOCKS``.
+
+        Return the count of results and a list of docs, one per line found,
+        as :meth:`_scanned_lines()` does.
+
+        """
+        ors = self._line_ors(filters, lambda f: f.block_filter())
+        # Terms, each with the LINE filters a line must (or, if the term is
+        # negated, must not) have highlights from, and the ES clauses of
+        # what lines must not have LINE docs matching:
+        checked_terms, excluding_clauses = [], []
+        for term, term_filters in zip(self.terms, filters):
+            line_filters = [f for f in term_filters if f.domain == LINE]
+            if all(f.block_searchable for f in line_filters):
+                if line_filters:
+                    checked_terms.append((term['not'], line_filters))
+            else:
+                positive_term = dict(term, **{'not': False})
+                excluding_clauses.extend(
+                    type(f)(positive_term, self.enabled_plugins).filter()
+                    for f in line_filters)
+        excluding_clauses = filter(None, excluding_clauses)
+
+        def matching_lines(blocks):
+            candidates = [line for line in
+                          ({'path': block['path'],
+                            'number': [number],
+                            'content': [content]}
+                           for block in blocks
+                           for number, content in unblocked_lines([block]))
+                          if _matches(line, checked_terms)]
+            if excluding_clauses and candidates:
+                excluded = self._lines_matching(candidates, excluding_clauses)
+                candidates = [c for c in candidates if
+                              (c['path'][0], c['number'][0]) not in excluded]
+            return candidates
+
+        return self._scanned_lines(LINE_BLOCK, ors, matching_lines, offset,
+                                   limit, BLOCK_BATCH_SIZE, MAX_SCANNED_BLOCKS)
+
+    def _structural_query_results(self, filters, offset, limit):
+        """Find lines through their LINE docs in a tree with blocks, where
+        only lines with structural needles have those, and they lack content.
+
+        Text terms can't be answered by such LINE docs, so we find the lines
+        matching the rest, fetch their content from their blocks, and check
+        each against the text terms with their filters' highlighters. That
+        means paging through the LINE docs as :meth:`_block_query_results()`
+        does through blocks, up to ``MAX_SCANNED_LINES``. Without text terms,
+        one page of LINE docs does, and the count is exact.
+
+        Return the count of results and a list of docs, one per line found.
+
+        """
+        # Terms with any content filter are checked line by line. The
+        # union_only filters at the end of ``filters`` are all FILE-domain,
+        # so they go to ES:
+        checked_terms, es_filters = [], []
+        for i, term_filters in enumerate(filters):
+            if (i < len(self.terms) and
+                    any(f.block_searchable for f in term_filters)):
+                checked_terms.append((self.terms[i]['not'],
+                                      [f for f in term_filters
+                                       if f.domain == LINE]))
+            else:
+                es_filters.append(term_filters)
+        ors = self._line_ors(es_filters, lambda f: f.filter())
+
+        if not checked_terms:
+            hits = self.es_search(
+                {'query': _filtered_query(ors),
+                 'sort': ['path', 'number'],
+                 'from': offset,
+                 'size': limit},
+                doc_type=LINE)['hits']
+            return hits['total'], self._with_block_content(
+                [hit['_source'] for hit in hits['hits']])
+
+        def matching_lines(lines):
+            return [line for line in self._with_block_content(lines)
+                    if _matches(line, checked_terms)]
+
+        return self._scanned_lines(LINE, ors, matching_lines, offset, limit,
+                                   LINE_BATCH_SIZE, MAX_SCANNED_LINES)
+
+    def _scanned_lines(self, doc_type, ors, matching_lines, offset, limit,
+                       batch_size, max_scanned):
+        """Page through the docs of a type which an ES query finds, picking
+        out the lines that really match from each page, until we have
+        ``offset + limit`` of them or have seen ``max_scanned`` docs.
+
+        Return the count of results and a list of docs, one per line found.
+        The count is exact if we got through all the docs and, if we gave up
+        partway, is the number we found. If we stopped because we had enough,
+        it's an estimate, scaled up from the docs we saw to all of them.
+
+        :arg matching_lines: A callable which takes a page of doc sources and
+            returns a list of docs for the matching lines they hold
+
+        """
+        found, lines = 0, []
+        scanned = total = 0
+        while found < offset + limit and scanned < max_scanned:
+            hits = self.es_search(
+                {'query': _filtered_query(ors),
+                 'sort': ['path', 'number'],
+                 'from': scanned,
+                 'size': min(batch_size, max_scanned - scanned)},
+                doc_type=doc_type)['hits']
+            total = hits['total']
+            if not hits['hits']:
+                break
+            scanned += len(hits['hits'])
+            for line in matching_lines([hit['_source']
+                                        for hit in hits['hits']]):
+                if offset <= found < offset + limit:
+                    lines.append(line)
+                found += 1
+            if scanned >= total:
+                break
+        if scanned < total and found >= offset + limit:
+            return found * total // scanned, lines
+        return found, lines
+
+    def _lines_matching(self, lines, clauses):
+        """Return a set of the (path, number) pairs of those of some lines
+        whose LINE docs match any of some ES filter clauses."""
+        hits = self.es_search(
+            {'query': _filtered_query([_lines_clause(lines),
+                                       {'or': clauses}]),
+             '_source': {'include': ['path', 'number']},
+             'size': len(lines)},
+            doc_type=LINE)['hits']['hits']
+        return set((hit['_source']['path'][0], hit['_source']['number'][0])
+                   for hit in hits)
+
+    def _with_block_content(self, lines):
+        """Fill in the content of some LINE docs from their LINE_BLOCK docs,
+        in a tree with blocks, and return them."""
+        if not lines:
+            return lines
+        hits = self.es_search(
+            {'query': _filtered_query([_lines_clause(lines)]),
+             '_source': {'include': ['path', 'number', 'content']},
+             # No more blocks than lines can hold them.
+             'size': len(lines)},
+            doc_type=LINE_BLOCK)['hits']['hits']
+        contents = dict(((hit['_source']['path'][0], number), content)
+                        for hit in hits
+                        for number, content in
+                            unblocked_lines([hit['_source']]))
+        for line in lines:
+            line['content'] = [contents.get(
+                (line['path'][0], line['number'][0]), u'')]
+        return lines
+
     def direct_result(self):
         """Return a single search result that is an exact match for the query.
 
@@ -187,7 +458,10 @@ class Query(object):
 
         for searcher in direct_searchers(self.enabled_plugins):
             clause = searcher(term)
-            if clause:
+            if isinstance(clause, tuple):
+                # A FILE clause to pick a file by and a line number within it:
+                results = self._numbered_lines(*clause)
+            elif clause:
                 results = self.es_search(
                     {
                         'query': {
@@ -201,13 +475,95 @@ class Query(object):
                         'size': 2
                     },
                     doc_type=searcher.domain)['hits']['hits']
-                if len(results) == 1:
-                    result = results[0]['_source']
-                    # Everything is stored as arrays in ES. Pull it all out:
-                    return (result['path'][0],
-                            result['number'][0] if searcher.domain == LINE else None)
-                elif len(results) > 1:
-                    return None
+                # Everything is stored as arrays in ES. Pull it all out:
+                results = [(r['_source']['path'][0],
+                            r['_source']['number'][0]
+                            if searcher.domain == LINE else None)
+                           for r in results]
+            else:
+                continue
+            if len(results) == 1:
+                return results[0]
+            elif len(results) > 1:
+                return None
+
+    def _numbered_lines(self, file_clause, number):
+        """Return a list of (path, line number) of the line of a given number
+        in each of the files a FILE clause finds, as long as it finds no more
+        than one. Otherwise, return a list of two.
+
+        """
+        files = self.es_search(
+            {'query': _filtered_query([file_clause,
+                                       {'term': {'is_folder': False}}]),
+             '_source': {'include': ['path']},
+             'size': 2},
+            doc_type=FILE)['hits']['hits']
+        if len(files) != 1:
+            return [(f['_source']['path'][0], number) for f in files]
+        path = files[0]['_source']['path'][0]
+        # In trees with blocks, only they are sure to have every line:
+        lines = self.es_search(
+            {'query': _filtered_query([{'term': {'path': path}},
+                                       {'term': {'number': number}}]),
+             '_source': False,
+             'size': 1},
+            doc_type=LINE_BLOCK if self.line_block_size else LINE)['hits']
+        return [(path, number)] if lines['total'] else []
+
+
+def _matches(line, checked_terms):
+    """Return whether a line doc has highlights from some filter of each of
+    some terms, or, for negated ones, from none.
+
+    :arg checked_terms: An iterable of (whether the term is negated, its
+        LINE-domain filters)
+
+    """
+    return all(any(any(True for _ in f.highlight_content(line))
+                   for f in term_filters) != negated
+               for negated, term_filters in checked_terms)
+
+
+def _lines_clause(lines):
+    """Return an ES filter clause that finds the docs of some lines, given
+    their docs from some other type, by path and number."""
+    numbers_by_path = {}
+    for line in lines:
+        numbers_by_path.setdefault(line['path'][0], []).append(
+            line['number'][0])
+    return {'or': [{'and': [{'term': {'path': path}},
+                            {'terms': {'number': numbers}}]}
+                   for path, numbers in numbers_by_path.iteritems()]}
+
+
+def _ors(filters, es_filter):
+    """Return a list of ES "or" clauses, one for each term's filters, omitting
+    filters that punt by returning {} and ors that contain nothing but
+    punts.
+
+    :arg es_filter: A callable returning a Filter's ES clause
+
+    """
+    return [{'or': x} for x in
+            filter(None, [filter(None, (es_filter(f) for f in term))
+                          for term in filters])]
+
+
+def _filtered_query(ors):
+    """Return an ES query that ANDs together some filter clauses."""
+    if ors:
+        return {
+            'filtered': {
+                'query': {
+                    'match_all': {}
+                },
+                'filter': {
+                    'and': ors
+                }
+            }
+        }
+    return {'match_all': {}}
 
 
 @cached
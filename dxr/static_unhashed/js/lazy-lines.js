@@ -0,0 +1,116 @@
+/* jshint devel:true */
+/* globals $ */
+
+/**
+ * Big files' browse pages come with only their first lines rendered. Fetch
+ * the rest, a batch at a time, as the page is scrolled toward the bottom, and
+ * fetch straight through to any lines named in window.location.hash.
+ */
+
+$(function () {
+    'use strict';
+    var file = $('#file'),
+        url = file.data('more-lines');
+
+    if (!url) {
+        return;  // The whole file is already here.
+    }
+
+    var lineCount = file.data('line-count'),
+        offset = file.data('offset'),  // where the next line starts in the file
+        batchSize = lineCount,  // Fetch about a page's worth at a time.
+        annotationSets = $('#annotations'),
+        lineNumbers = $('#line-numbers'),
+        code = $('#file .code pre'),
+        docElem = document.documentElement,
+        loading = false,
+        done = false,
+        didScroll = true;
+
+    /**
+     * Add some rendered lines to the end of the page.
+     * @param {Array} lines - The HTML of each line
+     * @param {Array} annotations - The annotations of each line: for each, an
+     *     array of objects mapping attribute names to values
+     */
+    function appendLines(lines, annotations) {
+        var numberHtml = [],
+            codeHtml = [],
+            sets = [];
+        for (var i = 0; i < lines.length; i++) {
+            lineCount++;
+            var set = $('<div class="annotation-set">').attr('id', 'aset-' + lineCount);
+            for (var j = 0; j < annotations[i].length; j++) {
+                set.append($('<div>').attr(annotations[i][j]));
+            }
+            sets.push(set);
+            numberHtml.push('<span id="' + lineCount + '" class="line-number" unselectable="on" rel="#' + lineCount + '">' + lineCount + '</span>');
+            codeHtml.push('<code id="line-' + lineCount + '" aria-labelledby="' + lineCount + '">' + lines[i] + '</code>');
+        }
+        annotationSets.append(sets);
+        lineNumbers.append(numberHtml.join('\n'));
+        code.append(codeHtml.join(''));
+    }
+
+    /**
+     * Fetch and add the lines from the end of the page through a given one,
+     * a batch at a time, since the server returns only so many at once.
+     * @param {int} lastLine - The number of the last line to fetch
+     * @param {function} then - Something to call once they're added
+     */
+    function loadThrough(lastLine, then) {
+        loading = true;
+        $.ajax({
+            dataType: 'json',
+            url: url,
+            data: {start: lineCount + 1, end: lastLine, offset: offset},
+            success: function (data) {
+                appendLines(data.lines, data.annotations);
+                offset = data.offset;
+                done = !data.more;
+                if (!done && lineCount < lastLine) {
+                    loadThrough(lastLine, then);
+                    return;
+                }
+                loading = false;
+                if (then) {
+                    then();
+                }
+            },
+            error: function () {
+                // Try again on the next scroll.
+                loading = false;
+            }
+        });
+    }
+
+    function loadNearBottom() {
+        if (!didScroll || loading || done) {
+            return;
+        }
+        didScroll = false;
+        var maxScrollY = window.scrollMaxY || (docElem.scrollHeight - window.innerHeight);
+        if ((maxScrollY - window.scrollY) < window.innerHeight + 500) {
+            loadThrough(lineCount + batchSize);
+        }
+    }
+
+    $(window).scroll(function () {
+        didScroll = true;
+    });
+    setInterval(loadNearBottom, 250);
+
+    // If the hash names lines we don't have yet, fetch through them, and then
+    // have code-highlighter.js highlight and scroll to them.
+    var hashLines = window.location.hash.substring(1).match(/[0-9]+/g);
+    if (hashLines !== null) {
+        var lastHashLine = Math.max.apply(null, hashLines.map(function (line) {
+            return parseInt(line, 10);
+        }));
+        if (lastHashLine > lineCount) {
+            loadThrough(lastHashLine + batchSize, function () {
+                $(window).trigger('popstate');
+            });
+        }
+    }
+});
@@ -546,7 +546,8 @@ def boolean_filter_tree(substrings, trigram_field):
     }
 
 
-def es_regex_filter(parsed_regex, raw_field, is_case_sensitive):
+def es_regex_filter(parsed_regex, raw_field, is_case_sensitive,
+                    with_script=True):
     """Return an efficient ES filter to find matches to a regex.
 
     Looks for fields of which ``regex`` matches a substring. (^ and $ do
@@ -559,6 +560,9 @@ def es_regex_filter(parsed_regex, raw_field, is_case_sensitive):
         raw_field.trigrams.
     :arg is_case_sensitive: Whether the match should be performed
         case-sensitive
+    :arg with_script: Whether to confirm the trigram matches by running the
+        regex itself. Without it, the filter is only a cheap, over-inclusive
+        approximation, for callers which check the results themselves.
 
     """
     trigram_field = ('%s.trigrams' if is_case_sensitive else
@@ -573,11 +577,14 @@ def es_regex_filter(parsed_regex, raw_field, is_case_sensitive):
         # query at this point. It would be slower but tolerable on a
         # moz-central-sized codebase: perhaps 500ms rather than 80.
     else:
+        trigram_filter = boolean_filter_tree(substrings, trigram_field)
+        if not with_script:
+            return trigram_filter
         # Should be fine even if the regex already starts or ends with .*:
         js_regex = JsRegexVisitor().visit(parsed_regex)
         return {
             'and': [
-                boolean_filter_tree(substrings, trigram_field),
+                trigram_filter,
                 {
                     'script': {
                         'lang': 'js',
@@ -1,15 +1,16 @@
-from collections import Mapping, defaultdict
+from collections import Mapping, OrderedDict, defaultdict
 from commands import getstatusoutput
 from contextlib import contextmanager
 from datetime import datetime
 from errno import ENOENT
 import fnmatch
 from functools import wraps
-from itertools import izip, imap
-from os import chdir, dup, fdopen, getcwd
+from itertools import chain, imap, islice, izip, izip_longest, repeat
+from os import chdir, dup, fdopen, getcwd, sysconf
 from os.path import join
 from shutil import rmtree
 from sys import stdout
+from threading import Lock
 from urllib import quote, quote_plus
 
 from flask import current_app
@@ -65,6 +66,16 @@ def open_log(folder, name, use_stdout=False):
     return open(join(folder, name), 'w', 1)
 
 
+def rss_bytes():
+    """Return the resident set size of this process in bytes, or None if we
+    can't tell."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * sysconf('SC_PAGE_SIZE')
+    except (IOError, ValueError, IndexError):
+        return None
+
+
 def non_negative_int(s, default):
     """Parse a string into an int >= 0. If parsing fails or the result is out
     of bounds, return a default."""
@@ -148,6 +159,21 @@ def append_by_line(dest_lists, list_per_line):
     return dest_lists
 
 
+def by_line(iterables, num_lines):
+    """Lazily zip several per-line iterables together, yielding a tuple of
+    what each has for each line.
+
+    Pad with empty tuples the iterables that run short, and stop after
+    ``num_lines``, just as :func:`append_update_by_line()` and
+    :func:`append_by_line()` would over lists of ``num_lines`` elements.
+
+    """
+    padding = tuple(() for _ in iterables)
+    return islice(chain(izip_longest(*iterables, fillvalue=()),
+                        repeat(padding)),
+                  num_lines)
+
+
 def decode_es_datetime(es_datetime):
     """Turn an elasticsearch datetime into a datetime object."""
     try:
@@ -168,6 +194,84 @@ def glob_to_regex(glob):
     return fnmatch.translate(glob)[:-_FNMATCH_TRANSLATE_SUFFIX_LEN]
 
 
+def es_regexp_escape(text):
+    """Escape everything but letters and digits in some text to be matched
+    literally by an ES (Lucene) ``regexp``, which reserves more punctuation
+    than Python does."""
+    return u''.join(c if c.isalnum() else u'\\' + c for c in text)
+
+
+def glob_to_es_regexp(glob, is_case_sensitive=True, within_segment=False):
+    """Return an ES (Lucene) ``regexp`` pattern equivalent to a shell-style
+    glob.
+
+    Lucene regexps are always anchored at both ends and have no flag for
+    case-insensitivity, so fold case by spelling out both cases of each
+    letter.
+
+    :arg within_segment: Whether wildcards should stop at slashes, for
+        matching globs against file names at the ends of paths
+
+    """
+    def char(c):
+        if is_case_sensitive or c.lower() == c.upper():
+            return es_regexp_escape(c)
+        return u'[%s%s]' % (c.lower(), c.upper())
+
+    def char_class(stuff):
+        """Turn the inside of a glob's [...] into a Lucene one's."""
+        negated = stuff.startswith('!')
+        if negated:
+            stuff = stuff[1:]
+        ranges = []
+        i = 0
+        while i < len(stuff):
+            if i + 2 < len(stuff) and stuff[i + 1] == '-':
+                ranges.append((stuff[i], stuff[i + 2]))
+                i += 3
+            else:
+                ranges.append((stuff[i], stuff[i]))
+                i += 1
+        if not is_case_sensitive:
+            ranges.extend([(a.swapcase(), b.swapcase()) for a, b in ranges
+                           if a.isalpha() and b.isalpha() and
+                           a.swapcase() <= b.swapcase()])
+        if negated and within_segment:
+            ranges.append(('/', '/'))
+        return u'[%s%s]' % (
+            u'^' if negated else u'',
+            u''.join(u'\\' + a if a == b else u'\\%s-\\%s' % (a, b)
+                     for a, b in ranges))
+
+    any_char = u'[^/]' if within_segment else u'.'
+    i, n = 0, len(glob)
+    regexp = []
+    while i < n:
+        c = glob[i]
+        i += 1
+        if c == '*':
+            regexp.append(any_char + u'*')
+        elif c == '?':
+            regexp.append(any_char)
+        elif c == '[':
+            # Find the end of the class the way fnmatch.translate() does.
+            j = i
+            if j < n and glob[j] == '!':
+                j += 1
+            if j < n and glob[j] == ']':
+                j += 1
+            while j < n and glob[j] != ']':
+                j += 1
+            if j >= n:
+                regexp.append(char(c))
+            else:
+                regexp.append(char_class(glob[i:j]))
+                i = j + 1
+        else:
+            regexp.append(char(c))
+    return u''.join(regexp)
+
+
 def cached(f):
     """Cache the result of a function that takes an iterable of plugins."""
     # TODO: Generalize this into a general memoizer function later if needed.
@@ -186,6 +290,61 @@ def cached(f):
     return inner
 
 
+class LruCache(object):
+    """A thread-safe mapping holding up to a fixed number of items, and
+    optionally up to a fixed number of bytes of them, which forgets the least
+    recently used ones first"""
+
+    def __init__(self, max_size, max_bytes=0):
+        """
+        :arg max_size: The most items to hold. 0 holds nothing.
+        :arg max_bytes: If nonzero, the most bytes of items to hold, going by
+            the sizes passed to :meth:`set()`
+
+        """
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()  # {key: (value, bytes)}
+        self._bytes = 0
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        """Return the value for a key, or ``default`` if it isn't there."""
+        with self._lock:
+            try:
+                value_and_bytes = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value_and_bytes  # Move to the most recent end.
+            return value_and_bytes[0]
+
+    def set(self, key, value, bytes=0):
+        """Store a value, forgetting the least recently used ones if we're
+        full.
+
+        :arg bytes: The approximate size of the value. If it's more than
+            ``max_bytes`` on its own, we don't store it.
+
+        """
+        if not self.max_size or (self.max_bytes and bytes > self.max_bytes):
+            return
+        with self._lock:
+            self._forget(key)
+            self._items[key] = value, bytes
+            self._bytes += bytes
+            while (len(self._items) > self.max_size or
+                   (self.max_bytes and self._bytes > self.max_bytes)):
+                self._forget(next(iter(self._items)))
+
+    def _forget(self, key):
+        """Drop an item, if it's there. Call with the lock held."""
+        _, bytes = self._items.pop(key, (None, 0))
+        self._bytes -= bytes
+
+    def __len__(self):
+        return len(self._items)
+
+
 class frozendict(dict):
     """A dict that can be hashed if all its values are hashable
 
@@ -109,6 +109,18 @@ class Vcs(object):
         """Return a human-readable revision identifier for the repository."""
         raise NotImplementedError
 
+    def changed_files(self, revision):
+        """Return the paths of tracked files that differ between ``revision``
+        and the working copy, including ones added or deleted since then.
+
+        Paths are relative to the root of the VCS. Untracked files are not
+        included.
+
+        Raise NotImplementedError if the VCS has no way of telling.
+
+        """
+        raise NotImplementedError
+
 
 class Mercurial(Vcs):
     command = 'hg'
@@ -195,6 +207,15 @@ class Mercurial(Vcs):
     def generate_log(self, path):
         return "{}filelog/{}/{}".format(self.upstream, self.revision, path)
 
+    def changed_files(self, revision):
+        # Modified, added, removed, and deleted-but-not-removed:
+        with open(os.devnull, 'w') as devnull:
+            return [path for path in
+                    self.invoke_vcs(['status', '--rev', revision, '-mard',
+                                     '--no-status', '--print0'],
+                                    self.root, stderr=devnull).split('\0')
+                    if path]
+
     @classmethod
     def get_contents(cls, working_dir, rel_path, revision, stderr=None):
         return cls.invoke_vcs(['cat', '-r', revision, rel_path], working_dir, stderr=stderr)
@@ -293,6 +314,16 @@ class Git(Vcs):
     def generate_log(self, path):
         return "{}/commits/{}/{}".format(self.upstream, self.revision, path)
 
+    def changed_files(self, revision):
+        # Renames come out as a deletion and an addition this way, which is
+        # just what we want.
+        with open(os.devnull, 'w') as devnull:
+            return [path for path in
+                    self.invoke_vcs(['diff', '--name-only', '--no-renames',
+                                     '-z', revision],
+                                    self.root, stderr=devnull).split('\0')
+                    if path]
+
     @classmethod
     def get_contents(cls, working_dir, rel_path, revision, stderr=None):
         return cls.invoke_vcs(['show', revision + ':./' + rel_path], working_dir, stderr=stderr)
@@ -375,23 +406,41 @@ class Perforce(Vcs):
 every_vcs = [Mercurial, Git, Perforce]
 
 
-def tree_to_repos(tree):
+def claim_repos(folder, subfolders, tree):
+    """Return a list of Vcs objects for the repositories rooted at a folder.
+
+    :arg subfolders: The names of the folder's subfolders. Like
+        ``os.walk()``'s, this list may be edited in place to keep a walk out of
+        a VCS's private folders.
+
+    """
+    return [attempt for attempt in
+            (vcs.claim_vcs_source(folder, subfolders, tree)
+             for vcs in every_vcs)
+            if attempt is not None]
+
+
+def tree_to_repos(tree, roots=None):
     """Given a TreeConfig, return a mapping {root: Vcs object} where root is a
     directory under tree.source_folder where root is a directory under
     tree.source_folder. Traversal of the returned mapping follows the order of
     deepest directory first.
 
     :arg tree: TreeConfig object representing a source code tree
+    :arg roots: A mapping {root: Vcs object} of the repositories within the
+        source folder, if a walk of it already found them. Otherwise, we
+        walk it ourselves.
 
     """
-    sources = {}
-    # Find all of the VCSs in the source directory:
-    # We may see multiple VCS if we use git submodules, for example.
-    for cwd, dirs, files in os.walk(tree.source_folder):
-        for vcs in every_vcs:
-            attempt = vcs.claim_vcs_source(cwd, dirs, tree)
-            if attempt is not None:
+    if roots is None:
+        sources = {}
+        # Find all of the VCSs in the source directory:
+        # We may see multiple VCS if we use git submodules, for example.
+        for cwd, dirs, files in os.walk(tree.source_folder):
+            for attempt in claim_repos(cwd, dirs, tree):
                 sources[attempt.root] = attempt
+    else:
+        sources = dict(roots)
 
     # It's possible that the root of the tree is not a VCS by itself, so walk up
     # the hierarchy until we find a parent folder that is a VCS. If we can't
@@ -469,14 +518,16 @@ class VcsCache(object):
     """This class offers a way to obtain Vcs objects for any file within a
     given tree."""
 
-    def __init__(self, tree):
+    def __init__(self, tree, roots=None):
         """Construct a VcsCache for the given tree.
 
         :arg tree: TreeConfig object representing a source code tree
+        :arg roots: Repositories already found in the tree, as for
+            :func:`tree_to_repos()`
 
         """
         self.tree = tree
-        self.repos = tree_to_repos(tree)
+        self.repos = tree_to_repos(tree, roots)
         self._path_cache = {}
 
     def vcs_for_path(self, path):
@@ -1,19 +1,57 @@
 import os
-from os.path import dirname
+from os.path import dirname, getmtime
+from threading import Lock
 
 from dxr.app import make_app
 from dxr.config import Config
 from dxr.utils import file_text
 
 
+# {config path: (config file mtime, app)}. Building an app means parsing and
+# validating the config and making a fresh ES connection pool, so we do it
+# once per process rather than once per request.
+_apps = {}
+_apps_lock = Lock()
+
+
+def app_for(config_path, reload=False):
+    """Return the DXR app for a config file, building it the first time it's
+    asked for.
+
+    :arg reload: Whether to build a fresh app if the config file has been
+        modified since the last one was built
+
+    """
+    built = _apps.get(config_path)
+    if built is not None:
+        if not reload:
+            return built[1]
+        mtime = getmtime(config_path)
+        if mtime == built[0]:
+            return built[1]
+    with _apps_lock:
+        # Another thread may have beaten us to it.
+        mtime = getmtime(config_path)
+        built = _apps.get(config_path)
+        if built is None or (reload and built[0] != mtime):
+            built = _apps[config_path] = (
+                mtime,
+                make_app(Config(file_text(config_path),
+                                relative_to=dirname(config_path))))
+        return built[1]
+
+
 def application(environ, start_response):
-    """Pull the config file path out of an env var, and then instantiate the
-    WSGI app as normal.
+    """Pull the config file path out of an env var, and then hand the request
+    to the WSGI app for that config.
 
     This prefers the Apache SetEnv sort of environment; but if that's missing,
     try the process-level env var instead since it's easier to set for some
     users, like those using Stackato.
 
+    Set ``DXR_CONFIG_RELOAD`` to a non-empty value to have each request check
+    whether the config file has changed and, if it has, rebuild the app.
+
     """
     try:
         config_path = environ['DXR_CONFIG']
@@ -21,6 +59,6 @@ def application(environ, start_response):
         # Not found in WSGI env. Try process env:
         # If this still fails, this is a fatal error.
         config_path = os.environ['DXR_CONFIG']
-    return make_app(Config(file_text(config_path),
-                           relative_to=dirname(config_path)))(environ,
-                                                              start_response)
+    reload = environ.get('DXR_CONFIG_RELOAD',
+                         os.environ.get('DXR_CONFIG_RELOAD'))
+    return app_for(config_path, reload=bool(reload))(environ, start_response)
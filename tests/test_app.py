@@ -4,11 +4,21 @@ Much of the module is covered in the course of the integration tests that test
 everything else. Here are a few unit tests.
 
 """
+import json
+from os import utime
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
 from unittest import TestCase
 
-from nose.tools import eq_
+from nose.tools import eq_, ok_
 
-from dxr.app import _linked_pathname
+from dxr.app import (_cached_search, _line_docs, _linked_pathname,
+                     LINES_PER_PAGE, make_app, MAX_CACHED_RESULT_BYTES)
+from dxr.config import Config
+from dxr.es import frozen_config, frozen_configs, numbered_sources
+from dxr.testing import make_file
+from dxr.wsgi import app_for
 
 
 class LinkedPathnameTests(TestCase):
@@ -22,3 +32,263 @@ class LinkedPathnameTests(TestCase):
     def test_root_folder(self):
         """Make sure the root folder is treated correctly."""
         eq_(_linked_pathname('', 'stuff'), [('/stuff/source', 'stuff')])
+
+
+def test_catalog_cache():
+    """Make sure the catalog is read once per catalog_cache_ttl, not once per
+    frozen_config() call."""
+    class CatalogEs(object):
+        searches = 0
+
+        def search(self, query, **kwargs):
+            self.searches += 1
+            return {'hits': {'hits': [{'_source': {'name': 'code',
+                                                   'es_alias': 'dxr_code'}}]}}
+
+    app = make_app(Config('[DXR]\n'
+                          'catalog_cache_ttl = 60\n'
+                          'enabled_plugins = pygmentize\n'
+                          '[code]\n'
+                          'source_folder = /\n'))
+    app.es = CatalogEs()
+    with app.test_request_context():
+        eq_(frozen_config('code')['es_alias'], 'dxr_code')
+        eq_(frozen_config('code')['es_alias'], 'dxr_code')
+        eq_([tree['name'] for tree in frozen_configs()], ['code'])
+    eq_(app.es.searches, 1)
+
+
+def test_search_cache_skips_big_results():
+    """Results too big to cache should be computed every time, and the rest
+    only once."""
+    class Terms(object):
+        terms = []
+
+    computed = []
+
+    def compute(value):
+        def compute():
+            computed.append(value)
+            return value
+        return compute
+
+    app = make_app(Config('[DXR]\n'
+                          'enabled_plugins = pygmentize\n'
+                          '[code]\n'
+                          'source_folder = /\n'))
+    big = u'x' * (MAX_CACHED_RESULT_BYTES + 1)
+    with app.test_request_context():
+        for _ in xrange(2):
+            eq_(_cached_search('dxr_code_1', Terms(), ['small'],
+                               compute(u'small')),
+                u'small')
+            eq_(_cached_search('dxr_code_1', Terms(), ['big'], compute(big)),
+                big)
+    eq_(computed, [u'small', big, big])
+
+
+def test_numbered_sources():
+    """Make sure docs come out in order a page at a time, each page picking up
+    after the greatest number in the last, even for multi-numbered docs."""
+    blocks = [{'number': [1, 2]}, {'number': [3, 4]}, {'number': [5]}]
+
+    class PagingEs(object):
+        searches = 0
+
+        def search(self, query, size=None, **kwargs):
+            self.searches += 1
+            filter = query['query']['filtered']['filter']
+            after = (filter['and'][1]['range']['number']['gt']
+                     if 'and' in filter else 0)
+            page = [block for block in blocks
+                    if max(block['number']) > after][:size]
+            return {'hits': {'hits': [{'_source': block,
+                                       'sort': [max(block['number'])]}
+                                      for block in page]}}
+
+    app = make_app(Config('[DXR]\n'
+                          'enabled_plugins = pygmentize\n'
+                          '[code]\n'
+                          'source_folder = /\n'))
+    app.es = PagingEs()
+    with app.test_request_context():
+        eq_(list(numbered_sources('dxr_code', 'line_block', {'path': 'a'},
+                                  page_size=2)),
+            blocks)
+    eq_(app.es.searches, 2)
+
+
+class LinesEs(object):
+    """A stand-in for ES holding a tree with a 5-line file, a.py, in which
+    each line is 8 chars long and has its string highlit and annotated
+
+    Remember the ranges of lines asked for and how many docs were asked for
+    at once.
+
+    """
+    def __init__(self):
+        self.ranges = []
+        self.sizes = []
+
+    def search(self, query, doc_type=None, size=None, **kwargs):
+        if doc_type == 'tree':
+            sources = [{'name': 'code',
+                        'es_alias': 'dxr_code',
+                        'enabled_plugins': ['pygmentize'],
+                        'description': '',
+                        'generated_date': 'today'}]
+        elif doc_type == 'file':
+            # There are no folders but the root.
+            sources = ([] if 'folder' in query['query']['filtered']['filter']['term']
+                       else [{'links': []}])
+        else:
+            bounds = query['query']['filtered']['filter']['and'][1]
+            bounds = bounds['range']['number']
+            self.ranges.append(bounds)
+            self.sizes.append(size)
+            sources = [{'number': [number],
+                        'content': ['x = "%s"\n' % number],
+                        'regions': [{'payload': 's',
+                                     'start': number * 8 - 4,
+                                     'end': number * 8 - 1}],
+                        'annotations': [{'title': str(number)}]}
+                       for number in xrange(1, 6)
+                       if bounds.get('gte', 1) <= number and
+                          number <= bounds['lte']]
+        return {'hits': {'hits': [{'_source': source,
+                                   'sort': source.get('number')}
+                                  for source in sources[:size]]}}
+
+
+def test_browse_first_lines():
+    """Make sure a browse page fetches and renders only the first
+    browse_lines lines, and tells lazy-lines.js where to pick up."""
+    app = make_app(Config('[DXR]\n'
+                          'enabled_plugins = pygmentize\n'
+                          'browse_lines = 2\n'
+                          '[code]\n'
+                          'source_folder = /\n'))
+    app.es = LinesEs()
+    page = app.test_client().get('/code/source/a.py').data
+    ok_('<code id="line-2" aria-labelledby="2">x = <span class="s">"2"</span>'
+        in page)
+    ok_('id="line-3"' not in page)
+    ok_('title="2"' in page)
+    ok_('data-line-count="2" data-offset="16"' in page)
+    # Just 1 line past the page was fetched, to see whether there were more:
+    eq_([bounds.get('lte') for bounds in app.es.ranges], [3])
+    eq_(app.es.sizes, [3])
+
+
+def test_line_docs_page_size():
+    """Make sure no request for a file's lines asks for more than the range
+    or LINES_PER_PAGE, counting the lines in blocks."""
+    class PageSizeEs(object):
+        def __init__(self):
+            self.sizes = []
+
+        def search(self, query, doc_type=None, size=None, **kwargs):
+            self.sizes.append((doc_type, size))
+            return {'hits': {'hits': []}}
+
+    app = make_app(Config('[DXR]\n'
+                          'enabled_plugins = pygmentize\n'
+                          '[code]\n'
+                          'source_folder = /\n'))
+    app.es = PageSizeEs()
+    with app.test_request_context():
+        frozen = {'es_alias': 'dxr_code', 'line_block_size': 10}
+        list(_line_docs(frozen, 'a.py', first=11, last=31))
+        list(_line_docs(frozen, 'a.py'))
+    eq_(app.es.sizes, [('line_block', 4),
+                       ('line_block', LINES_PER_PAGE // 10 + 1)])
+
+
+def test_lines_from_blocks():
+    """In a tree with blocks, browsing should piece lines together from the
+    blocks alone, each with its own refs, regions, and annotations."""
+    class BlocksEs(object):
+        def __init__(self):
+            self.doc_types = []
+
+        def search(self, query, doc_type=None, size=None, **kwargs):
+            self.doc_types.append(doc_type)
+            block = {'number': [1, 2, 3],
+                     'content': ['a\n', 'b\n', 'c\n'],
+                     'regions': [{'start': 2, 'end': 3, 'payload': 'k',
+                                  'number': 2}],
+                     'annotations': [{'title': 'x', 'number': 3}]}
+            return {'hits': {'hits': [{'_source': block, 'sort': [3]}]}}
+
+    app = make_app(Config('[DXR]\n'
+                          'enabled_plugins = pygmentize\n'
+                          '[code]\n'
+                          'source_folder = /\n'))
+    app.es = BlocksEs()
+    with app.test_request_context():
+        frozen = {'es_alias': 'dxr_code', 'line_block_size': 10}
+        eq_(list(_line_docs(frozen, 'a.py', first=2, last=3)),
+            [{'content': 'b\n',
+              'regions': [{'start': 2, 'end': 3, 'payload': 'k'}]},
+             {'content': 'c\n', 'annotations': [{'title': 'x'}]}])
+    eq_(app.es.doc_types, ['line_block'])
+
+
+def test_rendered_lines():
+    """Make sure rendered_lines() fetches and renders just the lines asked
+    for, no more than browse_lines at once, with their offsets reckoned from
+    the one passed in, and returns their annotations, whether there are more,
+    and where they'd start."""
+    app = make_app(Config('[DXR]\n'
+                          'enabled_plugins = pygmentize\n'
+                          'browse_lines = 2\n'
+                          '[code]\n'
+                          'source_folder = /\n'))
+    app.es = LinesEs()
+    client = app.test_client()
+    response = json.loads(
+        client.get('/code/rendered-lines/a.py?start=3&end=4&offset=16').data)
+    eq_(response['lines'], ['x = <span class="s">"3"</span>\n',
+                            'x = <span class="s">"4"</span>\n'])
+    eq_(response['annotations'], [[{'title': '3'}], [{'title': '4'}]])
+    ok_(response['more'])
+    eq_(response['offset'], 32)
+    # The lines before weren't fetched:
+    ok_(all(bounds.get('gte') == 3 for bounds in app.es.ranges))
+
+    response = json.loads(
+        client.get('/code/rendered-lines/a.py?start=4&end=9&offset=24').data)
+    eq_(len(response['lines']), 2)
+    ok_('"5"' in response['lines'][1])
+    ok_(not response['more'])
+    eq_(response['offset'], 40)
+
+    # No more than browse_lines come back at once:
+    response = json.loads(
+        client.get('/code/rendered-lines/a.py?start=1&end=9').data)
+    eq_(len(response['lines']), 2)
+    ok_(response['more'])
+
+
+def test_app_built_once():
+    """Make sure the WSGI entrypoint reuses its app until the config file
+    changes, and then only if asked to reload."""
+    folder = mkdtemp()
+    try:
+        config_path = join(folder, 'dxr.config')
+        config = ('[DXR]\n'
+                  'enabled_plugins = pygmentize\n'
+                  '[code]\n'
+                  'source_folder = /\n')
+        make_file(folder, 'dxr.config', config)
+        app = app_for(config_path)
+        ok_(app_for(config_path) is app)
+
+        make_file(folder, 'dxr.config', config + 'description = Code\n')
+        utime(config_path, (0, 0))
+        ok_(app_for(config_path) is app)
+        reloaded = app_for(config_path, reload=True)
+        ok_(reloaded is not app)
+        eq_(reloaded.dxr_config.trees['code'].description, 'Code')
+    finally:
+        rmtree(folder)
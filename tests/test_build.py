@@ -0,0 +1,655 @@
+"""Tests for indexing machinery that doesn't need elasticsearch"""
+
+from copy import deepcopy
+import json
+from os import listdir
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Event, Lock
+from time import sleep
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from nose.tools import eq_, ok_, assert_raises
+from pyelasticsearch import BulkError
+import pygments
+
+from dxr.build import (blocked_lines, BulkSender, BulkThrottle, cached_lines,
+                       caching_lines, Checkpoint, ChunkStats,
+                       copy_unchanged_docs, Export, IgnoreMatcher,
+                       index_metadata, INDEX_BYTES_PER_SOURCE_BYTE,
+                       interned_refs, library_versions, ManifestFile,
+                       MIN_CHUNK_BYTES,
+                       path_chunks, plan_incremental_index, plan_shards,
+                       recycling_reason, RecyclingPool, ResumeState,
+                       shards_over, trees_to_start)
+from dxr.config import Config
+from dxr.es import (BLOCKED_LINE_ARRAYS, LINE_BLOCK, REF, unblocked_line_docs,
+                    unblocked_lines)
+from dxr.filters import FILE, LINE
+from dxr.lines import ref_payload_id
+
+
+def test_line_cache_round_trip():
+    """Make sure lines come back out of the index cache as they went in, even
+    if the consumer scribbles on them."""
+    folder = mkdtemp()
+    try:
+        path = join(folder, 'ab', 'cdef.json.gz')
+        lines = [{'number': [1], 'content': [u'h\xe9llo']},
+                 {'number': [2], 'content': [u''],
+                  'refs': [{'start': 0, 'end': 1, 'payload': {}}]}]
+        for line in caching_lines([dict(l) for l in lines], path):
+            line['path'] = [u'scribbled']
+        eq_(list(cached_lines(path)), lines)
+    finally:
+        rmtree(folder)
+
+
+def test_line_cache_abandoned():
+    """An entry should appear in the index cache only if all its lines were
+    consumed."""
+    folder = mkdtemp()
+    try:
+        path = join(folder, 'ab', 'cdef.json.gz')
+        lines = caching_lines([{'number': [1]}, {'number': [2]}], path)
+        next(lines)
+        lines.close()
+        eq_(listdir(join(folder, 'ab')), [])
+    finally:
+        rmtree(folder)
+
+
+def test_library_versions():
+    """The index cache key should change with the versions of the libraries
+    plugins use, like Pygments."""
+    ok_('Pygments %s' % pygments.__version__ in library_versions())
+
+
+def test_path_chunks():
+    """Make sure the biggest files go out first and that chunks shrink toward
+    the end of the run."""
+    sizes = {'huge': 8 * MIN_CHUNK_BYTES,
+             'big': 3 * MIN_CHUNK_BYTES,
+             'medium': MIN_CHUNK_BYTES // 2,
+             'small': 10,
+             'tiny': 1}
+    chunks = path_chunks([ManifestFile(name, size, 0, False) for name, size
+                          in sorted(sizes.iteritems())],
+                         workers=1)
+    eq_(chunks, [['huge'], ['big'], ['medium', 'small', 'tiny']])
+
+
+def test_ignore_matcher():
+    """Make sure the compiled matcher agrees with matching each glob on its
+    own."""
+    matcher = IgnoreMatcher(['.*', '*.o', 'CVS'],
+                            ['/build/', '/docs/*.html', '/a?c/[!x]'])
+    for name, rel_path, is_folder, ignored in [
+            ('.hg', '.hg', True, True),
+            ('foo.o', 'src/foo.o', False, True),
+            ('foo.c', 'src/foo.c', False, False),
+            ('CVS', 'src/CVS', True, True),
+            ('CVSROOT', 'src/CVSROOT', True, False),
+            ('build', 'build', True, True),
+            ('build', 'build', False, False),
+            ('build', 'src/build', True, False),
+            ('x.html', 'docs/x.html', False, True),
+            ('x.html', 'docs/sub/x.html', False, True),  # * spans slashes.
+            ('y', 'abc/y', False, True),
+            ('x', 'abc/x', False, False),
+            ('line\nbreak', 'line\nbreak', False, False)]:
+        eq_(matcher.is_ignored(name, rel_path, is_folder), ignored,
+            msg='%s was wrongly %s.' %
+                (rel_path, 'ignored' if not ignored else 'kept'))
+    ok_(not IgnoreMatcher([], []).is_ignored('anything', 'anything'))
+
+
+class RecordingEs(object):
+    """A stand-in for an ElasticSearch object which remembers bulk requests
+
+    It rejects an action called "reject" the first time it sees it, as an
+    overloaded ES would, and fails on one called "fail".
+
+    """
+    def __init__(self):
+        self.actions = []
+        self.requests = 0
+        self._rejected = set()
+
+    def send_request(self, method, path_components, body=''):
+        self.requests += 1
+        items = []
+        for action in body.splitlines():
+            if action == 'fail':
+                status = 400
+            elif action.startswith('reject') and action not in self._rejected:
+                self._rejected.add(action)
+                status = 429
+            else:
+                self.actions.append((path_components[0], action))
+                status = 201
+            items.append({'index': {'status': status}})
+        return {'errors': True, 'items': items}
+
+
+def test_bulk_sender():
+    """Make sure everything sent through a threaded BulkSender arrives,
+    including things ES rejected the first time."""
+    es = RecordingEs()
+    actions = [str(i) for i in xrange(2000)] + ['reject1', 'reject2']
+    with BulkSender(es, 'some_index', threads=3) as sender:
+        sender.add_all(actions)
+    eq_(sorted(es.actions), sorted(('some_index', a) for a in actions))
+
+
+def test_bulk_sender_chunk_growth():
+    """Make sure chunks grow while ES responds promptly."""
+    es = RecordingEs()
+    with BulkSender(es, 'some_index', threads=0,
+                    throttle=BulkThrottle(1, 10)) as sender:
+        sender.add_all(str(i) for i in xrange(3000))
+    ok_(es.requests < 3000 / BulkThrottle.DOCS_PER_CHUNK)
+
+
+def test_export_round_trip():
+    """Make sure exported bulk requests read back as the actions they were,
+    compressed or not, filed under their default doc types."""
+    folder = mkdtemp()
+    try:
+        actions = ['{"index": {}}\n{"number": [%s]}' % i for i in xrange(3)]
+        with Export(folder).sender('chunk-1') as sender:
+            sender.add_all(actions)
+        with Export(folder, compress=True).sender('folders',
+                                                  doc_type='file') as sender:
+            sender.add_all(actions[:1])
+        export = Export(folder)
+        eq_(export.bulk_files(),
+            [('file', join(folder, 'file-folders.ndjson.gz')),
+             ('line', join(folder, 'line-chunk-1.ndjson'))])
+        eq_([list(export.actions(path)) for _, path in export.bulk_files()],
+            [actions[:1], actions])
+    finally:
+        rmtree(folder)
+
+
+def test_bulk_throttle_backoff():
+    """Make sure failures shrink chunks and concurrency, but never below a
+    floor."""
+    throttle = BulkThrottle(max_in_flight=4, slow_seconds=1)
+    for _ in xrange(10):
+        throttle.succeeded(0.1)
+    eq_(throttle.in_flight_limit, 4)
+    throttle.succeeded(2)  # too slow
+    eq_(throttle.in_flight_limit, 2)
+    for _ in xrange(20):
+        throttle.failed()
+    eq_(throttle.in_flight_limit, 1)
+    eq_(throttle.docs_per_chunk, BulkThrottle.DOCS_PER_CHUNK * BulkThrottle.MIN_SCALE)
+
+
+class GatedEs(object):
+    """A stand-in for ES which holds every bulk request until released,
+    noting the most it held at once"""
+
+    def __init__(self):
+        self.release = Event()
+        self.most_in_flight = 0
+        self._in_flight = 0
+        self._lock = Lock()
+
+    def send_request(self, method, path_components, body=''):
+        with self._lock:
+            self._in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self._in_flight)
+        self.release.wait(10)
+        with self._lock:
+            self._in_flight -= 1
+        return {'errors': False}
+
+
+def test_bulk_rejection_cuts_concurrency():
+    """A rejection seen by one sender should cut the number of requests the
+    process's other senders get in flight at once."""
+    throttle = BulkThrottle(max_in_flight=4, slow_seconds=10)
+    for _ in xrange(10):
+        throttle.succeeded(0.1)
+    eq_(throttle.in_flight_limit, 4)
+
+    with BulkSender(RecordingEs(), 'some_index', threads=0,
+                    throttle=throttle) as sender:
+        sender.add('reject1')
+
+    es = GatedEs()
+    with BulkSender(es, 'some_index', threads=4, throttle=throttle) as sender:
+        sender.add_all('doc' for _ in xrange(4 * throttle.docs_per_chunk))
+        sleep(0.2)  # Let every thread that can get a request in flight.
+        eq_(es.most_in_flight, 2)
+        es.release.set()
+
+
+def test_bulk_throttle_shared():
+    """Senders in one process should share a throttle unless given one."""
+    eq_(BulkSender(RecordingEs(), 'a', threads=0)._throttle,
+        BulkSender(RecordingEs(), 'b', threads=0)._throttle)
+
+
+def test_bulk_sender_errors():
+    """Make sure errors in sending threads make it back to the caller."""
+    es = RecordingEs()
+
+    def send_failure():
+        with BulkSender(es, 'some_index', threads=2) as sender:
+            sender.add('fail')
+            sender.add_all(str(i) for i in xrange(1000))
+    assert_raises(BulkError, send_failure)
+
+
+class StubTreeIndexer(object):
+    plugin_name = 'core'
+
+
+class StubPlugin(object):
+    name = 'core'
+    tree_to_index = StubTreeIndexer
+
+
+class StubTree(object):
+    def __init__(self, folder):
+        self.temp_folder = folder
+        self.source_folder = join(folder, 'src')
+        self.enabled_plugins = [StubPlugin()]
+
+
+#: The index_metadata() of a StubTree
+STUB_METADATA = {'enabled_plugins': ['core'],
+                 'plugin_options': {'core': {}},
+                 'ignore_paths': [],
+                 'ignore_filenames': ['.hg'],
+                 'line_block_size': 100,
+                 'revisions': {'/src': 'abc123'}}
+
+
+class DeletingEs(object):
+    """A stand-in for an ElasticSearch object which remembers
+    delete-by-query requests"""
+
+    def __init__(self):
+        self.deletions = []
+
+    def refresh(self, index):
+        pass
+
+    def delete_by_query(self, index, doc_type, query):
+        self.deletions.append(query['filtered']['filter'])
+
+
+def test_checkpoint_resume():
+    """A resumed run should skip finished chunks and clear out the docs of
+    interrupted ones before redoing them."""
+    folder = mkdtemp()
+    try:
+        tree = StubTree(folder)
+        files = [ManifestFile(join(tree.source_folder, name), 1, 0, False)
+                 for name in ['done', 'cut_off', 'untouched']]
+        checkpoint = Checkpoint(tree)
+        checkpoint.save(ResumeState('dxr_idx', [StubTreeIndexer()], files,
+                                    [join(tree.source_folder, 'sub')],
+                                    STUB_METADATA))
+        checkpoint.record('started', [files[0].path])
+        checkpoint.record('started', [files[1].path])
+        checkpoint.record('finished', [files[0].path])
+
+        es = DeletingEs()
+        state = Checkpoint(tree).resume(es, STUB_METADATA)
+        eq_(state.index, 'dxr_idx')
+        eq_([f.path for f in state.files], [files[1].path, files[2].path])
+        eq_(state.folders, [join(tree.source_folder, 'sub')])
+        eq_(es.deletions, [{'terms': {'path': [u'cut_off']}},
+                           {'term': {'is_folder': True}}])
+    finally:
+        rmtree(folder)
+
+
+def test_checkpoint_missing():
+    """Without a saved state, there should be nothing to resume."""
+    folder = mkdtemp()
+    try:
+        eq_(Checkpoint(StubTree(folder)).resume(DeletingEs(), STUB_METADATA),
+            None)
+    finally:
+        rmtree(folder)
+
+
+def test_checkpoint_outdated():
+    """A run shouldn't resume into an index made from other revisions of the
+    source or with other options."""
+    folder = mkdtemp()
+    try:
+        tree = StubTree(folder)
+        for key, value in [('revisions', {'/src': 'def456'}),
+                           ('plugin_options', {'core': {'x': 1}}),
+                           ('ignore_paths', ['/obj/']),
+                           ('line_block_size', 0)]:
+            Checkpoint(tree).save(ResumeState('dxr_idx',
+                                              [StubTreeIndexer()],
+                                              [],
+                                              [],
+                                              STUB_METADATA))
+            es = DeletingEs()
+            eq_(Checkpoint(tree).resume(es, dict(STUB_METADATA, **{key: value})),
+                None)
+            eq_(es.deletions, [])
+    finally:
+        rmtree(folder)
+
+
+class WorkingTree(object):
+    def __init__(self, name, workers):
+        self.name, self.workers = name, workers
+
+    def __repr__(self):
+        return self.name
+
+
+def test_trees_to_start():
+    """Trees should start in order, within the job and worker budgets, with
+    small trees filling in around big ones."""
+    big, medium, small, tiny, huge = [WorkingTree(name, workers) for
+                                      name, workers in [('big', 6),
+                                                        ('medium', 4),
+                                                        ('small', 2),
+                                                        ('tiny', 0),
+                                                        ('huge', 99)]]
+    pending = [big, medium, small, tiny, huge]
+    eq_(trees_to_start(pending, [], jobs=4, budget=8), [big, small])
+    eq_(trees_to_start(pending, [], jobs=1, budget=8), [big])
+    eq_(trees_to_start([medium, tiny], [big, small], jobs=4, budget=8), [])
+    eq_(trees_to_start([medium, tiny], [big], jobs=4, budget=8), [tiny])
+    # Trees wanting more than the whole budget wait to run alone:
+    eq_(trees_to_start([huge], [tiny], jobs=4, budget=8), [])
+    eq_(trees_to_start([huge], [], jobs=4, budget=8), [huge])
+
+
+class LimitConfig(object):
+    def __init__(self, worker_max_files=0, worker_max_memory=0):
+        self.worker_max_files = worker_max_files
+        self.worker_max_memory = worker_max_memory
+
+
+def test_recycling_reason():
+    """Workers should be retired only once past a limit that's set."""
+    stats = ChunkStats(1, 10, 1.0, {}, [], 300 * 1024 * 1024)
+    eq_(recycling_reason(LimitConfig(), stats, 10000), None)
+    eq_(recycling_reason(LimitConfig(worker_max_files=100), stats, 99), None)
+    eq_(recycling_reason(LimitConfig(worker_max_files=100), stats, 100),
+        'a worker has indexed 100 files')
+    eq_(recycling_reason(LimitConfig(worker_max_memory=400), stats, 1), None)
+    eq_(recycling_reason(LimitConfig(worker_max_memory=200), stats, 1),
+        'a worker has grown to 300 MB')
+    eq_(recycling_reason(LimitConfig(worker_max_memory=200),
+                         stats._replace(rss=None),
+                         1),
+        None)
+
+
+class CountedExecutor(ThreadPoolExecutor):
+    """A one-thread stand-in for a worker process, which keeps count of how
+    many of its kind are alive"""
+    live = most_live = made = 0
+
+    def __init__(self):
+        super(CountedExecutor, self).__init__(max_workers=1)
+        CountedExecutor.made += 1
+        CountedExecutor.live += 1
+        CountedExecutor.most_live = max(CountedExecutor.most_live,
+                                        CountedExecutor.live)
+        self._alive = True
+
+    def shutdown(self, wait=True):
+        super(CountedExecutor, self).shutdown(wait)
+        if self._alive:
+            self._alive = False
+            CountedExecutor.live -= 1
+
+
+def index_stub_chunk(number):
+    sleep(0.01)
+    return ChunkStats(number, 1, 0.01, {}, [], None)
+
+
+def test_recycling_pool():
+    """Workers should be replaced one at a time, never running more than the
+    pool's size at once, as chunks keep flowing."""
+    pool = RecyclingPool(3, LimitConfig(worker_max_files=2),
+                         new_executor=CountedExecutor)
+    numbers = iter(xrange(20))
+    futures, results, reasons = set(), [], []
+    try:
+        while True:
+            while pool.has_room():
+                number = next(numbers, None)
+                if number is None:
+                    break
+                futures.add(pool.submit(index_stub_chunk, number))
+            if not futures:
+                break
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                results.append(future.result().pid)
+                reasons.append(pool.finished(future, future.result()))
+    finally:
+        pool.shutdown()
+    eq_(sorted(results), range(20))
+    ok_(CountedExecutor.most_live <= 3)
+    ok_(CountedExecutor.made > 3)
+    eq_(CountedExecutor.live, 0)
+    ok_('a worker has indexed 2 files' in reasons)
+
+
+def test_recycling_pool_one_chunk_each():
+    """A busy worker shouldn't be handed a chunk an idle one could take
+    later."""
+    release = Event()
+
+    def wait_for_release():
+        release.wait()
+        return ChunkStats(0, 1, 0.01, {}, [], None)
+
+    pool = RecyclingPool(2, LimitConfig(), new_executor=CountedExecutor)
+    try:
+        futures = [pool.submit(wait_for_release) for _ in xrange(2)]
+        ok_(not pool.has_room())
+        release.set()
+        wait(futures[:1])
+        pool.finished(futures[0], futures[0].result())
+        ok_(pool.has_room())
+    finally:
+        release.set()
+        pool.shutdown()
+
+
+class ShardingTree(object):
+    def __init__(self, es_shards, es_shard_size=1):
+        self.es_shards = es_shards
+        self.config = ShardingConfig(es_shard_size)
+
+
+class ShardingConfig(object):
+    def __init__(self, es_shard_size):
+        self.es_shard_size = es_shard_size
+
+
+def test_plan_shards():
+    """Auto shard counts should follow the estimated index size, and fixed
+    ones should stay put."""
+    mb = 1024 * 1024
+    files = [ManifestFile('/a', 3 * mb // INDEX_BYTES_PER_SOURCE_BYTE, 0,
+                          False),
+             ManifestFile('/b', 0, 0, False)]
+    eq_(plan_shards(ShardingTree('auto'), files)['shards'], 3)
+    eq_(plan_shards(ShardingTree('auto', es_shard_size=2), files)['shards'], 2)
+    eq_(plan_shards(ShardingTree('auto'), files[1:])['shards'], 1)
+    eq_(plan_shards(ShardingTree(7), files)['shards'], 7)
+    eq_(plan_shards(ShardingTree(7), files)['estimated_bytes'], 3 * mb)
+
+
+def test_shards_over():
+    """Make sure only primary shards with too many segments count as
+    unmerged."""
+    def copy(primary, segments):
+        return {'routing': {'primary': primary},
+                'num_search_segments': segments}
+
+    segments = {'indices': {'dxr_idx': {'shards': {
+        '0': [copy(True, 1), copy(False, 9)],
+        '1': [copy(True, 3)],
+        '2': [copy(False, 1), copy(True, 2)]}}}}
+    eq_(shards_over(segments, 'dxr_idx', 2), (3, 1))
+    eq_(shards_over(segments, 'dxr_idx', 1), (3, 2))
+
+
+def test_blocked_lines():
+    """Make sure every line lands in a block, with its refs, regions, and
+    annotations, and only lines with structural needles get their own docs,
+    without content."""
+    lines = [{'number': [n], 'content': [u'line %s\n' % n]}
+             for n in xrange(1, 6)]
+    lines[3]['refs'] = [{'start': 0, 'end': 4, 'payload': 'abc'}]
+    lines[3]['py_function'] = [{'name': 'line', 'start': 0, 'end': 4}]
+    lines[4]['regions'] = [{'start': 0, 'end': 4, 'payload': 'k'}]
+    docs = list(blocked_lines([deepcopy(l) for l in lines], 2))
+    eq_([doc_type for doc_type, _ in docs],
+        [LINE_BLOCK, LINE, LINE_BLOCK, LINE_BLOCK])
+    eq_(docs[1][1], {'number': [4], 'py_function': lines[3]['py_function']})
+    blocks = [doc for doc_type, doc in docs if doc_type == LINE_BLOCK]
+    eq_(blocks[0], {'number': [1, 2],
+                    'content': [u'line 1\n', u'line 2\n']})
+    eq_(blocks[1]['refs'], [{'start': 0, 'end': 4, 'payload': 'abc',
+                             'number': 4}])
+    eq_(list(unblocked_lines(blocks)),
+        [(l['number'][0], l['content'][0]) for l in lines])
+    # Each line comes back out with what it went in with, but its number:
+    eq_([doc for block in blocks for _, doc in unblocked_line_docs(block)],
+        [dict((k, v[0] if k == 'content' else v) for k, v in l.iteritems()
+              if k in ['content'] + BLOCKED_LINE_ARRAYS)
+         for l in lines])
+
+
+def test_interned_refs():
+    """Each distinct ref payload should be handed out once, and every ref
+    should point to its payload's ID."""
+    payload = {'plugin': 'clang', 'id': 'Function', 'menu_data': '[]'}
+    other = dict(payload, hover=u'int main()')
+    lines = [{'number': [1], 'refs': [{'start': 0, 'end': 3,
+                                       'payload': dict(payload)}]},
+             {'number': [2], 'refs': [{'start': 0, 'end': 3,
+                                       'payload': dict(payload)},
+                                      {'start': 4, 'end': 5,
+                                       'payload': other}]}]
+    new_payloads = []
+    ref_ids = set([ref_payload_id(other)])
+    interned = interned_refs(lines, ref_ids, new_payloads)
+    next(interned)
+    eq_(new_payloads, [(ref_payload_id(payload), payload)])
+    next(interned)
+    eq_(len(new_payloads), 1)
+    eq_([ref['payload'] for line in lines for ref in line['refs']],
+        [ref_payload_id(payload)] * 2 + [ref_payload_id(other)])
+
+
+class NoVcs(object):
+    """A stand-in for a :class:`~dxr.vcs.VcsCache` of a tree with no
+    repositories"""
+    repos = {}
+
+    def vcs_for_path(self, path):
+        return None
+
+
+class DeployedIndexEs(object):
+    """A stand-in for ES with one deployed index, built with the given
+    settings"""
+
+    def __init__(self, meta):
+        self.meta = meta
+
+    def aliases(self, alias):
+        return {'dxr_old': {}}
+
+    def get_mapping(self, index, doc_type):
+        # Round-trip through JSON, as ES would:
+        return {'dxr_old': {'mappings': {FILE: {
+            '_meta': json.loads(json.dumps(self.meta))}}}}
+
+
+def test_incremental_settings_changed():
+    """An incremental build should start over if anything that decides what
+    gets indexed, or how, differs from the deployed index."""
+    def tree(extra=''):
+        return Config('[DXR]\n'
+                      'enabled_plugins = buglink\n'
+                      '[tree]\n'
+                      'source_folder = /some/path\n' + extra +
+                      '    [[buglink]]\n'
+                      '    url = http://example.com/\n').trees['tree']
+
+    old = tree()
+    es = DeployedIndexEs(index_metadata(old, NoVcs()))
+    ok_(plan_incremental_index(tree(), es, NoVcs(), []) is not None)
+    eq_(plan_incremental_index(tree('ignore_patterns = .git generated\n'),
+                               es, NoVcs(), []),
+        None)
+    eq_(plan_incremental_index(
+            Config('[DXR]\n'
+                   'enabled_plugins = buglink\n'
+                   '[tree]\n'
+                   'source_folder = /some/path\n'
+                   '    [[buglink]]\n'
+                   '    url = http://example.com/\n'
+                   '    regex = (?i)issue ([0-9]+)\n').trees['tree'],
+            es, NoVcs(), []),
+        None)
+
+
+class OldIndexEs(RecordingEs):
+    """A stand-in for ES which serves the docs of an old index through scan
+    and scroll and remembers what's bulk-indexed"""
+
+    def __init__(self, hits):
+        super(OldIndexEs, self).__init__()
+        self._hits = hits
+        self._scrolls = {}
+
+    def search(self, query, index, doc_type, **kwargs):
+        scroll_id = str(len(self._scrolls))
+        self._scrolls[scroll_id] = [hit for hit in self._hits
+                                    if hit['_type'] in doc_type]
+        return {'_scroll_id': scroll_id}
+
+    def send_request(self, method, path_components, body='',
+                     query_params=None):
+        if path_components == ['_search', 'scroll']:
+            hits, self._scrolls[body] = self._scrolls[body], []
+            return {'_scroll_id': body, 'hits': {'hits': hits}}
+        return super(OldIndexEs, self).send_request(method,
+                                                    path_components,
+                                                    body)
+
+    def index_op(self, doc, doc_type=None, id=None):
+        return json.dumps([doc_type, id, doc])
+
+
+def test_copy_unchanged_refs():
+    """Only the REF docs that copied lines point to should be copied."""
+    es = OldIndexEs(
+        [{'_type': LINE, '_source': {'path': [u'same.c'],
+                                     'refs': [{'payload': 'kept'}]}},
+         {'_type': LINE, '_source': {'path': [u'changed.c'],
+                                     'refs': [{'payload': 'dropped'}]}},
+         {'_type': REF, '_id': 'kept', '_source': {'id': 'k'}},
+         {'_type': REF, '_id': 'dropped', '_source': {'id': 'd'}}])
+    copy_unchanged_docs(es, 'old', 'new', set([u'same.c']))
+    eq_(sorted((doc_type, id) for doc_type, id, _ in
+               (json.loads(action) for _, action in es.actions)),
+        [(LINE, None), (REF, 'kept')])
@@ -0,0 +1,55 @@
+"""Tests for sniffing and decoding file contents"""
+
+from mmap import mmap, ACCESS_READ
+from os import close, remove, write
+from tempfile import mkstemp
+
+from nose.tools import eq_, ok_
+
+from dxr.mime import decode_data, is_binary_sample
+
+
+def test_plain_text_sample():
+    """Plain ASCII, whitespace included, should never be called binary."""
+    ok_(not is_binary_sample('int main()\n{\n\treturn 0;\r\n}\f\n'))
+    ok_(not is_binary_sample(''))
+
+
+def test_binary_sample():
+    """Samples full of control characters should still be found binary."""
+    ok_(is_binary_sample('\x00\x01\x02\x03\x7f\x00ELF\x00\x00\x01\x00'))
+
+
+def test_decode_guess():
+    eq_(decode_data('hello\n', 'utf-8'), (True, u'hello\n'))
+    eq_(decode_data('caf\xc3\xa9\n', 'utf-8'), (True, u'caf\xe9\n'))
+
+
+def test_decode_utf8_despite_guess():
+    """UTF-8 should be tried before chardet when the guess fails."""
+    eq_(decode_data('\xe2\x9c\x93 done\n', 'ascii'), (True, u'\u2713 done\n'))
+
+
+def test_decode_chardet():
+    """Fall back to chardet when neither the guess nor UTF-8 works."""
+    is_text, contents = decode_data(
+        'Le caf\xe9 est tr\xe8s bon, n\'est-ce pas? D\xe9j\xe0 vu.\n' * 20,
+        'utf-8')
+    ok_(is_text)
+    ok_(isinstance(contents, unicode))
+    ok_(u'caf\xe9' in contents)
+
+
+def test_decode_mmap():
+    """Mapped files should decode just like strings."""
+    fd, path = mkstemp()
+    try:
+        write(fd, 'caf\xc3\xa9\n')
+        close(fd)
+        with open(path, 'rb') as file:
+            data = mmap(file.fileno(), 0, access=ACCESS_READ)
+            eq_(decode_data(data, 'utf-8', sample_size=4096),
+                (True, u'caf\xe9\n'))
+            data.close()
+    finally:
+        remove(path)
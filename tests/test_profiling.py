@@ -0,0 +1,47 @@
+"""Tests for the accounting of where indexing time goes"""
+
+from time import sleep
+
+from nose.tools import eq_, ok_
+
+from dxr.profiling import Profile, report, CALLS, WALL, DOCS, BYTES
+
+
+def test_exclusive_timing():
+    """Time spent in a nested section, including the steps of a timed
+    iterable, should count only toward the inner key."""
+    profile = Profile()
+
+    def slow_numbers():
+        for i in xrange(3):
+            sleep(0.01)
+            yield i
+
+    with profile.timed(('stage', 'outer')):
+        eq_(list(profile.timed_iter(('plugin', 'p', 'refs'), slow_numbers)),
+            [0, 1, 2])
+    outer = profile.totals[('stage', 'outer')]
+    inner = profile.totals[('plugin', 'p', 'refs')]
+    eq_(outer[CALLS], 1)
+    eq_(inner[CALLS], 1)
+    ok_(inner[WALL] >= 0.03)
+    ok_(outer[WALL] < 0.01)
+
+
+def test_merge_and_report():
+    """Totals from several profiles should add up and come out nested by
+    key."""
+    worker = Profile()
+    worker.add(('es', 'bulk'), wall=1.5, docs=10, bytes=100)
+    master = Profile()
+    master.add(('es', 'bulk'), wall=0.5, docs=5, bytes=50)
+    master.merge(worker.totals)
+    eq_(master.totals[('es', 'bulk')][DOCS], 15)
+    eq_(master.totals[('es', 'bulk')][BYTES], 150)
+    eq_(report(master.totals, tree='code'),
+        {'tree': 'code',
+         'es': {'bulk': {'calls': 2,
+                         'wall_seconds': 2.0,
+                         'cpu_seconds': 0,
+                         'docs': 15,
+                         'bytes': 150}}})
@@ -6,9 +6,13 @@ everything else. Here are a few unit tests.
 """
 from unittest import TestCase
 
-from nose.tools import eq_
+from nose.tools import eq_, ok_
 
-from dxr.query import fix_extents_overlap
+from dxr.es import LINE_BLOCK
+from dxr.filters import FILE, LINE
+from dxr.plugins import plugins_named
+from dxr.query import (fix_extents_overlap, MAX_SCANNED_BLOCKS,
+                       PATH_BATCH_SIZE, Query)
 
 
 class FixExtentsOverlapTests(TestCase):
@@ -49,3 +53,193 @@ class FixExtentsOverlapTests(TestCase):
         """Work even if the highlighting starts at offset 0."""
         eq_(list(fix_extents_overlap([(0, 3), (2, 5), (11, 14)])),
             [(0, 5), (11, 14)])
+
+
+def test_block_query():
+    """Lines found through LINE_BLOCK docs should be checked one by one, and
+    negated terms should let through the lines they don't match."""
+    blocks = [{'path': [u'a.c'],
+               'number': [1, 2, 3],
+               'content': [u'foo bar\n', u'foo\n', u'bar\n']},
+              {'path': [u'b.c'],
+               'number': [1],
+               'content': [u'bar foo\n']}]
+    searches = []
+
+    def es_search(query, doc_type):
+        searches.append(query)
+        page = blocks[query['from']:query['from'] + query['size']]
+        return {'hits': {'total': len(blocks),
+                         'hits': [{'_source': b} for b in page]}}
+
+    query = Query(es_search, 'foo -bar', plugins_named(['core']),
+                  line_block_size=3)
+    results = query.results()
+    eq_(results['result_count'], 1)
+    eq_([(path, [number for number, _ in lines])
+         for _, path, lines in results['results']],
+        [(u'a.c', [2])])
+    # The negated term can't rule out any blocks:
+    eq_(len(searches[0]['query']['filtered']['filter']['and']), 1)
+
+
+def test_file_filters_look_up_paths():
+    """FILE filters whose needles aren't on lines should be resolved against
+    FILE docs and turned into a filter on the lines' paths, inverted if
+    negated. The rest should apply to lines directly."""
+    searches = []
+
+    def es_search(query, doc_type):
+        searches.append((doc_type, query))
+        if doc_type == FILE:
+            return {'hits': {'total': 1,
+                             'hits': [{'_source': {'path': [u'a/b.py']}}]}}
+        return {'hits': {'total': 0, 'hits': []}}
+
+    Query(es_search,
+          'path:a/b -ext:h -module:os.path foo',
+          plugins_named(['core', 'python'])).results()
+    doc_types = [doc_type for doc_type, _ in searches]
+    eq_(doc_types, [FILE, LINE])
+    ands = searches[-1][1]['query']['filtered']['filter']['and']
+    ok_({'or': [{'not': {'terms': {'path': [u'a/b.py']}}}]} in ands)
+    ok_({'or': [{'not': {'regexp': {'path': u'(.*/)?\\.*[^/.][^/]*\\.h'}}}]}
+        in ands)
+    ok_({'or': [{'regexp': {'path': u'.*[aA]\\/[bB].*'}}]} in ands)
+    # The negated module: filter was looked up un-negated:
+    eq_(len(searches[0][1]['query']['filtered']['filter']['and']), 2)
+
+
+def test_many_filter_paths():
+    """FILE filters matching more files than fit in a batch should be looked
+    up a page at a time, however many there are."""
+    count = PATH_BATCH_SIZE * 2 + 1
+    searches = []
+
+    def es_search(query, doc_type):
+        if doc_type == FILE:
+            searches.append(query['from'])
+            return {'hits': {'total': count,
+                             'hits': [{'_source': {'path': [u'%s.py' % i]}}
+                                      for i in xrange(query['from'],
+                                                      min(count,
+                                                          query['from'] +
+                                                          query['size']))]}}
+        searches.append(query['query']['filtered']['filter'])
+        return {'hits': {'total': 0, 'hits': []}}
+
+    Query(es_search, 'module:os foo', plugins_named(['core', 'python'])).results()
+    eq_(searches[:-1], [0, PATH_BATCH_SIZE, PATH_BATCH_SIZE * 2])
+    ok_({'or': [{'terms': {'path': [u'%s.py' % i for i in xrange(count)]}}]}
+        in searches[-1]['and'])
+
+
+def test_block_query_scan_cap():
+    """Paging through blocks should stop at a cap, and the count should be
+    scaled up from the blocks seen when we stop because we have enough."""
+    blocks = [{'path': [u'a.c'], 'number': [n], 'content': [u'foo\n']}
+              for n in xrange(1, MAX_SCANNED_BLOCKS * 2)]
+    searches = []
+
+    def es_search(query, doc_type):
+        searches.append(query)
+        page = blocks[query['from']:query['from'] + query['size']]
+        return {'hits': {'total': len(blocks),
+                         'hits': [{'_source': b} for b in page]}}
+
+    query = Query(es_search, 'bar', plugins_named(['core']),
+                  line_block_size=1)
+    eq_(query.results()['result_count'], 0)
+    eq_(sum(q['size'] for q in searches), MAX_SCANNED_BLOCKS)
+
+    query = Query(es_search, 'foo', plugins_named(['core']),
+                  line_block_size=1)
+    eq_(query.results(limit=10)['result_count'], len(blocks))
+
+
+def test_block_query_negated_structural():
+    """Negated structural terms in a tree with blocks should rule out just the
+    lines whose LINE docs match them."""
+    blocks = [{'path': [u'a.py'],
+               'number': [1, 2, 3],
+               'content': [u'def foo():\n', u'    foo = 1\n', u'bar\n']}]
+    searches = []
+
+    def es_search(query, doc_type):
+        searches.append((doc_type, query))
+        if doc_type == LINE_BLOCK:
+            page = blocks[query['from']:query['from'] + query['size']]
+            return {'hits': {'total': len(blocks),
+                             'hits': [{'_source': b} for b in page]}}
+        return {'hits': {'total': 1,
+                         'hits': [{'_source': {'path': [u'a.py'],
+                                               'number': [1]}}]}}
+
+    query = Query(es_search, 'foo -function:foo',
+                  plugins_named(['core', 'python']), line_block_size=3)
+    results = query.results()
+    eq_([(path, [number for number, _ in lines])
+         for _, path, lines in results['results']],
+        [(u'a.py', [2])])
+    eq_([doc_type for doc_type, _ in searches[:2]], [LINE_BLOCK, LINE])
+    # The lookup asked for LINE docs matching the un-negated term:
+    lookup = repr(searches[1][1])
+    ok_('py_function' in lookup)
+    ok_("'not'" not in lookup)
+
+
+def test_structural_query_in_blocked_tree():
+    """In a tree with blocks, LINE docs lack content, so text terms mixed
+    with structural ones should be checked against content fetched from the
+    blocks."""
+    lines = [{'path': [u'a.py'], 'number': [n],
+              'py_function': [{'name': u'foo', 'start': 4, 'end': 7}]}
+             for n in [1, 3]]
+    block = {'path': [u'a.py'],
+             'number': [1, 2, 3],
+             'content': [u'def foo(bar):\n', u'    bar\n', u'def foo():\n']}
+    searches = []
+
+    def es_search(query, doc_type):
+        searches.append((doc_type, query))
+        if doc_type == LINE:
+            page = lines[query['from']:query['from'] + query['size']]
+            return {'hits': {'total': len(lines),
+                             'hits': [{'_source': l} for l in page]}}
+        return {'hits': {'total': 1, 'hits': [{'_source': block}]}}
+
+    query = Query(es_search, u'function:foo bar',
+                  plugins_named(['core', 'python']), line_block_size=3)
+    results = query.results()
+    eq_(results['result_count'], 1)
+    eq_([(path, [number for number, _ in lines])
+         for _, path, lines in results['results']],
+        [(u'a.py', [1])])
+    eq_([doc_type for doc_type, _ in searches], [LINE, LINE_BLOCK])
+    # The text term wasn't asked of the LINE docs:
+    ok_('content' not in repr(searches[0][1]))
+
+
+def test_direct_line_in_block():
+    """path:line should jump to a line that lives only in a LINE_BLOCK doc."""
+    searches = []
+
+    def es_search(query, doc_type):
+        searches.append(doc_type)
+        if doc_type == FILE:
+            return {'hits': {'total': 1,
+                             'hits': [{'_source': {'path': [u'fee/fum.c']}}]}}
+        return {'hits': {'total': 1 if doc_type == LINE_BLOCK else 0,
+                         'hits': []}}
+
+    query = Query(es_search, 'fum.c:2', plugins_named(['core']),
+                  line_block_size=10)
+    eq_(query.direct_result(), (u'fee/fum.c', 2))
+    eq_(searches, [FILE, LINE_BLOCK])
+
+    # Without blocks, the line has to have a LINE doc. Failing that, we jump
+    # to the file:
+    del searches[:]
+    query = Query(es_search, 'fum.c:2', plugins_named(['core']))
+    eq_(query.direct_result(), (u'fee/fum.c', None))
+    eq_(searches[:2], [FILE, LINE])
@@ -6,8 +6,9 @@ from nose.tools import eq_, assert_raises
 
 from dxr.testing import TestCase
 from dxr.utils import (DXR_BLUEPRINT, append_update, append_update_by_line,
-                       append_by_line, browse_file_url, decode_es_datetime,
-                       deep_update, glob_to_regex, search_url)
+                       append_by_line, browse_file_url, by_line,
+                       decode_es_datetime, deep_update, glob_to_es_regexp,
+                       glob_to_regex, LruCache, search_url)
 
 
 class DeepUpdateTests(TestCase):
@@ -88,6 +89,13 @@ def test_append_by_line():
         [[5, 6], [6, 7, 9]])
 
 
+def test_by_line():
+    """Short iterables should be padded, and long ones cut off."""
+    eq_(list(by_line([iter([[1], [2], [3], [4]]), iter([[5]])], 3)),
+        [([1], [5]), ([2], ()), ([3], ())])
+    eq_(list(by_line([], 2)), [(), ()])
+
+
 def test_glob_to_regex():
     """Make sure glob_to_regex() strips the right static suffix off the end of
     the pattern fnmatch.translate() returns.
@@ -98,12 +106,58 @@ def test_glob_to_regex():
     eq_(glob_to_regex('hi'), 'hi')
 
 
+def test_glob_to_es_regexp():
+    """Make sure glob_to_es_regexp() escapes Lucene's reserved punctuation,
+    folds case, and keeps wildcards within a path segment on request."""
+    eq_(glob_to_es_regexp('a.b*c?'), u'a\\.b.*c.')
+    eq_(glob_to_es_regexp('fish[!14]', within_segment=True),
+        u'fish[^\\1\\4\\/]')
+    eq_(glob_to_es_regexp('a*[b-c]', is_case_sensitive=False,
+                          within_segment=True),
+        u'[aA][^/]*[\\b-\\c\\B-\\C]')
+    eq_(glob_to_es_regexp('[oops'), u'\\[oops')
+
+
 def test_decode_es_datetime():
     """Test that both ES datetime formats are decoded."""
     eq_(datetime(1992, 6, 27, 0, 0), decode_es_datetime("1992-06-27T00:00:00"))
     eq_(datetime(1992, 6, 27, 0, 0, 0), decode_es_datetime("1992-06-27T00:00:00.0"))
 
 
+def test_lru_cache():
+    """Make sure LruCache forgets the least recently used item when full."""
+    cache = LruCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    eq_(cache.get('a'), 1)  # Now b is the least recently used.
+    cache.set('c', 3)
+    eq_(cache.get('b'), None)
+    eq_(cache.get('a'), 1)
+    eq_(cache.get('c'), 3)
+    eq_(len(cache), 2)
+
+    disabled = LruCache(0)
+    disabled.set('a', 1)
+    eq_(disabled.get('a'), None)
+
+
+def test_lru_cache_bytes():
+    """Make sure LruCache forgets items to stay under its byte budget, and
+    doesn't take items bigger than the whole budget."""
+    cache = LruCache(10, max_bytes=100)
+    cache.set('a', 1, bytes=60)
+    cache.set('b', 2, bytes=30)
+    cache.set('a', 1, bytes=50)  # Replacing an item frees its old size.
+    eq_(len(cache), 2)
+    cache.set('c', 3, bytes=40)
+    eq_(cache.get('b'), None)
+    eq_(cache.get('a'), 1)
+    eq_(cache.get('c'), 3)
+    cache.set('huge', 4, bytes=101)
+    eq_(cache.get('huge'), None)
+    eq_(len(cache), 2)
+
+
 class UrlBuilderTests(TestCase):
     """Tests for the speed-optimized URL builders"""
 
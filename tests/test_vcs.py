@@ -0,0 +1,40 @@
+"""Tests for the VCS abstractions that don't need a built tree"""
+
+from os import remove
+from os.path import join
+from shutil import rmtree
+from subprocess import check_call
+from tempfile import mkdtemp
+
+from nose.tools import eq_
+
+from dxr.testing import make_file
+from dxr.utils import cd
+from dxr.vcs import Git
+
+
+def test_git_changed_files():
+    """Make sure Git reports modified, added, deleted, and renamed files, but
+    not untracked ones."""
+    root = mkdtemp()
+    try:
+        with cd(root):
+            check_call(['git', 'init', '-q'])
+            for name in ['modified', 'deleted', 'renamed', 'untouched']:
+                make_file(root, name, u'%s\n' % name)
+            check_call(['git', 'add', '.'])
+            check_call(['git', '-c', 'user.name=me', '-c', 'user.email=me@me',
+                        'commit', '-q', '-m', 'Add some files.'])
+            git = Git(root)
+            old_revision = git.revision
+
+            make_file(root, 'modified', u'different\n')
+            remove(join(root, 'deleted'))
+            check_call(['git', 'mv', 'renamed', 'new name'])
+            make_file(root, 'added', u'added\n')
+            check_call(['git', 'add', 'added'])
+            make_file(root, 'untracked', u'untracked\n')
+        eq_(sorted(git.changed_files(old_revision)),
+            ['added', 'deleted', 'modified', 'new name', 'renamed'])
+    finally:
+        rmtree(root)